@@ -0,0 +1,180 @@
+# =======================================================
+# admission.py - 訂票提交的流量控制 (admission control)
+# =======================================================
+#
+# 訂票機處理不及時，無上限地接受新訂票只會讓佇列與所有人的延遲一起變長。
+# 提交前依序檢查：
+#   1. Idempotency-Key：同一個 key 已建立過訂票時直接回傳原本的 task_id (client 重送不會重複建立)；
+#      同一 key 的請求仍在處理中回傳 in_progress，內容不同則回傳 mismatch
+#   2. 待處理訂票數 (佇列 + 處理中) 達到上限：拒絕，Retry-After 依目前的佇列消化速度估算
+#   3. 全域與每位乘客 (id_number) 的 token bucket：拒絕，Retry-After 為補滿一個 token 所需的秒數
+# 回傳值都是 dict ({"status": ...})，多 worker 時可直接經由 broker 呼叫 (見 coordinator.py)。
+# Idempotency key 只保存在記憶體，程序重啟後不再辨識重啟前的 key。
+
+import math
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Optional
+
+from jsonlog import get_logger
+
+log = get_logger("admission")
+
+# 佇列已滿但還沒有消化速度可參考時 (例如剛啟動) 的 Retry-After
+QUEUE_FULL_DEFAULT_RETRY_S = 30
+RETRY_AFTER_MAX_S = 600
+# 建立中的 idempotency key 若一直沒有 commit (例如 worker 中途失敗)，此秒數後視為失效
+IDEMPOTENCY_PENDING_TTL_S = 30
+
+
+class TokenBucket:
+    """每秒補充 rate 個 token，最多累積 burst 個；每次提交消耗一個。"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_s(self, now: float) -> float:
+        """還要等多少秒才有一個 token (0 表示現在就可以提交)。"""
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class AdmissionController:
+    def __init__(self, max_pending: int, pending_count: Callable[[], int], drain_rate: Callable[[], float],
+                 global_rate: float = 0, global_burst: float = 1,
+                 passenger_rate: float = 0, passenger_burst: float = 1,
+                 idempotency_ttl_s: float = 86400, max_passenger_buckets: int = 100000,
+                 max_idempotency_keys: int = 100000):
+        self.max_pending = max_pending
+        self.pending_count = pending_count
+        self.drain_rate = drain_rate
+        self.passenger_rate = passenger_rate
+        self.passenger_burst = passenger_burst
+        self.idempotency_ttl_s = idempotency_ttl_s
+        self.max_passenger_buckets = max_passenger_buckets
+        self.max_idempotency_keys = max_idempotency_keys
+
+        self._lock = threading.Lock()
+        # rate <= 0 表示不限制
+        self._global = TokenBucket(global_rate, global_burst, time.monotonic()) if global_rate > 0 else None
+        # id_number -> TokenBucket；依最近使用排序，超過上限時淘汰最久未使用者
+        self._passengers: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        # idempotency key -> [task_id (建立中為 None), fingerprint, 失效時間]；依建立順序排列
+        self._keys: "OrderedDict[str, list]" = OrderedDict()
+
+    def admit(self, id_number: str, idempotency_key: Optional[str] = None,
+              fingerprint: Optional[str] = None) -> Dict[str, Any]:
+        """
+        決定是否接受一筆新訂票：
+          {"status": "admitted"}                              接受 (有 key 時已保留，建立後須 commit / release)
+          {"status": "replay", "task_id": n}                   同一 key 已建立過訂票
+          {"status": "in_progress", "retry_after_s": s}        同一 key 的請求仍在處理中
+          {"status": "mismatch"}                               同一 key 用在內容不同的訂票
+          {"status": "rejected", "reason": ..., "retry_after_s": s}  佇列已滿 / 超過速率限制
+        """
+        now = time.monotonic()
+        with self._lock:
+            if idempotency_key:
+                self._expire_keys(now)
+                entry = self._keys.get(idempotency_key)
+                if entry is not None and entry[2] <= now:
+                    # 建立中的 key 逾期未 commit (排在較晚到期的 key 之後，_expire_keys 不一定清得到)
+                    del self._keys[idempotency_key]
+                    entry = None
+                if entry is not None:
+                    if fingerprint is not None and entry[1] != fingerprint:
+                        return {"status": "mismatch"}
+                    if entry[0] is None:
+                        return {"status": "in_progress", "retry_after_s": 1}
+                    return {"status": "replay", "task_id": entry[0]}
+
+            pending = self.pending_count()
+            if pending >= self.max_pending:
+                return self._reject("queue_full", self._queue_retry_after(pending), pending=pending)
+
+            waits = []
+            if self._global is not None:
+                waits.append(("rate_limited", self._global.wait_s(now)))
+            bucket = self._passenger_bucket(id_number, now)
+            if bucket is not None:
+                waits.append(("passenger_rate_limited", bucket.wait_s(now)))
+            reason, wait = max(waits, key=lambda w: w[1], default=(None, 0.0))
+            if wait > 0:
+                return self._reject(reason, wait, id_number=id_number)
+
+            # 兩個 bucket 都有 token 才一起扣，被其中一個拒絕的請求不會白白消耗另一個
+            if self._global is not None:
+                self._global.consume()
+            if bucket is not None:
+                bucket.consume()
+            if idempotency_key:
+                self._keys[idempotency_key] = [None, fingerprint, now + IDEMPOTENCY_PENDING_TTL_S]
+                while len(self._keys) > self.max_idempotency_keys:
+                    self._keys.popitem(last=False)
+        return {"status": "admitted"}
+
+    def commit(self, idempotency_key: Optional[str], task_id: int):
+        """訂票已建立：之後同一 key 的請求回傳此 task_id。"""
+        if not idempotency_key:
+            return
+        with self._lock:
+            entry = self._keys.get(idempotency_key)
+            if entry is not None:
+                entry[0] = task_id
+                entry[2] = time.monotonic() + self.idempotency_ttl_s
+                self._keys.move_to_end(idempotency_key)
+
+    def release(self, idempotency_key: Optional[str]):
+        """訂票建立失敗：釋放保留的 key，讓 client 可以用同一個 key 重試。"""
+        if not idempotency_key:
+            return
+        with self._lock:
+            entry = self._keys.get(idempotency_key)
+            if entry is not None and entry[0] is None:
+                del self._keys[idempotency_key]
+
+    # --- 內部 (呼叫端需持有 self._lock) ---
+    def _passenger_bucket(self, id_number: str, now: float) -> Optional[TokenBucket]:
+        if self.passenger_rate <= 0 or not id_number:
+            return None
+        bucket = self._passengers.get(id_number)
+        if bucket is None:
+            bucket = self._passengers[id_number] = TokenBucket(self.passenger_rate, self.passenger_burst, now)
+            while len(self._passengers) > self.max_passenger_buckets:
+                self._passengers.popitem(last=False)
+        else:
+            self._passengers.move_to_end(id_number)
+        return bucket
+
+    def _expire_keys(self, now: float):
+        # commit 時會移到最後，因此前段 (最舊) 的項目先到期；遇到未到期者即停止
+        while self._keys:
+            key, entry = next(iter(self._keys.items()))
+            if entry[2] > now:
+                break
+            del self._keys[key]
+
+    def _queue_retry_after(self, pending: int) -> float:
+        # 佇列消化到低於上限所需的時間
+        rate = self.drain_rate()
+        if rate <= 0:
+            return QUEUE_FULL_DEFAULT_RETRY_S
+        return (pending - self.max_pending + 1) / rate
+
+    def _reject(self, reason: str, wait_s: float, **fields) -> Dict[str, Any]:
+        retry_after_s = min(RETRY_AFTER_MAX_S, max(1, math.ceil(wait_s)))
+        log.summary("submit_rejected", reason=reason, retry_after_s=retry_after_s, **fields)
+        return {"status": "rejected", "reason": reason, "retry_after_s": retry_after_s}
@@ -9,28 +9,114 @@ import os
 import sys
 import json
 import time
+import queue
+import uuid
+import hashlib
 import threading
+from functools import lru_cache
 from datetime import datetime, timezone, timedelta 
 from typing import Dict, Any, List
 from zoneinfo import ZoneInfo
 from argparse import ArgumentParser
 
 from werkzeug.middleware.proxy_fix import ProxyFix 
-from flask import Flask, request, abort, render_template, jsonify, render_template_string
+from flask import Flask, request, abort, render_template, jsonify, redirect, url_for, Response, stream_with_context
+
+from ticket_store import STORE_BACKENDS, open_store
+from dispatcher import TaskDispatcher, RetryPolicy
+from event_hub import EventHub, format_sse
+from wire import WireFormatError, WIRE_PAYLOAD_BYTES, decode_request, encode_response, client_protocol, compact_poll_payload
+from admission import AdmissionController
+from coordinator import (BrokerClient, BrokerServer, BrokerError, STORE_METHODS, DISPATCHER_METHODS, ADMISSION_METHODS,
+                         METRICS_PUSH_INTERVAL_S)
+from metrics import REGISTRY, STORE_IO_SECONDS, PUSH_TO_PICKUP_SECONDS
+from jsonlog import get_logger, dropped_records
 
 # ... (省略 LINE Bot 相關設定) ...
 
 app = Flask(__name__)
+
+# --- 日誌 (JSON Lines，背景寫入；各子系統等級由 THSR_LOG_LEVEL / THSR_LOG_LEVELS 設定) ---
+http_log = get_logger("http")
+poll_log = get_logger("poll")
+dispatch_log = get_logger("dispatch")
+status_log = get_logger("status")
+# 每次 poll 都會發生的事件只輸出彙總 (每 POLL_LOG_SUMMARY_S 秒一筆)
+POLL_LOG_SUMMARY_S = 30
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1) 
 
+# --- 指標 (/metrics, Prometheus text format) ---
+REQUEST_LATENCY = REGISTRY.histogram(
+    "thsr_http_request_duration_seconds", "HTTP request latency by route (streaming routes: until headers are sent).",
+    ("route", "method", "status"))
+POLL_WAIT = REGISTRY.histogram(
+    "thsr_poll_wait_seconds", "Time a worker long poll was held before returning.", ("outcome",))
+BOOKING_DURATION = REGISTRY.histogram(
+    "thsr_booking_duration_seconds", "Booking duration reported by workers.", ("status",))
+REGISTRY.gauge("thsr_queue_depth", "Tasks waiting in the dispatcher queue (including delayed retries).",
+               lambda: dispatcher.backlog_size())
+REGISTRY.gauge("thsr_jobs_in_flight", "Jobs leased to workers and not yet reported.",
+               lambda: dispatcher.in_flight())
+REGISTRY.gauge("thsr_waiting_workers", "Workers currently parked in a long poll.",
+               lambda: dispatcher.waiting_workers())
+REGISTRY.gauge("thsr_unavailable_trains", "Train / date / route keys currently marked sold out.",
+               lambda: dispatcher.unavailable_count())
+REGISTRY.gauge("thsr_sse_subscribers", "Open pending-table SSE streams.",
+               lambda: pending_events.subscriber_count())
+REGISTRY.gauge("thsr_log_records_dropped", "Log records dropped or sampled out because the log queue was full.",
+               dropped_records)
+
+@app.before_request
+def start_request_timer():
+    request.environ["thsr.start_time"] = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    start = request.environ.get("thsr.start_time")
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        REQUEST_LATENCY.observe(time.perf_counter() - start, route=route, method=request.method,
+                                status=response.status_code)
+    return response
+
 # --- 核心配置與全局狀態 (保持不變) ---
 MAX_NETWORK_LATENCY = 5
 BASE_CLIENT_TIMEOUT = 600 + MAX_NETWORK_LATENCY
 CST_TIMEZONE = ZoneInfo('Asia/Taipei') 
 
-data_lock = threading.Lock() 
-current_waiting_event: threading.Event | None = None 
-current_response_data: Dict[str, Any] | None = None 
+# 每次 poll 從 backlog 最多認領的任務數 (client 未指定 max_tasks 時)
+DISPATCH_BATCH_SIZE = 5
+# 派出的任務在此秒數內未回報最終結果，lease 逾期並回到佇列重新派送
+LEASE_TIMEOUT_S = 300
+# 排程優先順序 = 乘車時間 - SCHEDULE_AGE_WEIGHT * 已等待時間 (越小越先派出)
+SCHEDULE_AGE_WEIGHT = float(os.environ.get("SCHEDULE_AGE_WEIGHT", "1.0"))
+# 同車次 / 日期 / 起訖站的待處理訂票最多合併幾位乘客成一筆訂票 (1 = 不合併)；
+# 只有在 poll 時宣告 max_group_size 的 worker 才會收到合併的 job
+MAX_BOOKING_GROUP_SIZE = int(os.environ.get("MAX_BOOKING_GROUP_SIZE", "4"))
+
+# 訂票失敗 (failed) 的重試策略：最多 MAX_BOOKING_ATTEMPTS 次，等待 RETRY_BACKOFF_S * 2^(n-1) 秒
+# (上限 RETRY_BACKOFF_MAX_S) 後重新排入佇列；超過次數或來不及在乘車前重試才移入歷史記錄
+MAX_BOOKING_ATTEMPTS = int(os.environ.get("MAX_BOOKING_ATTEMPTS", "3"))
+RETRY_BACKOFF_S = float(os.environ.get("RETRY_BACKOFF_S", "60"))
+RETRY_BACKOFF_MAX_S = float(os.environ.get("RETRY_BACKOFF_MAX_S", "1800"))
+RETRY_PENDING_STATUS = "重試待處理"
+# worker 回報車次已售完 (details.reason == "sold_out") 後，同車次 / 日期 / 起訖站的任務暫緩派送的秒數 (0 = 不暫緩)
+SOLD_OUT_REASON = "sold_out"
+SOLD_OUT_TTL_S = float(os.environ.get("SOLD_OUT_TTL_S", "60"))
+FINAL_STATUSES = ("booked", "failed")
+
+retry_policy = RetryPolicy(MAX_BOOKING_ATTEMPTS, RETRY_BACKOFF_S, RETRY_BACKOFF_MAX_S)
+
+# 訂票提交的流量控制 (admission.py)：待處理訂票 (佇列 + 處理中) 達 MAX_PENDING_TICKETS 筆時拒絕新訂票；
+# 全域每秒最多 SUBMIT_RATE_PER_S 筆 (可瞬間累積 SUBMIT_BURST 筆)，同一 id_number 每秒最多
+# PASSENGER_SUBMIT_RATE_PER_S 筆 (累積 PASSENGER_SUBMIT_BURST 筆)；速率設為 0 表示不限制。
+# 被拒絕的請求回應 429 + Retry-After。帶 Idempotency-Key 標頭的重送在 IDEMPOTENCY_TTL_S 秒內回傳原本的 task_id
+MAX_PENDING_TICKETS = int(os.environ.get("MAX_PENDING_TICKETS", "5000"))
+SUBMIT_RATE_PER_S = float(os.environ.get("SUBMIT_RATE_PER_S", "50"))
+SUBMIT_BURST = float(os.environ.get("SUBMIT_BURST", "100"))
+PASSENGER_SUBMIT_RATE_PER_S = float(os.environ.get("PASSENGER_SUBMIT_RATE_PER_S", "0.2"))
+PASSENGER_SUBMIT_BURST = float(os.environ.get("PASSENGER_SUBMIT_BURST", "3"))
+IDEMPOTENCY_TTL_S = 24 * 3600
 
 TICKET_DIR = "./"
 TICKET_REQUEST_FILE = os.path.join(TICKET_DIR, "ticket_requests.json")
@@ -39,36 +125,169 @@ TICKET_HISTORY_FILE = os.path.join(TICKET_DIR, "ticket_history.json")
 PASSENGER_DIR = "./json"
 PASSENGER_FILE = os.path.join(PASSENGER_DIR, "passenger_data.json")
 
-# --- 數據庫操作函式 (保持不變) ---
-def load_json(filename):
-    if not os.path.exists(filename):
-        return []
-    try:
-        with open(filename, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        return []
+# 所有異動先寫入 journal，累積 JOURNAL_COMPACT_THRESHOLD 筆後於背景壓縮回上述 JSON 快照檔
+TICKET_JOURNAL_FILE = os.path.join(TICKET_DIR, "ticket_journal.log")
+JOURNAL_COMPACT_THRESHOLD = 1000
+# journal 寫入的 group commit：同一時間窗 (秒) 內的寫入共用一次 fsync，請求在資料落地後才回應；
+# 設為 "off" 則只寫到 OS 快取 (不 fsync)
+JOURNAL_FSYNC_WINDOW_S = os.environ.get("JOURNAL_FSYNC_WINDOW_S", "0.002")
+
+# sqlite 後端的資料庫檔；第一次啟用時自動匯入上述 JSON 檔
+TICKET_DB_FILE = os.path.join(TICKET_DIR, "tickets.db")
+
+# 儲存後端: "journal" (預設) 或 "sqlite"，可由環境變數或 --storage 參數指定
+STORE_BACKEND = os.environ.get("TICKET_STORE_BACKEND", "journal")
+
+# --- 數據庫操作函式 ---
+def create_store(backend: str):
+    return open_store(
+        backend, TICKET_REQUEST_FILE, TICKET_HISTORY_FILE, PASSENGER_FILE,
+        TICKET_JOURNAL_FILE, TICKET_DB_FILE, compact_threshold=JOURNAL_COMPACT_THRESHOLD,
+        fsync_window_s=None if JOURNAL_FSYNC_WINDOW_S == "off" else float(JOURNAL_FSYNC_WINDOW_S),
+    )
+
+# --- 任務派送 (多 worker long polling) ---
+def create_dispatcher(ticket_store) -> TaskDispatcher:
+    task_dispatcher = TaskDispatcher(batch_size=DISPATCH_BATCH_SIZE, lease_timeout_s=LEASE_TIMEOUT_S,
+                                     age_weight=SCHEDULE_AGE_WEIGHT, max_group_size=MAX_BOOKING_GROUP_SIZE)
+    # 啟動時把尚未完成的任務放回佇列
+    task_dispatcher.seed(ticket_store.list_pending())
+    return task_dispatcher
+
+def create_admission(task_dispatcher) -> AdmissionController:
+    return AdmissionController(
+        MAX_PENDING_TICKETS, task_dispatcher.pending_count, task_dispatcher.drain_rate,
+        global_rate=SUBMIT_RATE_PER_S, global_burst=SUBMIT_BURST,
+        passenger_rate=PASSENGER_SUBMIT_RATE_PER_S, passenger_burst=PASSENGER_SUBMIT_BURST,
+        idempotency_ttl_s=IDEMPOTENCY_TTL_S,
+    )
+
+# --- 命令列參數 ---
+# 直接執行 (python app.py) 時在建立 store 之前解析參數，由 --storage 決定後端，整個程序只開啟一個 store
+def build_arg_parser() -> ArgumentParser:
+    arg_parser = ArgumentParser(
+        usage='Usage: python ' + __file__ + ' [--port <port>] [--storage journal|sqlite] [--broker <socket>] [--help]'
+    )
+    arg_parser.add_argument('-p', '--port', default=10000, help='port')
+    arg_parser.add_argument('-d', '--debug', default=True, help='debug')
+    arg_parser.add_argument('-s', '--storage', default=STORE_BACKEND, choices=STORE_BACKENDS,
+                            help='storage backend (default: $TICKET_STORE_BACKEND or journal)')
+    arg_parser.add_argument('--broker', metavar='SOCKET',
+                            help='run as the coordination broker for gunicorn workers (started by gunicorn.conf.py)')
+    return arg_parser
 
-def save_json(filename, data):
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+options = None
+if __name__ == "__main__":
+    arg_parser = build_arg_parser()
+    options = arg_parser.parse_args()
+    if os.environ.get("THSR_BROKER_SOCKET"):
+        arg_parser.error('THSR_BROKER_SOCKET is set: this process would only be a broker client')
+    STORE_BACKEND = options.storage
+
+# --- 跨程序協調 (gunicorn 多 worker) ---
+# 設定 THSR_BROKER_SOCKET 時 store / dispatcher 由 broker 程序持有 (由 gunicorn.conf.py 啟動，見 coordinator.py)，
+# 本程序只透過 Unix domain socket 呼叫，異動在 broker 內序列化，push 也能叫醒其他 worker 上的 poll；
+# 未設定時在本程序內建立 (單一 worker)
+BROKER_SOCKET = os.environ.get("THSR_BROKER_SOCKET")
+if BROKER_SOCKET:
+    broker = BrokerClient(BROKER_SOCKET)
+    store = broker.proxy("store", STORE_METHODS)
+    dispatcher = broker.proxy("dispatcher", DISPATCHER_METHODS)
+    admission = broker.proxy("admission", ADMISSION_METHODS)
+else:
+    broker = None
+    store = create_store(STORE_BACKEND)
+    dispatcher = create_dispatcher(store)
+    admission = create_admission(dispatcher)
 
 def get_new_id():
-    requests = load_json(TICKET_REQUEST_FILE)
-    history = load_json(TICKET_HISTORY_FILE)
-    max_id = 0
-    if requests:
-        max_id = max(max_id, max(r.get("id", 0) for r in requests))
-    if history:
-        max_id = max(max_id, max(h.get("id", 0) for h in history))
-    return max_id + 1
-
-def get_new_passenger_id():
-    passengers = load_json(PASSENGER_FILE)
-    if not passengers:
-        return 1
-    return max(p["id"] for p in passengers) + 1
+    return store.next_ticket_id()
+
+
+# --- 待處理表格即時推播 (SSE) ---
+# SSE 連線閒置時每隔此秒數送出 keepalive 註解，避免被 proxy 斷線
+SSE_KEEPALIVE_S = 15
+
+pending_events = EventHub()
+
+# /update_status_batch 單次最多接受的結果筆數
+MAX_STATUS_BATCH = 500
+
+# --- 歷史記錄分頁 ---
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 200
+HISTORY_FILTERS = ("date_from", "date_to", "train_no", "status", "passenger")
+
+# --- 待處理表格快取 ---
+# 每次訂票異動遞增版本號；/api/pending_table 以版本號快取已渲染的 HTML 並作為 ETag。
+# EPOCH 區分不同的程序啟動，避免重啟後版本號重複造成錯誤的 304。
+# 多 worker 時版本號與 EPOCH 由 broker 配發，各 worker 回應的 ETag 才一致。
+PENDING_TABLE_EPOCH = uuid.uuid4().hex[:8]
+pending_table_lock = threading.Lock()
+pending_table_version = 0
+pending_table_cache: tuple[int, str] | None = None
+
+def current_pending_version() -> int:
+    return broker.call("events.version") if broker else pending_table_version
+
+def pending_table_etag(version: int) -> str:
+    epoch = broker.epoch if broker else PENDING_TABLE_EPOCH
+    return f"pending-{epoch}-{version}"
+
+def render_pending_rows() -> tuple[int, str]:
+    """回傳 (版本號, 表格 HTML)；版本未變時直接使用快取，不讀取資料也不渲染模板。"""
+    global pending_table_cache
+    # 先讀版本再讀資料：渲染期間若有異動，快取內容只會比版本新，下次請求會重新渲染
+    version = current_pending_version()
+    cache = pending_table_cache
+    if cache and cache[0] == version:
+        return cache
+    formatted_requests = [format_ticket_data(r) for r in store.list_pending()]
+    html = render_template("pending_rows.html", formatted_requests=formatted_requests)
+    with pending_table_lock:
+        pending_table_cache = (version, html)
+    return version, html
+
+def notify_pending_change(ticket: Dict[str, Any], removed: bool = False):
+    """訂票新增 / 狀態變更時，更新表格版本號，並推播單一列的增量更新給所有開啟中的首頁。"""
+    global pending_table_version
+    if broker is not None:
+        # 由 broker 配發版本號並轉送給所有 worker (包含本程序)，各自推播給自己的 SSE 訂閱者
+        row = {"id": ticket["id"]} if removed else format_ticket_data(ticket)
+        broker.call("events.publish", "remove" if removed else "upsert", row)
+        return
+    with pending_table_lock:
+        pending_table_version += 1
+    if not pending_events.has_subscribers():
+        return
+    if removed:
+        publish_pending_row("remove", {"id": ticket["id"]})
+    else:
+        publish_pending_row("upsert", format_ticket_data(ticket))
+
+def publish_pending_row(kind: str, row: Dict[str, Any]):
+    if kind == "remove":
+        pending_events.publish("remove", {"id": row["id"]})
+    else:
+        html = render_template("pending_row.html", r=row)
+        pending_events.publish("upsert", {"id": row["id"], "html": html})
+
+def handle_broker_event(message: Dict[str, Any]):
+    """broker 轉送的待處理表格異動 (可能來自其他 worker)。"""
+    if message.get("event") != "pending" or not pending_events.has_subscribers():
+        return
+    with app.app_context():
+        publish_pending_row(message["kind"], message["row"])
+
+def handle_broker_reconnect():
+    # broker 可能已重啟 (版本號重新起算)，斷線期間的異動也可能遺漏：丟棄快取並要求 SSE 重送快照
+    global pending_table_cache
+    with pending_table_lock:
+        pending_table_cache = None
+    pending_events.resync()
+
+if broker is not None:
+    broker.on_event(handle_broker_event, on_reconnect=handle_broker_reconnect)
 
 # --- 時間同步函式 (保持不變) ---
 def calculate_server_timeout(client_timeout_s: int, client_timestamp_str: str) -> int:
@@ -81,38 +300,68 @@ def calculate_server_timeout(client_timeout_s: int, client_timestamp_str: str) -
         time_to_wait = (t2_end_time - current_server_time).total_seconds()
         return max(0, int(time_to_wait))
     except Exception as e:
-        print(f"[{time.strftime('%H:%M:%S')}] ⚠️ TIME CALC ERROR: {e}. Falling back to default T2={max(0, client_timeout_s - MAX_NETWORK_LATENCY)}s.")
+        poll_log.warning("time_calc_error", error=str(e), fallback_t2_s=max(0, client_timeout_s - MAX_NETWORK_LATENCY))
         return max(0, client_timeout_s - MAX_NETWORK_LATENCY)
 
 def push_task_to_client(task_data: Dict[str, Any]):
-    global current_waiting_event, current_response_data
-    with data_lock:
-        notifications_sent = 0
-        if current_waiting_event:
-            current_response_data = {"status": "success", "data": task_data.copy()}
-            current_waiting_event.set() 
-            notifications_sent = 1
-    print(f"[{time.strftime('%H:%M:%S')}] ✅ PUSHED: New booking task (ID: {task_data.get('id')}). Waking up {notifications_sent} client.")
+    worker_id = dispatcher.submit(task_data)
+    if worker_id:
+        dispatch_log.info("task_pushed", task_id=task_data.get('id'), worker_id=worker_id)
+    else:
+        # 沒有閒置 worker，留在 backlog
+        dispatch_log.info("task_queued", task_id=task_data.get('id'))
+
+# --- 訂票提交的流量控制 ---
+SUBMIT_FIELDS = ("name", "id_number", "train_no", "travel_date", "from_station", "from_time", "to_station", "to_time")
+
+def submit_fingerprint(data: Dict[str, Any]) -> str:
+    """同一 Idempotency-Key 必須對應相同的訂票內容。"""
+    return hashlib.sha256(json.dumps([data.get(f) for f in SUBMIT_FIELDS], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def admission_rejection(decision: Dict[str, Any]) -> tuple[Dict[str, Any], int, Dict[str, str]]:
+    """admit() 未接受 (replay 以外) 時的 (內容, HTTP 狀態碼, 標頭)。"""
+    status = decision["status"]
+    if status == "mismatch":
+        return {"status": "error", "message": "Idempotency-Key was already used for a different booking."}, 422, {}
+    headers = {"Retry-After": str(decision["retry_after_s"])}
+    if status == "in_progress":
+        return {"status": "in_progress", "message": "A request with this Idempotency-Key is still being processed.",
+                "retry_after_s": decision["retry_after_s"]}, 409, headers
+    messages = {
+        "queue_full": "Too many pending bookings. Please retry later.",
+        "rate_limited": "Too many bookings are being submitted. Please retry later.",
+        "passenger_rate_limited": "Too many bookings for this passenger. Please retry later.",
+    }
+    return {"status": "rejected", "reason": decision["reason"], "message": messages.get(decision["reason"], "Rejected."),
+            "retry_after_s": decision["retry_after_s"]}, 429, headers
 
 # --- 新增：數據格式化函式 ---
-def format_ticket_data(ticket: Dict[str, Any]) -> Dict[str, Any]:
-    """將單筆訂票數據格式化為前端表格所需的精簡格式"""
-    
+# 日期字串格式化結果快取，避免每次渲染都對每一列重跑 strptime / strftime
+@lru_cache(maxsize=4096)
+def format_order_date(order_date: str) -> str:
     # 訂票日期 (Order Date): 格式 'hh:mm'
     try:
         # 假設 order_date 格式為 "YYYY-MM-DD HH:MM:SS"
-        order_dt = datetime.strptime(ticket.get("order_date"), "%Y-%m-%d %H:%M:%S")
-        formatted_order_date = order_dt.strftime("%H:%M")
+        order_dt = datetime.strptime(order_date, "%Y-%m-%d %H:%M:%S")
+        return order_dt.strftime("%H:%M")
     except Exception:
-        formatted_order_date = "N/A"
-        
+        return "N/A"
+
+@lru_cache(maxsize=4096)
+def format_travel_date(travel_date: str) -> str:
     # 乘車日期 (Travel Date): 格式 'MM/DD'
     try:
         # 假設 travel_date 格式為 "YYYY-MM-DD"
-        travel_dt = datetime.strptime(ticket.get("travel_date"), "%Y-%m-%d")
-        formatted_travel_date = travel_dt.strftime("%m/%d")
+        travel_dt = datetime.strptime(travel_date, "%Y-%m-%d")
+        return travel_dt.strftime("%m/%d")
     except Exception:
-        formatted_travel_date = "N/A"
+        return "N/A"
+
+def format_ticket_data(ticket: Dict[str, Any]) -> Dict[str, Any]:
+    """將單筆訂票數據格式化為前端表格所需的精簡格式"""
+    
+    formatted_order_date = format_order_date(ticket.get("order_date"))
+    formatted_travel_date = format_travel_date(ticket.get("travel_date"))
 
     # 組合時間地點資訊
     from_info = f"{ticket.get('from_station', 'N/A')} {ticket.get('from_time', 'N/A')}"
@@ -144,6 +393,10 @@ def format_ticket_data(ticket: Dict[str, Any]) -> Dict[str, Any]:
 def index():
     if request.method == "POST":
         data = request.form
+        decision = admission.admit(data.get("id_number"))
+        if decision["status"] != "admitted":
+            payload, http_status, headers = admission_rejection(decision)
+            return Response(payload["message"], status=http_status, headers=headers, mimetype="text/plain")
         # ...原本的訂票資料處理...
         ticket = {
             "id": get_new_id(),
@@ -158,16 +411,16 @@ def index():
             "to_station": data.get("to_station"),
             "to_time": data.get("to_time"),
         }
-        requests = load_json(TICKET_REQUEST_FILE)
-        requests.append(ticket)
-        save_json(TICKET_REQUEST_FILE, requests)
+        store.add_ticket(ticket)
+        notify_pending_change(ticket)
         # 新增：檢查是否需要新增乘客資料
         add_passenger_if_new(ticket["name"], ticket["id_number"])
+        # 與 /api/submit_ticket 相同：放進派送佇列，worker 才會收到
+        push_task_to_client(ticket)
         return redirect(url_for("index"))
-    requests = load_json(TICKET_REQUEST_FILE)
-    # 雖然 index.html 的表格內容由 AJAX 獲取，但這裡仍需傳遞數據以供初始渲染
-    formatted_requests = [format_ticket_data(r) for r in requests]
-    return render_template("index.html", requests=formatted_requests)
+    # 雖然 index.html 的表格內容由 SSE / AJAX 更新，但這裡仍需傳遞初始渲染內容 (與 /api/pending_table 共用快取)
+    _, pending_rows_html = render_pending_rows()
+    return render_template("index.html", pending_rows_html=pending_rows_html)
 
 # 2. JSON API 訂票提交路由 (保持不變)
 @app.route("/api/submit_ticket", methods=["POST"])
@@ -178,34 +431,50 @@ def api_submit_ticket():
         if not data:
             return jsonify({"status": "error", "message": "Missing JSON data in request body."}), 400
 
-        required_fields = ["name", "id_number", "train_no", "travel_date", "from_station", "from_time", "to_station", "to_time"]
-        for field in required_fields:
+        for field in SUBMIT_FIELDS:
             if not data.get(field):
                  return jsonify({"status": "error", "message": f"Missing required field: {field}"}), 400
-                 
-        ticket = {
-            "id": get_new_id(),
-            "status": "待處理",
-            "order_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "name": data["name"],
-            "id_number": data["id_number"],
-            "train_no": data["train_no"],
-            "travel_date": data["travel_date"],
-            "from_station": data["from_station"],
-            "from_time": data["from_time"],
-            "to_station": data["to_station"],
-            "to_time": data["to_time"],
-            "code": None
-        }
-        
-        requests = load_json(TICKET_REQUEST_FILE)
-        requests.append(ticket)
-        save_json(TICKET_REQUEST_FILE, requests)
+
+        # 流量控制：佇列已滿或超過速率限制時回應 429；同一 Idempotency-Key 的重送回傳原本的 task_id
+        idempotency_key = request.headers.get("Idempotency-Key") or None
+        decision = admission.admit(data["id_number"], idempotency_key, submit_fingerprint(data))
+        if decision["status"] == "replay":
+            return jsonify({
+                "status": "success",
+                "message": "Booking task already submitted.",
+                "task_id": decision["task_id"]
+            }), 201, {"Idempotent-Replayed": "true"}
+        if decision["status"] != "admitted":
+            payload, http_status, headers = admission_rejection(decision)
+            return jsonify(payload), http_status, headers
+
+        try:
+            ticket = {
+                "id": get_new_id(),
+                "status": "待處理",
+                "order_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "name": data["name"],
+                "id_number": data["id_number"],
+                "train_no": data["train_no"],
+                "travel_date": data["travel_date"],
+                "from_station": data["from_station"],
+                "from_time": data["from_time"],
+                "to_station": data["to_station"],
+                "to_time": data["to_time"],
+                "code": None
+            }
+            store.add_ticket(ticket)
+        except Exception:
+            # 訂票沒有建立：釋放 key，client 可以用同一個 key 重試
+            admission.release(idempotency_key)
+            raise
+        admission.commit(idempotency_key, ticket["id"])
+        notify_pending_change(ticket)
         # 新增：自動新增乘客資料
         add_passenger_if_new(ticket["name"], ticket["id_number"])
         push_task_to_client(ticket)
         
-        print(f"[{time.strftime('%H:%M:%S')}] 📝 JSON SUBMIT: New task ID {ticket['id']} created.")
+        http_log.info("ticket_submitted", task_id=ticket['id'])
         return jsonify({
             "status": "success", 
             "message": "Booking task submitted successfully.",
@@ -213,191 +482,329 @@ def api_submit_ticket():
         }), 201 
 
     except Exception as e:
-        print(f"[{time.strftime('%H:%M:%S')}] ❌ JSON SUBMIT UNKNOWN ERROR: {e}")
+        http_log.error("ticket_submit_error", error=str(e))
         return jsonify({"status": "internal_error", "message": str(e)}), 500
 
 
-# 3. 歷史記錄頁面 (已修改：應用格式化)
+# 3. 歷史記錄頁面 (表格內容由 /api/history 分頁載入)
 @app.route("/history.html")
 def history():
-    history_data = load_json(TICKET_HISTORY_FILE)
-    
-    # 應用格式化函式，將格式化後的數據傳遞給 history.html
-    formatted_history = [format_ticket_data(h) for h in history_data]
-    
-    return render_template("history.html", history=formatted_history)
+    return render_template("history.html")
 
-# 4. AJAX 短輪詢路由 (已修改：使用格式化數據和新模板)
+# 3-1. 歷史記錄 API：id cursor 分頁 + 篩選，以 JSON Lines 串流輸出
+#   GET /api/history?cursor=<id>&limit=50&date_from=&date_to=&train_no=&status=&passenger=
+#   每行一筆格式化後的記錄，最後一行為 {"next_cursor": <id 或 null>}
+@app.route("/api/history", methods=["GET"])
+def api_history():
+    try:
+        cursor = request.args.get("cursor", type=int)
+        limit = min(max(1, request.args.get("limit", HISTORY_PAGE_SIZE, type=int)), HISTORY_PAGE_MAX)
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "Invalid cursor or limit."}), 400
+    filters = {key: request.args.get(key, "").strip() for key in HISTORY_FILTERS}
+
+    def generate():
+        count = 0
+        last_id = None
+        for ticket in store.iter_history(before_id=cursor, filters=filters):
+            if count == limit:
+                # 還有下一頁：以本頁最後一筆的 id 作為 cursor
+                yield json.dumps({"next_cursor": last_id}) + "\n"
+                return
+            yield json.dumps(format_ticket_data(ticket), ensure_ascii=False) + "\n"
+            count += 1
+            last_id = ticket["id"]
+        yield json.dumps({"next_cursor": None}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+# 4. AJAX 短輪詢路由 (以版本號快取渲染結果，支援 ETag / If-None-Match)
 @app.route("/api/pending_table", methods=["GET"])
 def api_pending_table():
-    requests = load_json(TICKET_REQUEST_FILE)
-    
-    # 應用格式化函式
-    formatted_requests = [format_ticket_data(r) for r in requests]
-    
-    # 新的模板字串，配合 index.html 的新表頭
-    template_str = """
-    {% for r in formatted_requests %}
-    <tr>
-        <td>{{ r.id }}</td>
-        <td>{{ r.status }}</td>
-        <td>{{ r.formatted_order_date }}</td>
-        <td>{{ r.name }}</td>
-        <td>{{ r.train_no }}</td>
-        <td>{{ r.formatted_travel_date }}</td>
-        <td>{{ r.from_info }}</td>
-        <td>{{ r.to_info }}</td>
-    </tr>
-    {% else %}
-    <tr>
-        <td colspan="8">目前沒有待處理的訂票任務。</td>
-    </tr>
-    {% endfor %}
-    """
-    
-    rendered_html = render_template_string(template_str, formatted_requests=formatted_requests)
-    return rendered_html, 200
+    etag = pending_table_etag(current_pending_version())
+    if request.if_none_match.contains(etag):
+        # 表格未變動：不讀取資料、不渲染模板
+        return Response(status=304, headers={"ETag": f'"{etag}"', "Cache-Control": "no-cache"})
+
+    version, rendered_html = render_pending_rows()
+    response = Response(rendered_html, status=200, mimetype="text/html")
+    response.set_etag(pending_table_etag(version))
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+# 4-1. 待處理表格 SSE 串流 (只在訂票新增 / 狀態變更時推送單列增量)
+@app.route("/api/pending_stream", methods=["GET"])
+def api_pending_stream():
+    def render_snapshot():
+        return render_pending_rows()[1]
+
+    def generate(q):
+        try:
+            # 先訂閱再送快照，中間發生的異動不會遺漏
+            yield format_sse("reset", {"html": render_snapshot()})
+            while True:
+                try:
+                    message = q.get(timeout=SSE_KEEPALIVE_S)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    # 推送速度跟不上，已被移出訂閱：重新訂閱並送出完整快照
+                    q = pending_events.subscribe()
+                    yield format_sse("reset", {"html": render_snapshot()})
+                    continue
+                yield message
+        finally:
+            pending_events.unsubscribe(q)
+
+    return Response(
+        stream_with_context(generate(pending_events.subscribe())),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-# 5. Long Polling 端點 (保持不變)
+# 5. Long Polling 端點 (多 worker：每個 worker 以 worker_id 識別)
 @app.route('/poll_for_update', methods=['POST'])
 def long_poll_endpoint():
-    # ...existing code...
-    global current_waiting_event, current_response_data
     client_timeout = BASE_CLIENT_TIMEOUT
     client_timestamp = ""
+    worker_id = None
+    max_tasks = None
+    max_group_size = 1
     try:
-        data = request.get_json()
+        # 請求可為 JSON 或 MessagePack，可壓縮 (見 wire.py)
+        data = decode_request(request)
         client_timeout = data.get('client_timeout_s', BASE_CLIENT_TIMEOUT)
         client_timestamp = data.get('timestamp', "")
+        worker_id = data.get('worker_id')
+        max_tasks = data.get('max_tasks')
+        max_group_size = int(data.get('max_group_size') or 1)
+    except WireFormatError as e:
+        return encode_response(request, {"status": "error", "message": str(e)}, e.http_status)
     except Exception:
         pass
+    # 每次 poll 最多認領 DISPATCH_BATCH_SIZE 個 job，單一 worker 不能一次取走整個佇列
+    if max_tasks is not None:
+        try:
+            max_tasks = min(max(1, int(max_tasks)), DISPATCH_BATCH_SIZE)
+        except (TypeError, ValueError):
+            return encode_response(request, {"status": "error", "message": f"Invalid max_tasks: {max_tasks!r}"}, 400)
+    # 舊版 client 沒有 worker_id，以來源 IP 識別
+    worker_id = worker_id or request.remote_addr
 
     max_wait_time_server = calculate_server_timeout(client_timeout, client_timestamp)
-    print(f"[{time.strftime('%H:%M:%S')}] 🔥 RECEIVED: /poll_for_update. T2={max_wait_time_server}s, Client timeout={client_timeout}, Client timestamp={client_timestamp}")
+    poll_log.summary("poll_received", POLL_LOG_SUMMARY_S, worker_id=worker_id, t2_s=max_wait_time_server,
+                     client_timeout_s=client_timeout, client_timestamp=client_timestamp)
+
+    poll_started = time.perf_counter()
+    response_payload = dispatcher.poll(worker_id, max_wait_time_server, max_tasks=max_tasks,
+                                       max_group_size=max_group_size)
+    POLL_WAIT.observe(time.perf_counter() - poll_started, outcome=response_payload["status"])
+    status = response_payload["status"]
+    if status == "initial_sync":
+        poll_log.info("pending_tasks_returned", worker_id=worker_id, count=len(response_payload['data']))
+    elif status == "timeout":
+        poll_log.summary("poll_timeout", POLL_LOG_SUMMARY_S, worker_id=worker_id)
+    if client_protocol(request) >= 2:
+        # 協定版本 2 的 client 只需要訂票用的欄位
+        response_payload = compact_poll_payload(response_payload)
+    return encode_response(request, response_payload)
+
+
+# 6. 任務結果回傳端點
+def apply_status_updates(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """套用多筆任務結果 ({task_id, status, details})，所有異動以一次寫入完成；回傳每筆的處理結果。"""
+    results: List[Dict[str, Any] | None] = [None] * len(items)
+    updates = []
+    claimed = []  # 已標記為結束中的 job (寫入失敗時取消)
+    for index, item in enumerate(items):
+        task_id = item.get('task_id') if isinstance(item, dict) else None
+        status = item.get('status') if isinstance(item, dict) else None
+        details = (item.get('details') if isinstance(item, dict) else None) or {}
+        if not task_id or not status:
+            results[index] = {"task_id": task_id, "status": "error", "message": "Missing task_id or status"}
+            continue
+        try:
+            task_id = int(task_id)
+        except (TypeError, ValueError):
+            results[index] = {"task_id": task_id, "status": "error", "message": f"Invalid task_id: {task_id}"}
+            continue
+
+        # 只套用目前持有 lease 的回報 (lease_id 相符)：client 重送的重複結果、lease 逾時後才到的結果
+        # 都忽略，不會重複計算失敗次數，也不會結束已改派給其他 worker 的 lease。
+        # 合併的 job 以主訂票 id 回報，結果套用到 job 內的每一筆訂票
+        members = dispatcher.claim_result(task_id, item.get('lease_id'), final=status in FINAL_STATUSES)
+        if members is None:
+            results[index] = {"task_id": task_id, "status": "stale",
+                              "message": f"Task {task_id} is not leased to this report (duplicate or expired); ignored."}
+            status_log.summary("stale_result", task_id=task_id, status=status)
+            continue
+        if status in FINAL_STATUSES:
+            claimed.append(task_id)
+
+        # worker 回報的訂票耗時 (秒)，合併的 job 只計一次
+        if isinstance(details.get("duration_s"), (int, float)):
+            BOOKING_DURATION.observe(details["duration_s"], status=status)
+
+        for member_id in members:
+            fields = {
+                "status": status,
+                "result_details": details,
+                "completion_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            if details.get("code"):
+                fields["code"] = details["code"]
+            # 完成 (booked / failed) 的任務直接移入歷史記錄並結束 lease；其他狀態視為處理中，延長 lease
+            is_final = status in FINAL_STATUSES
+            retry_delay = None
+            if status == "failed":
+                # 依重試策略決定是否延遲後重新排入佇列，而不是直接移入歷史記錄
+                current = store.get_ticket(member_id)
+                if current and current.get("status") not in FINAL_STATUSES:
+                    attempts = current.get("attempts", 0) + 1
+                    fields["attempts"] = attempts
+                    retry_delay = retry_policy.next_delay(current, attempts)
+                    if retry_delay is not None:
+                        fields["status"] = RETRY_PENDING_STATUS
+                        is_final = False
+            updates.append((index, member_id, status, fields, is_final, retry_delay))
+        if len(members) > 1:
+            status_log.info("group_result", job_id=task_id, status=status, task_ids=members)
 
-    requests = load_json(TICKET_REQUEST_FILE)
-    if requests:
-        print(f"[{time.strftime('%H:%M:%S')}] 🚨 WAITING TASKS FOUND: Returning {len(requests)} pending tasks immediately.")
-        return jsonify({
-            "status": "initial_sync",
-            "message": "Found pending tasks in queue.",
-            "data": requests.copy() 
-        }), 200
-
-    new_client_event = threading.Event()
-    response_payload = None
-    with data_lock:
-        if current_waiting_event:
-            current_response_data = {"status": "forced_reconnect", "message": "New poll initiated. Please re-poll immediately."}
-            current_waiting_event.set()
-        
-        current_waiting_event = new_client_event
-        current_response_data = None
-    
-    is_triggered = new_client_event.wait(timeout=max_wait_time_server)
-    
-    with data_lock:
-        response_payload = current_response_data
-        if new_client_event == current_waiting_event:
-            current_waiting_event = None
-            current_response_data = None
-            
-    if response_payload:
-        return jsonify(response_payload), 200
-    
-    if not is_triggered:
-        print(f"[{time.strftime('%H:%M:%S')}] Timeout reached. Sending 'No Update' response.")
-        return jsonify({"status": "timeout", "message": "No new events."}), 200
-        
-    return jsonify({"status": "internal_error", "message": "Unknown trigger state."}), 500
+    try:
+        tickets = store.update_tickets([(task_id, fields, is_final) for _, task_id, _, fields, is_final, _ in updates])
+    except Exception:
+        # 結果沒有寫入：lease 恢復為處理中，逾時後照常回到佇列
+        for task_id in claimed:
+            dispatcher.release_claim(task_id)
+        raise
+
+    availability_noted = set()
+    for (index, task_id, status, fields, is_final, retry_delay), ticket in zip(updates, tickets):
+        if ticket is None:
+            if is_final:
+                dispatcher.complete(task_id)
+            result = {"task_id": task_id, "status": "not_found", "message": f"Task {task_id} not found."}
+        else:
+            if index not in availability_noted:
+                # 合併 job 的成員同車次，每個回報項目只需更新一次
+                availability_noted.add(index)
+                note_train_availability(ticket, status, fields["result_details"])
+            notify_pending_change(ticket, removed=is_final)
+            if retry_delay is not None:
+                dispatcher.retry(ticket, retry_delay)
+                message = f"Task {task_id} failed (attempt {fields['attempts']}/{MAX_BOOKING_ATTEMPTS}). Retrying in {int(retry_delay)}s."
+                status_log.info("retry_scheduled", task_id=task_id, attempts=fields['attempts'],
+                                max_attempts=MAX_BOOKING_ATTEMPTS, delay_s=int(retry_delay))
+            else:
+                if is_final:
+                    dispatcher.complete(task_id)
+                else:
+                    dispatcher.renew(task_id)
+                message = f"Task {task_id} status updated to {status}."
+            result = {"task_id": task_id, "status": "success", "message": message}
+        # 每個回報項目一筆結果 (以主訂票為準)，合併 job 另附各成員的結果
+        if results[index] is None:
+            results[index] = result
+        else:
+            results[index].setdefault("members", []).append(result)
+    return results
 
+def note_train_availability(ticket: Dict[str, Any], status: str, details: Dict[str, Any]):
+    """依 worker 回報的售完 / 訂票成功更新 dispatcher 的售完標記；worker 以快取判定的結果不延長標記。"""
+    if status == "failed" and details.get("reason") == SOLD_OUT_REASON and not details.get("cached"):
+        dispatcher.mark_unavailable(ticket, SOLD_OUT_TTL_S)
+    elif status == "booked":
+        dispatcher.mark_available(ticket)
 
-# 6. 任務結果回傳端點 (保持不變)
 @app.route('/update_status', methods=['POST'])
 def update_status():
-    # ... (程式碼保持不變) ...
     try:
-        data = request.get_json()
-        task_id = data.get('task_id')
-        status = data.get('status') 
-        details = data.get('details', {})
-        
-        if not task_id or not status:
-            return jsonify({"status": "error", "message": "Missing task_id or status"}), 400
-        
-        task_id = int(task_id)
-
-        with data_lock:
-            requests = load_json(TICKET_REQUEST_FILE)
-            found = False
-            for ticket in requests:
-                if ticket.get("id") == task_id:
-                    ticket["status"] = status
-                    ticket["result_details"] = details
-                    ticket["completion_time"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    
-                    if details.get("code"):
-                        ticket["code"] = details["code"]
-                    
-                    if status in ["booked", "failed"]:
-                        requests.remove(ticket)
-                        history_data = load_json(TICKET_HISTORY_FILE)
-                        history_data.append(ticket)
-                        save_json(TICKET_HISTORY_FILE, history_data)
-                    
-                    found = True
-                    break
-            
-            save_json(TICKET_REQUEST_FILE, requests)
-        
-        if found:
-            return jsonify({"status": "success", "message": f"Task {task_id} status updated to {status}."}), 200
-        else:
-            return jsonify({"status": "not_found", "message": f"Task {task_id} not found."}), 404
-            
+        data = decode_request(request)
+        result = apply_status_updates([data])[0]
+        http_status = {"success": 200, "not_found": 404, "stale": 409}.get(result["status"], 400)
+        return encode_response(request, {"status": result["status"], "message": result["message"]}, http_status)
+
+    except WireFormatError as e:
+        return encode_response(request, {"status": "error", "message": str(e)}, e.http_status)
     except Exception as e:
-        print(f"[{time.strftime('%H:%M:%S')}] ❌ STATUS UPDATE UNKNOWN ERROR: {e}")
-        return jsonify({"status": "internal_error", "message": str(e)}), 500
+        status_log.error("status_update_error", error=str(e))
+        return encode_response(request, {"status": "internal_error", "message": str(e)}, 500)
+
+# 6-1. 批次任務結果回傳端點：{"results": [{task_id, status, details}, ...]}
+@app.route('/update_status_batch', methods=['POST'])
+def update_status_batch():
+    try:
+        data = decode_request(request)
+        items = data.get('results') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items:
+            return encode_response(request, {"status": "error", "message": "Missing results list"}, 400)
+        if len(items) > MAX_STATUS_BATCH:
+            return encode_response(request, {"status": "error", "message": f"Too many results in one batch (max {MAX_STATUS_BATCH})."}, 400)
+
+        results = apply_status_updates(items)
+        succeeded = sum(1 for r in results if r["status"] == "success")
+        status_log.info("batch_status_update", succeeded=succeeded, total=len(results))
+        return encode_response(request, {"status": "success", "results": results})
+
+    except WireFormatError as e:
+        return encode_response(request, {"status": "error", "message": str(e)}, e.http_status)
+    except Exception as e:
+        status_log.error("batch_status_update_error", error=str(e))
+        return encode_response(request, {"status": "internal_error", "message": str(e)}, 500)
 
 
 def add_passenger_if_new(name, id_number):
-    passengers = load_json(PASSENGER_FILE)
-    for p in passengers:
-        if p["name"] == name and p["id_number"] == id_number:
-            return  # Already exists
-    # Add new passenger with default identity
-    new_passenger = {
-        "id": get_new_passenger_id(),
-        "name": name,
-        "id_number": id_number,
-        "identity": "一般"
-    }
-    passengers.append(new_passenger)
-    save_json(PASSENGER_FILE, passengers)
+    # 以 id_number 查詢記憶體索引；查詢與新增在 store 的 lock 內完成，同時送出的訂票不會重複新增乘客
+    store.upsert_passenger({"name": name, "id_number": id_number, "identity": "一般"}, overwrite=False)
 
 @app.route("/passenger.html", methods=["GET", "POST"])
 def passenger_page():
     if request.method == "POST":
         data = request.form
-        passenger = {
-            "id": get_new_passenger_id(),
+        # 同一身分證字號已存在時更新姓名 / 身份，而不是新增重複的乘客
+        store.upsert_passenger({
             "name": data.get("name"),
             "id_number": data.get("id_number"),
             "identity": data.get("identity")
-        }
-        passengers = load_json(PASSENGER_FILE)
-        passengers.append(passenger)
-        save_json(PASSENGER_FILE, passengers)
-        return render_template("passenger.html", passengers=passengers, success=True)
-    passengers = load_json(PASSENGER_FILE)
+        })
+        return render_template("passenger.html", passengers=store.list_passengers(), success=True)
+    passengers = store.list_passengers()
     return render_template("passenger.html", passengers=passengers)
 
-if __name__ == "__main__":
-    arg_parser = ArgumentParser(
-        usage='Usage: python ' + __file__ + ' [--port <port>] [--help]'
-    )
-    arg_parser.add_argument('-p', '--port', default=10000, help='port')
-    arg_parser.add_argument('-d', '--debug', default=True, help='debug')
-    options = arg_parser.parse_args()
+# 7. 指標端點 (Prometheus text exposition format)
+# 多 worker 時 store I/O 與派送延遲在 broker 程序內量測；
+# 各 worker 自己量測的指標定期送累積快照到 broker，由 broker 加總後與前者一起輸出
+BROKER_METRICS = (STORE_IO_SECONDS.name, PUSH_TO_PICKUP_SECONDS.name)
+WORKER_METRICS = (REQUEST_LATENCY.name, POLL_WAIT.name, BOOKING_DURATION.name, WIRE_PAYLOAD_BYTES.name,
+                  "thsr_sse_subscribers", "thsr_log_records_dropped")
+
+def push_worker_metrics():
+    while True:
+        time.sleep(METRICS_PUSH_INTERVAL_S)
+        try:
+            broker.push_metrics(WORKER_METRICS)
+        except BrokerError:
+            # broker 重啟中：快照是累積值，下一輪一併送出
+            pass
+
+if broker is not None:
+    threading.Thread(target=push_worker_metrics, name="metrics-push", daemon=True).start()
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if broker is None:
+        body = REGISTRY.render()
+    else:
+        # 先送出本 worker 最新的值，其他 worker 的快照最多落後 METRICS_PUSH_INTERVAL_S
+        broker.push_metrics(WORKER_METRICS)
+        aggregated = BROKER_METRICS + WORKER_METRICS
+        body = REGISTRY.render(exclude=aggregated) + broker.call("metrics.render", only=aggregated)
+    return Response(body, mimetype="text/plain; version=0.0.4; charset=utf-8")
 
-    app.run(debug=options.debug, port=options.port, threaded=True)
\ No newline at end of file
+if __name__ == "__main__":
+    # 參數已在建立 store 之前解析 (見「命令列參數」)
+    if options.broker:
+        BrokerServer(options.broker, store, dispatcher, admission).serve_forever()
+    else:
+        app.run(debug=options.debug, port=options.port, threaded=True)
\ No newline at end of file
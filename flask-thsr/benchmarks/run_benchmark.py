@@ -0,0 +1,390 @@
+# =======================================================
+# run_benchmark.py - submit / poll / update 流程的壓力測試
+# =======================================================
+#
+# 在暫存目錄啟動 gunicorn (gevent worker) 執行 app.py，並同時驅動：
+#   - pollers:    模擬開著首頁的瀏覽器，以 If-None-Match 輪詢 /api/pending_table
+#   - submitters: 以固定速率呼叫 /api/submit_ticket 送出訂票
+#   - workers:    long_polling_client.py 子行程 (simulate_booking 的耗時由環境變數設定)
+#   - 一條 /api/pending_stream SSE 連線：記錄每筆訂票被移出待處理表格 (完成) 的時間
+# 結束後輸出各類請求的 throughput 與 p50 / p99 延遲、端到端完成延遲，
+# 以及從 /metrics 取得的伺服器端指標，並寫成 JSON 供不同版本 / 設定比較。
+#
+# 用法 (在 flask-thsr/ 目錄下)：
+#   $ python benchmarks/run_benchmark.py --duration 30 --pollers 20 --submitters 4 --workers 2
+#   $ python benchmarks/run_benchmark.py --storage sqlite --label sqlite-baseline
+#   $ python benchmarks/run_benchmark.py --url http://127.0.0.1:10000   (使用已在執行中的伺服器)
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import signal
+import shutil
+import tempfile
+import threading
+import subprocess
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+CLIENT_DIR = os.path.join(APP_DIR, "long_polling_client")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+# 送出的訂票只分散在少數車次，讓合併 (coalescing) 與排程有實際作用
+TRAIN_NOS = ("0803", "0815", "0627", "1311", "0117")
+STATIONS = (("台北", "左營"), ("台中", "台北"), ("板橋", "台南"))
+
+
+# --- 統計 ---
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    # nearest-rank
+    index = min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize(latencies: List[float], elapsed_s: float, errors: int = 0, **extra) -> Dict[str, Any]:
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "throughput_per_s": round(len(values) / elapsed_s, 2) if elapsed_s > 0 else None,
+        "p50_ms": round(percentile(values, 50) * 1000, 2) if values else None,
+        "p99_ms": round(percentile(values, 99) * 1000, 2) if values else None,
+        "max_ms": round(values[-1] * 1000, 2) if values else None,
+        **extra,
+    }
+
+
+class Recorder:
+    """各驅動執行緒共用的延遲記錄。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.statuses: Dict[int, int] = {}
+
+    def record(self, latency: float, status: int):
+        with self._lock:
+            self.latencies.append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+
+
+# --- 伺服器 / worker 子行程 ---
+def start_server(port: int, data_dir: str, options) -> subprocess.Popen:
+    env = dict(os.environ,
+               TICKET_STORE_BACKEND=options.storage,
+               MAX_BOOKING_ATTEMPTS=str(options.max_attempts),
+               MAX_BOOKING_GROUP_SIZE=str(options.group_size))
+    cmd = [sys.executable, "-m", "gunicorn", "app:app",
+           "--worker-class", "gevent", "--workers", str(options.web_workers),
+           "--bind", f"127.0.0.1:{port}", "--timeout", "600",
+           "--pythonpath", APP_DIR, "--config", os.path.join(APP_DIR, "gunicorn.conf.py")]
+    log = open(os.path.join(data_dir, "server.log"), "w")
+    # 資料檔 (journal / JSON / SQLite) 以相對路徑寫在 data_dir
+    return subprocess.Popen(cmd, cwd=data_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def start_worker(index: int, server_url: str, data_dir: str, options) -> subprocess.Popen:
+    env = dict(os.environ,
+               THSR_SERVER_URL=server_url,
+               THSR_WORKER_ID=f"bench-worker-{index}",
+               THSR_MAX_CONCURRENT_BOOKINGS=str(options.worker_concurrency),
+               THSR_MAX_GROUP_SIZE=str(options.group_size),
+               THSR_SIM_BOOKING_MIN_S=str(options.booking_min_s),
+               THSR_SIM_BOOKING_MAX_S=str(options.booking_max_s),
+               THSR_SIM_SUCCESS_RATE=str(options.success_rate),
+               THSR_WIRE_FORMAT=options.wire_format,
+               PYTHONUNBUFFERED="1")
+    log = open(os.path.join(data_dir, f"worker-{index}.log"), "w")
+    return subprocess.Popen([sys.executable, "long_polling_client.py"], cwd=CLIENT_DIR, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+def stop_process(proc: subprocess.Popen, timeout: float):
+    if proc.poll() is not None:
+        return
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+def wait_until_ready(server_url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{server_url}/api/pending_table", timeout=2).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {server_url} did not become ready within {timeout}s.")
+
+
+# --- 驅動 ---
+def poller_loop(server_url: str, stop: threading.Event, interval: float, recorder: Recorder):
+    session = requests.Session()
+    etag = None
+    while not stop.is_set():
+        headers = {"If-None-Match": etag} if etag else {}
+        started = time.perf_counter()
+        try:
+            response = session.get(f"{server_url}/api/pending_table", headers=headers, timeout=10)
+            recorder.record(time.perf_counter() - started, response.status_code)
+            etag = response.headers.get("ETag", etag)
+        except requests.exceptions.RequestException:
+            recorder.error()
+        stop.wait(interval)
+
+def make_ticket(index: int) -> Dict[str, Any]:
+    from_station, to_station = random.choice(STATIONS)
+    hour = random.randint(6, 22)
+    return {
+        "name": f"乘客{index}",
+        "id_number": f"B{random.randint(100000000, 999999999)}",
+        "train_no": random.choice(TRAIN_NOS),
+        "travel_date": (datetime.now() + timedelta(days=random.randint(1, 14))).strftime("%Y-%m-%d"),
+        "from_station": from_station,
+        "from_time": f"{hour:02d}:00",
+        "to_station": to_station,
+        "to_time": f"{hour + 1:02d}:30",
+    }
+
+def submitter_loop(server_url: str, stop: threading.Event, rate: float, recorder: Recorder,
+                   submitted: Dict[int, float], submitted_lock: threading.Lock, counter):
+    session = requests.Session()
+    interval = 1.0 / rate if rate > 0 else 0
+    next_at = time.monotonic()
+    while not stop.is_set():
+        ticket = make_ticket(next(counter))
+        submitted_at = time.monotonic()
+        started = time.perf_counter()
+        try:
+            response = session.post(f"{server_url}/api/submit_ticket", json=ticket, timeout=10)
+            recorder.record(time.perf_counter() - started, response.status_code)
+            task_id = response.json().get("task_id") if response.ok else None
+            if task_id is not None:
+                with submitted_lock:
+                    submitted[task_id] = submitted_at
+        except (requests.exceptions.RequestException, ValueError):
+            recorder.error()
+        if interval:
+            next_at += interval
+            stop.wait(max(0, next_at - time.monotonic()))
+
+def completion_listener(server_url: str, stop: threading.Event, completed: Dict[int, float],
+                        ready: threading.Event):
+    """訂閱 /api/pending_stream：remove 事件表示訂票已有最終結果 (移入歷史記錄)。"""
+    try:
+        with requests.get(f"{server_url}/api/pending_stream", stream=True, timeout=(5, 60)) as response:
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if stop.is_set():
+                    return
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    if event == "reset":
+                        ready.set()
+                    elif event == "remove":
+                        completed.setdefault(json.loads(line[len("data: "):])["id"], time.monotonic())
+                    event = None
+    except requests.exceptions.RequestException:
+        # 伺服器已關閉 (測試結束時停止)
+        return
+
+
+def scrape_metrics(server_url: str) -> Dict[str, Any]:
+    """取出 /metrics 中的 gauge 值與各 histogram 的 count / 平均 / 估計 p50、p99 (bucket 上界；秒換算成 ms，*_bytes 維持 bytes)。"""
+    try:
+        text = requests.get(f"{server_url}/metrics", timeout=10).text
+    except requests.exceptions.RequestException:
+        return {}
+    gauges: Dict[str, float] = {}
+    histograms: Dict[str, Dict[str, Any]] = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name_labels, value = line.rsplit(" ", 1)
+        name, _, labels = name_labels.partition("{")
+        labels = labels.rstrip("}")
+        if name.endswith("_bucket"):
+            series_labels = ",".join(l for l in labels.split(",") if not l.startswith("le="))
+            le = labels.rsplit('le="', 1)[1].rstrip('"')
+            series = histograms.setdefault(f"{name[:-7]}{{{series_labels}}}", {"buckets": []})
+            series["buckets"].append((float(le), float(value)))
+        elif name.endswith("_sum") or name.endswith("_count"):
+            base, _, kind = name.rpartition("_")
+            histograms.setdefault(f"{base}{{{labels}}}", {"buckets": []})[kind] = float(value)
+        else:
+            gauges[name] = float(value)
+
+    summary = {}
+    for key, series in histograms.items():
+        count = series.get("count", 0)
+        if not count:
+            continue
+        def bucket_quantile(q):
+            for bound, cumulative in series["buckets"]:
+                if cumulative >= q * count:
+                    return bound
+            return None
+        scale, unit = (1, "bytes") if key.partition("{")[0].endswith("_bytes") else (1000, "ms")
+        summary[key] = {
+            "count": int(count),
+            f"mean_{unit}": round(series.get("sum", 0) / count * scale, 2),
+            f"p50_le_{unit}": round(bucket_quantile(0.5) * scale, 2),
+            f"p99_le_{unit}": round(bucket_quantile(0.99) * scale, 2),
+        }
+    return {"gauges": gauges, "histograms": summary}
+
+
+def wait_for_drain(server_url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        gauges = scrape_metrics(server_url).get("gauges", {})
+        if gauges.get("thsr_queue_depth", 1) == 0 and gauges.get("thsr_jobs_in_flight", 1) == 0:
+            return
+        time.sleep(0.5)
+
+
+# --- 主程式 ---
+def run(options) -> Dict[str, Any]:
+    data_dir = tempfile.mkdtemp(prefix="thsr-bench-")
+    server = None
+    workers: List[subprocess.Popen] = []
+    server_url = options.url
+    try:
+        if not server_url:
+            server_url = f"http://127.0.0.1:{options.port}"
+            server = start_server(options.port, data_dir, options)
+        wait_until_ready(server_url)
+
+        stop = threading.Event()
+        stop_listener = threading.Event()
+        completed: Dict[int, float] = {}
+        listener_ready = threading.Event()
+        threading.Thread(target=completion_listener, args=(server_url, stop_listener, completed, listener_ready),
+                         daemon=True).start()
+        listener_ready.wait(timeout=10)
+
+        workers = [start_worker(i, server_url, data_dir, options) for i in range(options.workers)]
+
+        poll_recorder, submit_recorder = Recorder(), Recorder()
+        submitted: Dict[int, float] = {}
+        submitted_lock = threading.Lock()
+        counter = iter(range(1, 10 ** 9))
+        threads = [threading.Thread(target=poller_loop, args=(server_url, stop, options.poll_interval, poll_recorder))
+                   for _ in range(options.pollers)]
+        threads += [threading.Thread(target=submitter_loop,
+                                     args=(server_url, stop, options.submit_rate, submit_recorder,
+                                           submitted, submitted_lock, counter))
+                    for _ in range(options.submitters)]
+
+        print(f"[{time.strftime('%H:%M:%S')}] 🏁 BENCHMARK: {options.duration}s, {options.pollers} pollers, "
+              f"{options.submitters} submitters, {options.workers} workers (data: {data_dir})")
+        started = time.monotonic()
+        for t in threads:
+            t.start()
+        time.sleep(options.duration)
+        stop_load = time.monotonic()
+        # 停止送出新訂票與輪詢，等待已送出的訂票完成
+        stop.set()
+        for t in threads:
+            t.join()
+        elapsed = stop_load - started
+        wait_for_drain(server_url, options.drain_s)
+        drained_at = time.monotonic()
+        stop_listener.set()
+
+        server_metrics = scrape_metrics(server_url)
+        end_to_end = [completed[task_id] - at for task_id, at in submitted.items() if task_id in completed]
+        return {
+            "label": options.label,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "config": {k: v for k, v in vars(options).items() if k not in ("output",)},
+            "elapsed_s": round(elapsed, 2),
+            "pending_table": summarize(poll_recorder.latencies, elapsed, poll_recorder.errors,
+                                       not_modified=poll_recorder.statuses.get(304, 0)),
+            "submit_ticket": summarize(submit_recorder.latencies, elapsed, submit_recorder.errors,
+                                       rejected=submit_recorder.statuses.get(429, 0)),
+            "bookings": summarize(end_to_end, drained_at - started,
+                                  submitted=len(submitted), completed=len(end_to_end)),
+            "server": server_metrics,
+        }
+    finally:
+        for proc in workers:
+            stop_process(proc, timeout=30)
+        if server is not None:
+            stop_process(server, timeout=10)
+        if options.keep_data:
+            print(f"[{time.strftime('%H:%M:%S')}] 📁 Data and logs kept in {data_dir}")
+        else:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def print_report(result: Dict[str, Any]):
+    print(f"\n=== {result['label'] or 'benchmark'} ({result['elapsed_s']}s) ===")
+    print(f"{'':16}{'count':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for key in ("pending_table", "submit_ticket", "bookings"):
+        r = result[key]
+        print(f"{key:16}{r['count']:>8}{r['errors']:>8}{str(r['throughput_per_s']):>10}"
+              f"{str(r['p50_ms']):>10}{str(r['p99_ms']):>10}")
+    if result["submit_ticket"].get("rejected"):
+        print(f"submit_ticket: {result['submit_ticket']['rejected']} rejected with 429 (admission control)")
+    print(f"bookings: {result['bookings']['completed']}/{result['bookings']['submitted']} completed "
+          f"(p50/p99 = submit until removed from the pending table)")
+    for key, h in sorted(result["server"].get("histograms", {}).items()):
+        if key.startswith(("thsr_push_to_pickup", "thsr_poll_wait", "thsr_booking_duration", "thsr_store_io")):
+            print(f"  {key}: n={h['count']} mean={h['mean_ms']}ms p50<={h['p50_le_ms']}ms p99<={h['p99_le_ms']}ms")
+        elif key.startswith("thsr_wire_payload_bytes"):
+            print(f"  {key}: n={h['count']} mean={h['mean_bytes']}B p50<={h['p50_le_bytes']}B p99<={h['p99_le_bytes']}B")
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(description="Load test the submit / poll / update cycle of flask-thsr.")
+    arg_parser.add_argument("--url", default=None, help="use an already running server instead of starting gunicorn")
+    arg_parser.add_argument("--port", type=int, default=10100, help="port for the gunicorn server")
+    arg_parser.add_argument("--storage", default="journal", choices=("journal", "sqlite"))
+    arg_parser.add_argument("--web-workers", type=int, default=1,
+                            help="gunicorn worker processes (> 1 starts the coordination broker)")
+    arg_parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    arg_parser.add_argument("--drain-s", type=float, default=30, help="max seconds to wait for submitted tickets to finish")
+    arg_parser.add_argument("--pollers", type=int, default=20, help="simulated browsers polling /api/pending_table")
+    arg_parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between polls per browser")
+    arg_parser.add_argument("--submitters", type=int, default=4)
+    arg_parser.add_argument("--submit-rate", type=float, default=5, help="tickets per second per submitter (0 = unthrottled)")
+    arg_parser.add_argument("--workers", type=int, default=2, help="long_polling_client processes")
+    arg_parser.add_argument("--worker-concurrency", type=int, default=4, help="concurrent bookings per worker")
+    arg_parser.add_argument("--group-size", type=int, default=4, help="max passengers coalesced into one booking job")
+    arg_parser.add_argument("--booking-min-s", type=float, default=0.05, help="simulated booking time lower bound")
+    arg_parser.add_argument("--booking-max-s", type=float, default=0.2, help="simulated booking time upper bound")
+    arg_parser.add_argument("--success-rate", type=float, default=0.5)
+    arg_parser.add_argument("--wire-format", default="auto", choices=("auto", "json", "msgpack"),
+                            help="poll / status encoding used by the workers (THSR_WIRE_FORMAT)")
+    arg_parser.add_argument("--max-attempts", type=int, default=1, help="server MAX_BOOKING_ATTEMPTS (1 = no retries)")
+    arg_parser.add_argument("--label", default="", help="name stored in the results file")
+    arg_parser.add_argument("--output", default=None, help="results JSON path (default: benchmarks/results/<timestamp>.json)")
+    arg_parser.add_argument("--keep-data", action="store_true", help="keep the temporary data directory and logs")
+    options = arg_parser.parse_args()
+
+    result = run(options)
+    print_report(result)
+
+    output = options.output or os.path.join(RESULTS_DIR, f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\nResults written to {output}")
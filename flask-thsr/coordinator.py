@@ -0,0 +1,334 @@
+# =======================================================
+# coordinator.py - 跨程序協調 (gunicorn 多 worker)
+# =======================================================
+#
+# ticket store、TaskDispatcher 的佇列 / lease 與待處理表格的版本號都是程序內的狀態；
+# gunicorn 開多個 worker 時，某個 worker 收到的新訂票叫不醒掛在另一個 worker 的 long poll。
+# 這裡用 Unix domain socket 上的 broker 把這些狀態集中到單一程序：
+#   - broker 程序擁有 store、dispatcher 與 admission (流量控制)，所有異動在同一個程序內依序執行 (跨 worker 序列化)
+#   - web worker 透過 BrokerClient 以 JSON Lines RPC 呼叫 broker；每個 worker 只開一條連線，
+#     一條連線上可同時有多個呼叫 (以 id 對應回應)，long poll 在 broker 端等待，
+#     因此任何 worker 收到的 push 都能叫醒任何 worker 上的 poll
+#   - 待處理表格的異動由 broker 配發全域版本號，再轉送給所有 web worker，
+#     各 worker 轉發給自己的 SSE 訂閱者
+#   - 各 web worker 自己量測的指標 (請求延遲等) 定期以 metrics.push 送來累積快照，
+#     metrics.render 輸出時與 broker 的值加總，/metrics 不論打到哪個 worker 都是全體的數字
+#
+# 協定 (每行一個 JSON)：
+#   請求  {"id": n, "method": "store.add_ticket", "args": [...], "kwargs": {...}}
+#   回應  {"id": n, "result": ...} 或 {"id": n, "error": "..."}
+#   事件  {"event": "pending", "version": v, "kind": "upsert" | "remove", "row": {...}}
+
+import os
+import json
+import time
+import uuid
+import socket
+import itertools
+import threading
+from typing import Dict, Any, List, Optional, Callable, Collection, Iterator
+
+from metrics import REGISTRY, ProcessSnapshots
+from jsonlog import get_logger
+
+log = get_logger("broker")
+
+# 允許透過 RPC 呼叫的方法 (其餘屬性一律拒絕)
+STORE_METHODS = frozenset({
+    "list_pending", "list_history", "get_ticket", "next_ticket_id", "add_ticket", "update_ticket",
+    "update_tickets", "list_passengers", "find_passenger", "next_passenger_id", "upsert_passenger",
+})
+DISPATCHER_METHODS = frozenset({
+    "submit", "poll", "claim_result", "release_claim", "complete", "renew", "retry",
+    "backlog_size", "in_flight", "waiting_workers", "pending_count", "drain_rate",
+    "mark_unavailable", "mark_available", "unavailable_count",
+})
+ADMISSION_METHODS = frozenset({"admit", "commit", "release"})
+# iter_history 是 generator，改由 broker 端分段 (每段最多這麼多筆) 取回
+HISTORY_CHUNK_SIZE = 200
+# web worker 啟動時 broker 可能尚未 listen：最多等待此秒數
+BROKER_CONNECT_TIMEOUT_S = 30
+# web worker 送指標快照到 broker 的間隔；超過 3 個間隔沒回報的 worker 不再計入 gauge
+METRICS_PUSH_INTERVAL_S = 5
+
+
+class BrokerError(RuntimeError):
+    """broker 連線中斷，或 broker 端執行方法時發生例外。"""
+
+
+def _encode(message: Dict[str, Any]) -> bytes:
+    return (json.dumps(message, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+
+class BrokerServer:
+    def __init__(self, socket_path: str, store, dispatcher, admission):
+        self.socket_path = socket_path
+        self.store = store
+        self.dispatcher = dispatcher
+        # EPOCH 區分 broker 的不同啟動，web worker 以此組出待處理表格的 ETag
+        self.epoch = uuid.uuid4().hex[:8]
+        self._targets = {"store": (store, STORE_METHODS), "dispatcher": (dispatcher, DISPATCHER_METHODS),
+                         "admission": (admission, ADMISSION_METHODS)}
+        self._events_lock = threading.Lock()
+        self._pending_version = 0
+        self._subscribers: Dict[int, Callable[[Dict[str, Any]], None]] = {}
+        self.worker_metrics = ProcessSnapshots(REGISTRY, gauge_ttl_s=3 * METRICS_PUSH_INTERVAL_S)
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        listener.listen(128)
+        log.info("broker_listening", socket=self.socket_path, epoch=self.epoch)
+        try:
+            while True:
+                conn, _ = listener.accept()
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def _serve_connection(self, conn: socket.socket):
+        write_lock = threading.Lock()
+
+        def send(message: Dict[str, Any]):
+            data = _encode(message)
+            with write_lock:
+                conn.sendall(data)
+
+        reader = conn.makefile("rb")
+        try:
+            for line in reader:
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    log.warning("broker_bad_request", line=line[:200])
+                    continue
+                # 每個呼叫各自一個 greenlet：long poll 在等待時不會擋住同一條連線上的其他呼叫
+                threading.Thread(target=self._dispatch, args=(request, send, id(conn)), daemon=True).start()
+        except OSError:
+            pass
+        finally:
+            with self._events_lock:
+                self._subscribers.pop(id(conn), None)
+            reader.close()
+            conn.close()
+
+    def _dispatch(self, request: Dict[str, Any], send: Callable, conn_id: int):
+        call_id = request.get("id")
+        try:
+            result = self._call(request.get("method", ""), request.get("args") or [],
+                                request.get("kwargs") or {}, send, conn_id)
+            response = {"id": call_id, "result": result}
+        except Exception as e:
+            log.warning("broker_call_failed", method=request.get("method"), error=f"{type(e).__name__}: {e}")
+            response = {"id": call_id, "error": f"{type(e).__name__}: {e}"}
+        try:
+            send(response)
+        except OSError:
+            pass
+
+    def _call(self, method: str, args: List, kwargs: Dict[str, Any], send: Callable, conn_id: int):
+        if method == "store.history_chunk":
+            return self.history_chunk(*args, **kwargs)
+        target, _, name = method.partition(".")
+        if target in self._targets:
+            obj, allowed = self._targets[target]
+            if name not in allowed:
+                raise AttributeError(f"method not allowed: {method}")
+            return getattr(obj, name)(*args, **kwargs)
+        if method == "broker.hello":
+            return {"epoch": self.epoch, "pid": os.getpid()}
+        if method == "events.subscribe":
+            with self._events_lock:
+                self._subscribers[conn_id] = send
+            return True
+        if method == "events.publish":
+            return self.publish_pending(*args, **kwargs)
+        if method == "events.version":
+            return self._pending_version
+        if method == "metrics.push":
+            return self.worker_metrics.update(*args, **kwargs)
+        if method == "metrics.render":
+            return self.worker_metrics.render(*args, **kwargs)
+        raise AttributeError(f"unknown method: {method}")
+
+    def history_chunk(self, before_id: Optional[int], filters: Optional[Dict[str, str]], limit: int) -> List[Dict[str, Any]]:
+        tickets = []
+        for ticket in self.store.iter_history(before_id=before_id, filters=filters):
+            tickets.append(ticket)
+            if len(tickets) >= limit:
+                break
+        return tickets
+
+    def publish_pending(self, kind: str, row: Dict[str, Any]) -> int:
+        """配發下一個待處理表格版本號，並把異動轉送給所有已訂閱的 web worker。"""
+        with self._events_lock:
+            self._pending_version += 1
+            version = self._pending_version
+            subscribers = list(self._subscribers.items())
+        message = {"event": "pending", "version": version, "kind": kind, "row": row}
+        for conn_id, send in subscribers:
+            try:
+                send(message)
+            except OSError:
+                with self._events_lock:
+                    self._subscribers.pop(conn_id, None)
+        return version
+
+
+class _PendingCall:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[str] = None
+
+
+class BrokerClient:
+    """web worker 端：單一連線、可同時多個呼叫；連線中斷時進行中的呼叫失敗，下次呼叫自動重連。"""
+
+    def __init__(self, socket_path: str, connect_timeout_s: float = BROKER_CONNECT_TIMEOUT_S):
+        self.socket_path = socket_path
+        self.connect_timeout_s = connect_timeout_s
+        self.epoch: Optional[str] = None
+        # 指標快照以此區分程序；pid 可能被重複使用，加上亂數避免蓋掉已結束 worker 的累積值
+        self.process_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._connect_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, _PendingCall] = {}
+        self._event_handler: Optional[Callable[[Dict[str, Any]], None]] = None
+        self._reconnect_handler: Optional[Callable[[], None]] = None
+
+    def on_event(self, handler: Callable[[Dict[str, Any]], None], on_reconnect: Optional[Callable[[], None]] = None):
+        """訂閱 broker 轉送的事件；on_reconnect 在重新連線後呼叫 (期間的事件可能已遺漏)。"""
+        self._event_handler = handler
+        self._reconnect_handler = on_reconnect
+
+    def proxy(self, target: str, methods: frozenset) -> "RemoteProxy":
+        return RemoteProxy(self, target, methods)
+
+    def call(self, method: str, *args, **kwargs):
+        sock = self._connection()
+        return self._request(sock, method, args, kwargs)
+
+    def push_metrics(self, names: Collection[str]):
+        """把本程序 names 指標的累積快照送到 broker (取代這個程序上一次送的快照)。"""
+        self.call("metrics.push", self.process_id, REGISTRY.snapshot(names))
+
+    # --- 內部 ---
+    def _request(self, sock: socket.socket, method: str, args=(), kwargs=None):
+        call_id = next(self._ids)
+        pending = self._pending[call_id] = _PendingCall()
+        try:
+            if self._sock is not sock:
+                raise OSError("connection closed")
+            data = _encode({"id": call_id, "method": method, "args": list(args), "kwargs": kwargs or {}})
+            with self._write_lock:
+                sock.sendall(data)
+        except OSError as e:
+            self._pending.pop(call_id, None)
+            self._disconnect(sock)
+            raise BrokerError(f"broker unavailable: {e}") from e
+        pending.done.wait()
+        if pending.error is not None:
+            raise BrokerError(pending.error)
+        return pending.result
+
+    def _connection(self) -> socket.socket:
+        with self._connect_lock:
+            sock = self._sock
+            if sock is not None:
+                return sock
+            sock = self._sock = self._open()
+            threading.Thread(target=self._read_loop, args=(sock,), daemon=True).start()
+        # 握手在 lock 外進行：連線若在此時中斷，讀取端需要 lock 才能讓這些呼叫失敗
+        reconnected = self.epoch is not None
+        self.epoch = self._request(sock, "broker.hello")["epoch"]
+        if self._event_handler is not None:
+            self._request(sock, "events.subscribe")
+        log.info("broker_connected", socket=self.socket_path, epoch=self.epoch, reconnected=reconnected)
+        if reconnected and self._reconnect_handler is not None:
+            self._reconnect_handler()
+        return sock
+
+    def _open(self) -> socket.socket:
+        deadline = time.monotonic() + self.connect_timeout_s
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+                return sock
+            except OSError as e:
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise BrokerError(f"broker unavailable: {e}") from e
+                time.sleep(0.1)
+
+    def _read_loop(self, sock: socket.socket):
+        reader = sock.makefile("rb")
+        try:
+            for line in reader:
+                message = json.loads(line)
+                if "event" in message:
+                    if self._event_handler is not None:
+                        try:
+                            self._event_handler(message)
+                        except Exception as e:
+                            log.error("broker_event_handler_failed", error=str(e))
+                    continue
+                pending = self._pending.pop(message.get("id"), None)
+                if pending is not None:
+                    pending.result = message.get("result")
+                    pending.error = message.get("error")
+                    pending.done.set()
+        except (OSError, ValueError):
+            pass
+        finally:
+            reader.close()
+            self._disconnect(sock)
+
+    def _disconnect(self, sock: socket.socket):
+        with self._connect_lock:
+            if self._sock is not sock:
+                return
+            self._sock = None
+            pending, self._pending = self._pending, {}
+        sock.close()
+        log.warning("broker_disconnected", socket=self.socket_path, failed_calls=len(pending))
+        for call in pending.values():
+            call.error = "broker connection lost"
+            call.done.set()
+
+
+class RemoteProxy:
+    """以 store / dispatcher 的介面呼叫 broker 上的同名物件。"""
+
+    def __init__(self, client: BrokerClient, target: str, methods: frozenset):
+        self._client = client
+        self._target = target
+        self._methods = methods
+
+    def __getattr__(self, name: str):
+        if name not in self._methods:
+            raise AttributeError(name)
+        method = f"{self._target}.{name}"
+
+        def remote_call(*args, **kwargs):
+            return self._client.call(method, *args, **kwargs)
+        return remote_call
+
+    def iter_history(self, before_id: Optional[int] = None, filters: Optional[Dict[str, str]] = None) -> Iterator[Dict[str, Any]]:
+        # 分段向 broker 取回，每段從上一段最後一筆之前接著讀
+        while True:
+            chunk = self._client.call("store.history_chunk", before_id, filters, HISTORY_CHUNK_SIZE)
+            yield from chunk
+            if len(chunk) < HISTORY_CHUNK_SIZE:
+                return
+            before_id = chunk[-1]["id"]
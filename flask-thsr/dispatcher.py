@@ -0,0 +1,483 @@
+# =======================================================
+# dispatcher.py - 多訂票機 (booking worker) 任務派送器
+# =======================================================
+#
+# 取代原本單一的 current_waiting_event / current_response_data:
+#   - 每個 worker 以 worker_id 識別，各自有自己的等待中 poll
+#   - 新任務只交給「一個」閒置 (正在等待) 的 worker，以 round-robin
+#     (最久未被派送者優先) 選擇
+#   - 沒有任何 worker 在等待時，任務保留在佇列，由下一個 poll 取走
+#   - 派出的任務以 lease 方式標記為處理中 (in-flight)，不會再派給其他
+#     worker；/update_status 完成 lease，逾期未回報的 lease 自動回到佇列
+#   - 佇列為優先佇列：乘車時間 (deadline) 越近、等待越久的任務越先派出；
+#     訂票失敗可依 RetryPolicy 延遲後重新排入佇列
+#   - 同車次 / 日期 / 起訖站的待處理訂票可合併成一個多乘客訂票工作 (job)，
+#     job id 為第一筆訂票的 id，回報結果時由 claim_result() 展開給每一筆
+#   - 每個 lease 有自己的 lease_id (隨 job 送出，worker 回報時帶回)；只有目前持有 lease 的
+#     回報會被套用，重送的重複回報、lease 逾時後才到的回報都會被忽略
+#   - worker 回報某車次已售完時 (mark_unavailable)，同車次 / 日期 / 起訖站的任務
+#     暫緩派送到標記到期，把訂票機留給還訂得到的任務
+
+import time
+import heapq
+import secrets
+import itertools
+import threading
+from collections import deque, OrderedDict
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from metrics import PUSH_TO_PICKUP_SECONDS
+from jsonlog import get_logger
+
+log = get_logger("dispatch")
+
+CST_TIMEZONE = ZoneInfo('Asia/Taipei')
+
+DRAIN_MIN_WINDOW_S = 10
+# 已售完標記最多保留的車次數 (超過時淘汰最早標記者)
+MAX_UNAVAILABLE_KEYS = 10000
+
+
+# --- 排程優先順序 ---
+def task_deadline(task: Dict[str, Any]) -> float:
+    """乘車日期 + 出發時間 (台北時間) 的 epoch 秒數；無法解析時視為無期限。"""
+    try:
+        departure = datetime.strptime(f"{task.get('travel_date')} {task.get('from_time')}", "%Y-%m-%d %H:%M")
+        return departure.replace(tzinfo=CST_TIMEZONE).timestamp()
+    except (TypeError, ValueError):
+        return float("inf")
+
+def task_submitted_at(task: Dict[str, Any]) -> float:
+    try:
+        return datetime.strptime(task.get("order_date"), "%Y-%m-%d %H:%M:%S").replace(tzinfo=CST_TIMEZONE).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+def task_priority(task: Dict[str, Any], age_weight: float) -> float:
+    """
+    數值越小越優先。有效期限 = deadline - age_weight * 已等待秒數；
+    其中 "- age_weight * now" 對所有任務相同，因此排序只需 deadline + age_weight * 提交時間，
+    鍵值不隨時間改變，可以直接放進 heap。
+    """
+    return task_deadline(task) + age_weight * task_submitted_at(task)
+
+
+def booking_group_key(task: Dict[str, Any]) -> tuple:
+    """可合併成同一筆多乘客訂票的條件：同車次、同日期、同起訖站。"""
+    return (task.get("train_no"), task.get("travel_date"), task.get("from_station"), task.get("to_station"))
+
+
+class RetryPolicy:
+    """訂票失敗的重試策略：最多 max_attempts 次，指數退避，已過乘車時間則不再重試。"""
+
+    def __init__(self, max_attempts: int = 3, backoff_s: float = 60, backoff_max_s: float = 1800):
+        self.max_attempts = max_attempts
+        self.backoff_s = backoff_s
+        self.backoff_max_s = backoff_max_s
+
+    def next_delay(self, task: Dict[str, Any], attempts: int) -> Optional[float]:
+        """已失敗 attempts 次後，回傳重試前的等待秒數；不應重試時回傳 None。"""
+        if attempts >= self.max_attempts:
+            return None
+        delay = min(self.backoff_max_s, self.backoff_s * 2 ** (attempts - 1))
+        if time.time() + delay >= task_deadline(task):
+            return None
+        return delay
+
+
+class _Waiter:
+    """一次等待中的 long poll。"""
+
+    def __init__(self, max_tasks: int, max_group_size: int):
+        self.event = threading.Event()
+        self.response: Optional[Dict[str, Any]] = None
+        self.max_tasks = max_tasks
+        self.max_group_size = max_group_size
+
+
+class _Lease:
+    def __init__(self, tasks: List[Dict[str, Any]], worker_id: str, expires_at: float):
+        self.tasks = tasks  # 第一筆為 job 的主訂票，其餘為合併進來的成員
+        self.worker_id = worker_id
+        self.expires_at = expires_at
+        self.lease_id = secrets.token_hex(8)
+        self.closing = False  # 已收到最終結果，正在寫入 (之後的回報視為重複)
+
+
+class _Worker:
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+        self.waiter: Optional[_Waiter] = None
+        self.last_seen = time.monotonic()
+        self.last_assigned = 0.0
+
+
+class TaskDispatcher:
+    def __init__(self, batch_size: int = 5, lease_timeout_s: int = 300, worker_expiry_s: int = 3600,
+                 age_weight: float = 1.0, max_group_size: int = 1, drain_window_s: float = 60):
+        self.batch_size = batch_size
+        self.lease_timeout_s = lease_timeout_s
+        self.worker_expiry_s = worker_expiry_s
+        self.age_weight = age_weight
+        self.max_group_size = max_group_size
+        self.drain_window_s = drain_window_s
+
+        self._lock = threading.Lock()
+        self._workers: Dict[str, _Worker] = {}
+        self._leases: Dict[int, _Lease] = {}
+
+        # 佇列中的任務: task_id -> (seq, task)。heap 採 lazy deletion，
+        # 取出時 seq 不符 (已被移除或重新排入) 的項目直接略過。
+        self._queued: Dict[int, Tuple[int, Dict[str, Any]]] = {}
+        self._ready: List[Tuple[float, int, int]] = []    # (priority, seq, task_id)
+        self._delayed: List[Tuple[float, int, int]] = []  # (ready_at, seq, task_id)，重試等待中
+        self._seq = itertools.count()
+        # 可立即派送的任務依 booking_group_key 分組 (dict 當作有序集合)，供合併時查找
+        self._ready_groups: Dict[tuple, Dict[int, None]] = {}
+        # submit() 的時間點，worker 認領時計算 push-to-pickup 延遲 (只計第一次派送)
+        self._submitted_at: Dict[int, float] = {}
+        # 最近 drain_window_s 秒內完成的任務 (時間, 筆數)，估算佇列消化速度
+        self._drained: deque = deque()
+        self._drained_total = 0
+        self._started = time.monotonic()
+        # 已知售完的 booking_group_key -> 標記到期時間 (monotonic)
+        self._unavailable: "OrderedDict[tuple, float]" = OrderedDict()
+
+        # 背景檢查逾期 lease / 到期的重試，放回佇列後直接派給等待中的 worker
+        self._reaper = threading.Thread(target=self._reap_loop, name="lease-reaper", daemon=True)
+        self._reaper.start()
+
+    # --- 佇列 ---
+    def _enqueue(self, task: Dict[str, Any], not_before: Optional[float] = None):
+        # 呼叫端需持有 self._lock
+        self._dequeue(task["id"])
+        seq = next(self._seq)
+        self._queued[task["id"]] = (seq, task)
+        if not_before is not None and not_before > time.monotonic():
+            heapq.heappush(self._delayed, (not_before, seq, task["id"]))
+        else:
+            self._push_ready(task, seq)
+
+    def _push_ready(self, task: Dict[str, Any], seq: int):
+        # 呼叫端需持有 self._lock
+        heapq.heappush(self._ready, (task_priority(task, self.age_weight), seq, task["id"]))
+        self._ready_groups.setdefault(booking_group_key(task), {})[task["id"]] = None
+
+    def _dequeue(self, task_id: int) -> Optional[Dict[str, Any]]:
+        # 呼叫端需持有 self._lock。heap 中的項目留待取出時略過。
+        entry = self._queued.pop(task_id, None)
+        if entry is None:
+            return None
+        key = booking_group_key(entry[1])
+        group = self._ready_groups.get(key)
+        if group is not None:
+            group.pop(task_id, None)
+            if not group:
+                del self._ready_groups[key]
+        return entry[1]
+
+    def _promote_delayed(self):
+        # 呼叫端需持有 self._lock
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, seq, task_id = heapq.heappop(self._delayed)
+            entry = self._queued.get(task_id)
+            if entry and entry[0] == seq:
+                self._push_ready(entry[1], seq)
+
+    def _pop_ready(self) -> Optional[Dict[str, Any]]:
+        # 呼叫端需持有 self._lock
+        while self._ready:
+            _, seq, task_id = heapq.heappop(self._ready)
+            entry = self._queued.get(task_id)
+            if entry and entry[0] == seq:
+                return self._dequeue(task_id)
+        return None
+
+    def _pop_group_members(self, task: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
+        # 呼叫端需持有 self._lock。取出最多 limit 筆可與 task 合併的待派送任務。
+        group = self._ready_groups.get(booking_group_key(task))
+        if not group or limit <= 0:
+            return []
+        return [self._dequeue(task_id) for task_id in list(itertools.islice(group, limit))]
+
+    def _has_ready(self) -> bool:
+        # 呼叫端需持有 self._lock
+        while self._ready:
+            _, seq, task_id = self._ready[0]
+            entry = self._queued.get(task_id)
+            if entry and entry[0] == seq:
+                return True
+            heapq.heappop(self._ready)
+        return False
+
+    # --- 任務進入 ---
+    def seed(self, tasks: List[Dict[str, Any]]):
+        """啟動時載入尚未完成的任務。"""
+        with self._lock:
+            for t in tasks:
+                self._enqueue(t.copy())
+
+    def submit(self, task: Dict[str, Any]) -> Optional[str]:
+        """排入一筆新任務並喚醒一個閒置 worker；回傳 worker_id，沒有閒置 worker 時回傳 None (留在佇列)。"""
+        with self._lock:
+            self._enqueue(task.copy())
+            self._submitted_at[task["id"]] = time.monotonic()
+            worker = self._idle_worker()
+            if worker is None or not self._wake(worker):
+                return None
+            return worker.worker_id
+
+    def _idle_worker(self) -> Optional[_Worker]:
+        # 呼叫端需持有 self._lock
+        idle = [w for w in self._workers.values() if w.waiter is not None]
+        return min(idle, key=lambda w: w.last_assigned) if idle else None
+
+    def _wake(self, worker: _Worker) -> bool:
+        # 呼叫端需持有 self._lock
+        waiter = worker.waiter
+        response = self._take(worker, waiter.max_tasks, waiter.max_group_size)
+        if response is None:
+            # 可派送的任務都屬於已售完的車次 (已延後)：worker 繼續等待
+            return False
+        worker.waiter = None
+        waiter.response = response
+        waiter.event.set()
+        return True
+
+    def _dispatch_to_idle(self):
+        # 呼叫端需持有 self._lock
+        while self._has_ready():
+            worker = self._idle_worker()
+            if worker is None:
+                break
+            self._wake(worker)
+
+    def _take(self, worker: _Worker, max_tasks: int, max_group_size: int = 1) -> Optional[Dict[str, Any]]:
+        # 呼叫端需持有 self._lock。依優先順序認領最多 max_tasks 個 job，並為每個 job 建立 lease。
+        self._promote_delayed()
+        group_size = max(1, min(max_group_size, self.max_group_size))
+        jobs = []
+        expires_at = time.monotonic() + self.lease_timeout_s
+        while len(jobs) < max_tasks:
+            task = self._pop_ready()
+            if task is None:
+                break
+            unavailable_until = self._unavailable_until(booking_group_key(task))
+            if unavailable_until is not None:
+                # 車次已知售完：延到標記到期後再派送 (同組的其他任務取出時也會各自延後)
+                self._enqueue(task, not_before=unavailable_until)
+                continue
+            members = [task] + self._pop_group_members(task, group_size - 1)
+            for member in members:
+                submitted_at = self._submitted_at.pop(member["id"], None)
+                if submitted_at is not None:
+                    PUSH_TO_PICKUP_SECONDS.observe(time.monotonic() - submitted_at)
+            lease = self._leases[task["id"]] = _Lease(members, worker.worker_id, expires_at)
+            jobs.append({**self._job_payload(members), "lease_id": lease.lease_id})
+        if not jobs:
+            return None
+
+        worker.last_assigned = time.monotonic()
+        if len(jobs) == 1:
+            return {"status": "success", "data": jobs[0], "lease_timeout_s": self.lease_timeout_s}
+        return {"status": "initial_sync", "message": "Found pending tasks in queue.", "data": jobs,
+                "lease_timeout_s": self.lease_timeout_s}
+
+    @staticmethod
+    def _job_payload(members: List[Dict[str, Any]]) -> Dict[str, Any]:
+        # 單筆任務維持原本格式；合併的 job 以主訂票為基礎，附上所有乘客
+        if len(members) == 1:
+            return members[0]
+        return {
+            **members[0],
+            "group_ids": [m["id"] for m in members],
+            "passengers": [{"id": m["id"], "name": m.get("name"), "id_number": m.get("id_number")} for m in members],
+        }
+
+    # --- 已售完車次 ---
+    def mark_unavailable(self, task: Dict[str, Any], ttl_s: float):
+        """worker 回報 task 的車次 / 日期 / 起訖站已售完：ttl_s 秒內暫緩派送同組任務。"""
+        if ttl_s <= 0:
+            return
+        key = booking_group_key(task)
+        with self._lock:
+            self._unavailable[key] = time.monotonic() + ttl_s
+            self._unavailable.move_to_end(key)
+            while len(self._unavailable) > MAX_UNAVAILABLE_KEYS:
+                self._unavailable.popitem(last=False)
+
+    def mark_available(self, task: Dict[str, Any]):
+        """同組有訂票成功：清除售完標記。"""
+        with self._lock:
+            self._unavailable.pop(booking_group_key(task), None)
+
+    def _unavailable_until(self, key: tuple) -> Optional[float]:
+        # 呼叫端需持有 self._lock
+        until = self._unavailable.get(key)
+        if until is None:
+            return None
+        if until <= time.monotonic():
+            del self._unavailable[key]
+            return None
+        return until
+
+    def unavailable_count(self) -> int:
+        with self._lock:
+            now = time.monotonic()
+            return sum(1 for until in self._unavailable.values() if until > now)
+
+    # --- Lease ---
+    def claim_result(self, task_id: int, lease_id: Optional[str] = None, final: bool = False) -> Optional[List[int]]:
+        """
+        worker 回報 job 結果前的檢查：job 目前有 lease 且 lease_id 相符 (舊版 worker 不帶 lease_id 時
+        只檢查有 lease) 才回傳所有成員訂票 id (含主訂票)，否則回傳 None (重複或過期的回報)。
+        final=True 時 lease 同時標記為結束中，同一結果的重送在 complete / retry 之前也不會再被套用。
+        """
+        with self._lock:
+            lease = self._leases.get(task_id)
+            if lease is None or lease.closing or (lease_id is not None and lease_id != lease.lease_id):
+                return None
+            if final:
+                lease.closing = True
+            return [t["id"] for t in lease.tasks]
+
+    def release_claim(self, task_id: int):
+        """最終結果沒有寫入成功 (例如 store 發生錯誤)：取消結束中的標記，lease 逾時後照常回到佇列。"""
+        with self._lock:
+            lease = self._leases.get(task_id)
+            if lease is not None:
+                lease.closing = False
+
+    def complete(self, task_id: int) -> bool:
+        """任務已回報最終結果：結束 lease (若已逾期回到佇列也一併移除)。"""
+        with self._lock:
+            lease = self._leases.pop(task_id, None)
+            queued = self._dequeue(task_id) is not None
+            self._submitted_at.pop(task_id, None)
+            # 合併 job 的成員由主訂票的 lease 一起計入
+            drained = len(lease.tasks) if lease is not None else int(queued)
+            if drained:
+                now = time.monotonic()
+                self._drained.append((now, drained))
+                self._drained_total += drained
+                self._trim_drained(now)
+            return lease is not None or queued
+
+    def renew(self, task_id: int) -> bool:
+        """任務仍在處理中 (非最終狀態回報)：延長 lease。"""
+        with self._lock:
+            lease = self._leases.get(task_id)
+            if lease is None:
+                return False
+            lease.expires_at = time.monotonic() + self.lease_timeout_s
+            return True
+
+    def retry(self, task: Dict[str, Any], delay_s: float):
+        """訂票失敗但仍可重試：結束 lease，delay_s 秒後重新排入佇列。"""
+        with self._lock:
+            self._leases.pop(task["id"], None)
+            self._enqueue(task.copy(), not_before=time.monotonic() + delay_s)
+
+    def _reclaim_expired(self) -> int:
+        # 呼叫端需持有 self._lock。逾期的任務依原本的優先順序放回佇列。
+        now = time.monotonic()
+        # 結束中的 lease (最終結果寫入中) 不回收：否則合併 job 的成員會重新排入佇列，
+        # 之後 complete(主訂票) 只移除主訂票，其他乘客會被再訂一次
+        expired = [task_id for task_id, lease in self._leases.items()
+                   if lease.expires_at <= now and not lease.closing]
+        for task_id in expired:
+            lease = self._leases.pop(task_id)
+            for task in lease.tasks:
+                self._enqueue(task)
+            log.warning("lease_expired", task_id=task_id, worker_id=lease.worker_id, requeued=len(lease.tasks))
+        return len(expired)
+
+    def _reap_loop(self):
+        interval = max(1, min(5, self.lease_timeout_s // 10))
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                self._reclaim_expired()
+                self._promote_delayed()
+                self._dispatch_to_idle()
+
+    # --- worker 端 ---
+    def poll(self, worker_id: str, timeout: float, max_tasks: Optional[int] = None,
+             max_group_size: int = 1) -> Dict[str, Any]:
+        """
+        worker 的 long poll：最多認領 max_tasks 個 job，有任務立即回傳，否則最多等待 timeout 秒。
+        max_group_size > 1 表示 worker 支援多乘客 job (舊版 worker 一律收到單筆任務)。
+        """
+        max_tasks = max(1, max_tasks or self.batch_size)
+        waiter = _Waiter(max_tasks, max_group_size)
+        with self._lock:
+            self._reclaim_expired()
+            self._expire_workers()
+            worker = self._workers.get(worker_id)
+            if worker is None:
+                worker = self._workers[worker_id] = _Worker(worker_id)
+            worker.last_seen = time.monotonic()
+
+            if worker.waiter is not None:
+                # 同一個 worker 重新連線：只中斷它自己前一個 poll。不論這次是否立即取得任務都要先釋放，
+                # 否則之後 submit 的任務會派給已被放棄的 poll，直到 lease 逾時才回到佇列
+                worker.waiter.response = {"status": "forced_reconnect", "message": "New poll initiated. Please re-poll immediately."}
+                worker.waiter.event.set()
+                worker.waiter = None
+
+            response = self._take(worker, max_tasks, max_group_size)
+            if response:
+                return response
+            worker.waiter = waiter
+
+        waiter.event.wait(timeout=timeout)
+
+        with self._lock:
+            if worker.waiter is waiter:
+                worker.waiter = None
+            worker.last_seen = time.monotonic()
+            if waiter.response:
+                return waiter.response
+        return {"status": "timeout", "message": "No new events."}
+
+    def _expire_workers(self):
+        # 呼叫端需持有 self._lock
+        now = time.monotonic()
+        for worker_id, worker in list(self._workers.items()):
+            if worker.waiter is None and now - worker.last_seen > self.worker_expiry_s:
+                del self._workers[worker_id]
+
+    def _trim_drained(self, now: float):
+        # 呼叫端需持有 self._lock
+        while self._drained and self._drained[0][0] <= now - self.drain_window_s:
+            self._drained_total -= self._drained.popleft()[1]
+
+    # --- 狀態 ---
+    def pending_count(self) -> int:
+        """待處理的任務數：佇列中 (含等待重試) + 已派出處理中。"""
+        with self._lock:
+            return len(self._queued) + sum(len(lease.tasks) for lease in self._leases.values())
+
+    def drain_rate(self) -> float:
+        """最近 drain_window_s 秒內平均每秒完成的任務數。"""
+        with self._lock:
+            now = time.monotonic()
+            self._trim_drained(now)
+            # 剛啟動時以實際經過時間計算，但至少 DRAIN_MIN_WINDOW_S 秒，避免前幾筆完成時高估速度
+            window = max(min(self.drain_window_s, now - self._started), min(DRAIN_MIN_WINDOW_S, self.drain_window_s))
+            return self._drained_total / window
+
+    def backlog_size(self) -> int:
+        with self._lock:
+            return len(self._queued)
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._leases)
+
+    def waiting_workers(self) -> int:
+        with self._lock:
+            return sum(1 for w in self._workers.values() if w.waiter is not None)
@@ -0,0 +1,66 @@
+# =======================================================
+# event_hub.py - Server-Sent Events 廣播中心
+# =======================================================
+#
+# 每個 SSE 連線訂閱一個有上限的佇列；publish() 只格式化一次訊息再放進
+# 所有佇列。跟不上的訂閱者 (佇列已滿) 會被移除並收到 None，由串流端
+# 重新訂閱並送出完整快照 (reset)，避免拖慢發佈端。
+
+import json
+import queue
+import threading
+from typing import Dict, Any, Set
+
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class EventHub:
+    def __init__(self, max_queue: int = 100):
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._subscribers: Set[queue.Queue] = set()
+
+    def subscribe(self) -> queue.Queue:
+        q = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q: queue.Queue):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def has_subscribers(self) -> bool:
+        return bool(self._subscribers)
+
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, event: str, data: Dict[str, Any]):
+        message = format_sse(event, data)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # 消費太慢：丟棄它累積的事件，要求重新同步
+                self._evict(q)
+
+    def resync(self):
+        """要求所有訂閱者重新訂閱並送出完整快照 (例如上游事件來源斷線重連，期間的事件可能遺漏)。"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            self._evict(q)
+
+    def _evict(self, q: queue.Queue):
+        self.unsubscribe(q)
+        try:
+            while True:
+                q.get_nowait()
+        except queue.Empty:
+            pass
+        q.put_nowait(None)
@@ -0,0 +1,94 @@
+# =======================================================
+# gunicorn.conf.py - 多 worker 時啟動跨程序協調的 broker
+# =======================================================
+#
+# gunicorn 啟動時會自動讀取目前目錄下的這個檔案。--workers 大於 1 時 (或已設定 THSR_BROKER_SOCKET)，
+# 在 fork web worker 之前先啟動 `python app.py --broker <socket>` 子程序持有 store 與 dispatcher，
+# 再把 socket 路徑放進 THSR_BROKER_SOCKET，之後 fork 出的 worker 都改為透過 broker 存取 (見 coordinator.py)。
+# master 中的監看執行緒在 broker 結束時以同一個 socket 路徑重新啟動它 (worker 會自動重新連線)；
+# 短時間內反覆結束時改為停止整個 gunicorn，交由部署平台重啟服務。
+
+import os
+import sys
+import time
+import signal
+import tempfile
+import threading
+import subprocess
+
+# 等待 broker 載入資料並開始 listen 的上限秒數
+BROKER_START_TIMEOUT_S = 60
+BROKER_STOP_TIMEOUT_S = 10
+# broker 結束後等待多久再重啟；BROKER_RESTART_WINDOW_S 秒內重啟超過 BROKER_MAX_RESTARTS 次則停止 gunicorn
+BROKER_RESTART_DELAY_S = 1
+BROKER_RESTART_WINDOW_S = 60
+BROKER_MAX_RESTARTS = 5
+
+
+def start_broker(socket_path: str) -> subprocess.Popen:
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    # broker 本身不能帶 THSR_BROKER_SOCKET，否則 app.py 會把它當成 broker 的 client
+    env = {key: value for key, value in os.environ.items() if key != "THSR_BROKER_SOCKET"}
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    broker = subprocess.Popen([sys.executable, app_path, "--broker", socket_path], env=env)
+    deadline = time.monotonic() + BROKER_START_TIMEOUT_S
+    while not os.path.exists(socket_path):
+        if broker.poll() is not None or time.monotonic() > deadline:
+            broker.kill()
+            raise RuntimeError(f"broker failed to start (exit code {broker.poll()})")
+        time.sleep(0.1)
+    return broker
+
+
+def watch_broker(server):
+    socket_path = server.thsr_broker_socket
+    restarts = []
+    while True:
+        code = server.thsr_broker.wait()
+        if server.thsr_broker_stopping.is_set():
+            return
+        now = time.monotonic()
+        restarts = [t for t in restarts if now - t < BROKER_RESTART_WINDOW_S] + [now]
+        if len(restarts) > BROKER_MAX_RESTARTS:
+            server.log.error("broker exited %d times within %ds; stopping gunicorn", len(restarts), BROKER_RESTART_WINDOW_S)
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+        server.log.warning("broker exited (code %s); restarting", code)
+        time.sleep(BROKER_RESTART_DELAY_S)
+        if server.thsr_broker_stopping.is_set():
+            return
+        try:
+            server.thsr_broker = start_broker(socket_path)
+        except (OSError, RuntimeError) as e:
+            server.log.error("broker restart failed: %s; stopping gunicorn", e)
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+        server.log.info("broker restarted: pid=%s socket=%s", server.thsr_broker.pid, socket_path)
+
+
+def on_starting(server):
+    socket_path = os.environ.get("THSR_BROKER_SOCKET")
+    if server.cfg.workers <= 1 and not socket_path:
+        return
+    socket_path = socket_path or os.path.join(tempfile.gettempdir(), f"thsr-broker-{os.getpid()}.sock")
+    server.thsr_broker = start_broker(socket_path)
+    server.thsr_broker_socket = socket_path
+    server.thsr_broker_stopping = threading.Event()
+    os.environ["THSR_BROKER_SOCKET"] = socket_path
+    server.log.info("broker started: pid=%s socket=%s", server.thsr_broker.pid, socket_path)
+    threading.Thread(target=watch_broker, args=(server,), name="broker-watcher", daemon=True).start()
+
+
+def on_exit(server):
+    if not hasattr(server, "thsr_broker"):
+        return
+    server.thsr_broker_stopping.set()
+    broker, socket_path = server.thsr_broker, server.thsr_broker_socket
+    broker.terminate()
+    try:
+        broker.wait(BROKER_STOP_TIMEOUT_S)
+    except subprocess.TimeoutExpired:
+        broker.kill()
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
@@ -0,0 +1,209 @@
+# =======================================================
+# jsonlog.py - 非阻塞的結構化 (JSON Lines) 日誌
+# =======================================================
+#
+# 取代各處直接 print 的日誌：
+#   - 每筆日誌是一行 JSON: {"ts", "level", "subsystem", "event", ...欄位}
+#   - 每個子系統 (http / poll / dispatch / store ...) 有各自的等級，
+#     由 THSR_LOG_LEVEL (預設) 與 THSR_LOG_LEVELS="poll=warning,store=debug" 設定
+#   - 呼叫端只把 record 放進有上限的緩衝區就返回；由背景的原生執行緒
+#     (gevent 下不是 greenlet) 序列化並寫到 stdout，stdout 變慢不會卡住 worker
+#   - 緩衝區超過 3/4 時 info 以下的日誌改為抽樣 (每 LOG_SAMPLE_EVERY 筆留 1 筆)，
+#     滿了則直接丟棄；丟棄 / 抽樣掉的筆數由背景執行緒定期以一筆 log_dropped 回報
+#   - 高頻事件 (例如每次 poll) 用 summary()：只累計次數，每 interval_s 秒輸出一筆彙總
+
+import os
+import sys
+import json
+import time
+import atexit
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, Any, Tuple
+
+try:
+    from gevent import monkey as _gevent_monkey
+except ImportError:
+    _gevent_monkey = None
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+LOG_QUEUE_SIZE = int(os.environ.get("THSR_LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_EVERY = 10
+LOG_FLUSH_INTERVAL_S = 0.1
+LOG_DEFAULT_LEVEL = os.environ.get("THSR_LOG_LEVEL", "info").lower()
+
+
+def parse_levels(spec: str) -> Dict[str, int]:
+    """'poll=warning,store=debug' -> {"poll": 30, "store": 10}；無法辨識的項目略過。"""
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip().lower() in LEVELS:
+            levels[name.strip()] = LEVELS[level.strip().lower()]
+    return levels
+
+SUBSYSTEM_LEVELS = parse_levels(os.environ.get("THSR_LOG_LEVELS", ""))
+
+
+def _native_thread_api() -> Tuple[Any, Any, Any]:
+    # gevent monkey patch 後 threading.Thread 是 greenlet，阻塞的 write 仍會卡住整個 hub；
+    # 寫入執行緒需要用未被 patch 的原生執行緒、sleep 與 lock (gevent 的 lock 不能跨原生執行緒使用)。
+    if _gevent_monkey is not None and _gevent_monkey.is_module_patched("threading"):
+        get_original = _gevent_monkey.get_original
+        return (get_original("_thread", "start_new_thread"), get_original("time", "sleep"),
+                get_original("_thread", "allocate_lock"))
+    import _thread
+    return _thread.start_new_thread, time.sleep, _thread.allocate_lock
+
+
+class LogWriter:
+    """背景寫入器：deque 的 append / popleft 在原生執行緒與 greenlet 之間皆為原子操作，不需 lock。"""
+
+    def __init__(self, stream=None, max_queue: int = LOG_QUEUE_SIZE,
+                 sample_every: int = LOG_SAMPLE_EVERY, flush_interval_s: float = LOG_FLUSH_INTERVAL_S):
+        self.stream = stream or sys.stdout
+        self.max_queue = max_queue
+        self.sample_every = sample_every
+        self.flush_interval_s = flush_interval_s
+        self._buffer: deque = deque()
+        self._sample_counter = 0
+        self.dropped = 0   # 累計丟棄 / 抽樣掉的筆數 (供 /metrics)
+        self._dropped_reported = 0
+        self._summaries: Dict[Tuple[str, str], list] = {}
+        self._start_new_thread, self._sleep, allocate_lock = _native_thread_api()
+        self._summary_lock = allocate_lock()
+        self._started = False
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        self._start_new_thread(self._run, ())
+        atexit.register(self.flush)
+
+    # --- 呼叫端 (hot path) ---
+    def submit(self, record: Dict[str, Any], level: int):
+        size = len(self._buffer)
+        if size >= self.max_queue:
+            self.dropped += 1
+            return
+        if size >= self.max_queue * 3 // 4 and level < LEVELS["warning"]:
+            self._sample_counter += 1
+            if self._sample_counter % self.sample_every:
+                self.dropped += 1
+                return
+        self._buffer.append(record)
+
+    def count(self, subsystem: str, event: str, interval_s: float, fields: Dict[str, Any]):
+        now = time.monotonic()
+        with self._summary_lock:
+            summary = self._summaries.get((subsystem, event))
+            if summary is None:
+                # [次數, 視窗開始時間, 視窗長度, 最後一筆的欄位]
+                summary = self._summaries[(subsystem, event)] = [0, now, interval_s, None]
+            if summary[0] == 0:
+                summary[1] = now
+            summary[0] += 1
+            summary[3] = fields
+
+    # --- 背景執行緒 ---
+    def _run(self):
+        while True:
+            self._emit_summaries()
+            self._report_dropped()
+            if not self._write_pending():
+                self._sleep(self.flush_interval_s)
+
+    def _emit_summaries(self, force: bool = False):
+        now = time.monotonic()
+        records = []
+        with self._summary_lock:
+            for (subsystem, event), summary in self._summaries.items():
+                count, started, interval_s, fields = summary
+                if count and (force or now - started >= interval_s):
+                    records.append({"ts": time.time(), "level": "info", "subsystem": subsystem, "event": event,
+                                    "summary": True, "count": count, "window_s": round(now - started, 1),
+                                    "last": fields})
+                    summary[0], summary[3] = 0, None
+        self._buffer.extend(records)
+
+    def _report_dropped(self):
+        dropped = self.dropped
+        if dropped != self._dropped_reported:
+            self._buffer.append({"ts": time.time(), "level": "warning", "subsystem": "log", "event": "log_dropped",
+                                 "count": dropped - self._dropped_reported, "total": dropped})
+            self._dropped_reported = dropped
+
+    def _write_pending(self) -> bool:
+        lines = []
+        while self._buffer:
+            record = self._buffer.popleft()
+            record["ts"] = datetime.fromtimestamp(record["ts"], timezone.utc).isoformat(timespec="milliseconds")
+            lines.append(json.dumps(record, ensure_ascii=False, default=str))
+        if not lines:
+            return False
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except (OSError, ValueError):
+            # stdout 已關閉 (例如直譯器結束中)：無法再輸出，直接略過
+            pass
+        return True
+
+    def flush(self):
+        """同步寫出緩衝區中剩下的日誌與未滿一個視窗的彙總 (程式結束時)。"""
+        self._emit_summaries(force=True)
+        self._report_dropped()
+        self._write_pending()
+
+
+class Logger:
+    def __init__(self, writer: LogWriter, subsystem: str):
+        self.writer = writer
+        self.subsystem = subsystem
+        self.level = SUBSYSTEM_LEVELS.get(subsystem, LEVELS.get(LOG_DEFAULT_LEVEL, LEVELS["info"]))
+
+    def enabled(self, level: str) -> bool:
+        return LEVELS[level] >= self.level
+
+    def log(self, level: str, event: str, **fields):
+        level_no = LEVELS[level]
+        if level_no < self.level:
+            return
+        # 只組出 dict 放進緩衝區；時間格式化與 JSON 序列化在背景執行緒進行
+        record = {"ts": time.time(), "level": level, "subsystem": self.subsystem, "event": event}
+        record.update(fields)
+        self.writer.submit(record, level_no)
+
+    def debug(self, event: str, **fields):
+        self.log("debug", event, **fields)
+
+    def info(self, event: str, **fields):
+        self.log("info", event, **fields)
+
+    def warning(self, event: str, **fields):
+        self.log("warning", event, **fields)
+
+    def error(self, event: str, **fields):
+        self.log("error", event, **fields)
+
+    def summary(self, event: str, interval_s: float = 10.0, **fields):
+        """高頻事件：只累計次數，每 interval_s 秒輸出一筆 {"summary": true, "count": n, "last": {...}}。"""
+        if LEVELS["info"] < self.level:
+            return
+        self.writer.count(self.subsystem, event, interval_s, fields)
+
+
+_writer = LogWriter()
+_loggers: Dict[str, Logger] = {}
+
+def get_logger(subsystem: str) -> Logger:
+    logger = _loggers.get(subsystem)
+    if logger is None:
+        logger = _loggers[subsystem] = Logger(_writer, subsystem)
+        _writer.start()
+    return logger
+
+def dropped_records() -> int:
+    return _writer.dropped
@@ -1,18 +1,36 @@
 # =======================================================
 # long_polling_client.py - Long Polling 客戶端 (最終版本)
 # =======================================================
+import os
+import socket
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import gzip
 import json
 import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Dict, Any
 from zoneinfo import ZoneInfo
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # 🚀 導入獨立的模擬函式
-from thsr_booking import simulate_booking
+from thsr_booking import simulate_booking, SOLD_OUT
 
 # 伺服器網址
-SERVER_URL = 'https://flask-thsr.onrender.com' 
+SERVER_URL = os.environ.get("THSR_SERVER_URL", 'https://flask-thsr.onrender.com')
 
 # 客戶端設定
 MAX_NETWORK_LATENCY = 5  # 預估最大網路延遲 (秒)
@@ -21,26 +39,197 @@ CLIENT_TIMEOUT_S = POLLING_INTERVAL + MAX_NETWORK_LATENCY
 MAX_RETRIES = 5 
 RETRY_DELAY_SECONDS = 60 # ⚠️ 已更新：重試延遲時間改為 60 秒
 
+# 任務結果批次回報：累積到 REPORT_BATCH_SIZE 筆或最舊一筆已等待 REPORT_FLUSH_INTERVAL_S 秒即送出
+REPORT_BATCH_SIZE = 20
+REPORT_FLUSH_INTERVAL_S = 2.0
+
+# 同時執行的訂票數上限；每次 poll 只認領目前空閒的名額，認領的任務須在伺服器的 lease 期限內回報結果
+MAX_CONCURRENT_BOOKINGS = int(os.environ.get("THSR_MAX_CONCURRENT_BOOKINGS", "4"))
+
+# 一筆訂票最多可包含的乘客數：伺服器會把同車次 / 日期 / 起訖站的訂票合併成一個 job，
+# 以主訂票 id 回報結果即套用到 job 內的每一筆訂票
+MAX_GROUP_SIZE = int(os.environ.get("THSR_MAX_GROUP_SIZE", "4"))
+
+# 車次售完快取：同車次 / 日期 / 起訖站在 AVAILABILITY_TTL_S 秒內已確認售完時，不再送進訂票系統而直接回報失敗；
+# 最多記住 AVAILABILITY_CACHE_SIZE 組 (超過時淘汰最久未使用者)。TTL 設為 0 停用
+AVAILABILITY_TTL_S = float(os.environ.get("THSR_AVAILABILITY_TTL_S", "60"))
+AVAILABILITY_CACHE_SIZE = int(os.environ.get("THSR_AVAILABILITY_CACHE_SIZE", "1024"))
+
+# 每台訂票機的識別碼 (伺服器依此把任務分派給不同 worker)
+WORKER_ID = os.environ.get("THSR_WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+
+# --- 傳輸格式 (與伺服器端 wire.py 協商) ---
+# 協定版本 2：伺服器只送訂票需要的欄位。回應的壓縮 (gzip，以及 urllib3 支援時的 zstd) 由 requests 自動協商與解壓。
+PROTOCOL_HEADER = "X-THSR-Protocol"
+PROTOCOL_VERSION = 2
+JSON_MIMETYPE = "application/json"
+MSGPACK_MIMETYPE = "application/msgpack"
+# 編碼格式: "auto" (有安裝 msgpack 就用 MessagePack)、"msgpack" 或 "json"
+WIRE_FORMAT = os.environ.get("THSR_WIRE_FORMAT", "auto").lower()
+USE_MSGPACK = msgpack is not None and WIRE_FORMAT in ("auto", "msgpack")
+# 超過此大小的請求本體 (例如批次回報) 在伺服器接受時壓縮後送出
+REQUEST_COMPRESS_MIN_BYTES = 1024
+
+
+class WireFormat:
+    """
+    依伺服器回應標頭 (X-THSR-Protocol / Accept-Post / Accept-Encoding) 記錄伺服器接受的請求格式；
+    在得知之前一律送出未壓縮的 JSON，舊版伺服器不受影響。
+    """
+
+    def __init__(self, use_msgpack: bool = USE_MSGPACK):
+        self.use_msgpack = use_msgpack
+        self.server_protocol = 1
+        self.server_mimetypes = {JSON_MIMETYPE}
+        self.server_encodings = set()
+
+    def request_headers(self) -> Dict[str, str]:
+        accept = f"{MSGPACK_MIMETYPE}, {JSON_MIMETYPE};q=0.9" if self.use_msgpack else JSON_MIMETYPE
+        return {PROTOCOL_HEADER: str(PROTOCOL_VERSION), "Accept": accept}
+
+    def learn(self, response: requests.Response):
+        try:
+            self.server_protocol = int(response.headers.get(PROTOCOL_HEADER, "1"))
+        except ValueError:
+            self.server_protocol = 1
+        self.server_mimetypes = {t.strip() for t in response.headers.get("Accept-Post", JSON_MIMETYPE).split(",")}
+        self.server_encodings = {e.strip() for e in response.headers.get("Accept-Encoding", "").split(",") if e.strip()}
+
+    def encode(self, payload: Dict[str, Any]):
+        """回傳 (請求本體, 額外標頭)。"""
+        headers = {}
+        if self.use_msgpack and MSGPACK_MIMETYPE in self.server_mimetypes:
+            body = msgpack.packb(payload, use_bin_type=True)
+            headers["Content-Type"] = MSGPACK_MIMETYPE
+        else:
+            body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            headers["Content-Type"] = JSON_MIMETYPE
+        if len(body) >= REQUEST_COMPRESS_MIN_BYTES:
+            if zstandard is not None and "zstd" in self.server_encodings:
+                body = zstandard.ZstdCompressor(level=3).compress(body)
+                headers["Content-Encoding"] = "zstd"
+            elif "gzip" in self.server_encodings:
+                body = gzip.compress(body, compresslevel=5)
+                headers["Content-Encoding"] = "gzip"
+        return body, headers
+
+    def decode(self, response: requests.Response) -> Any:
+        self.learn(response)
+        if response.headers.get("Content-Type", "").startswith(MSGPACK_MIMETYPE):
+            return msgpack.unpackb(response.content, raw=False, strict_map_key=False)
+        return response.json()
+
+    def post(self, session: requests.Session, url: str, payload: Dict[str, Any], timeout: float) -> requests.Response:
+        body, headers = self.encode(payload)
+        return session.post(url, data=body, headers=headers, timeout=timeout)
+
+
+wire = WireFormat()
+
+# --- HTTP 連線池 ---
+# Long poll 與結果回報各用一個 Session (各自的 keep-alive 連線池)，
+# 長時間掛著的 poll 不會佔住回報用的連線。
+POLL_POOL_SIZE = 1
+REPORT_POOL_SIZE = 4
+
+def create_session(pool_size: int, retry: Retry) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(wire.request_headers())
+    return session
+
+# Poll 會在伺服器端認領任務，只重試連線建立失敗 (請求尚未送出)；讀取逾時等由主迴圈處理
+poll_session = create_session(POLL_POOL_SIZE, Retry(
+    total=3, connect=3, read=0, status=0, backoff_factor=1,
+))
+
+# 結果回報可安全重送 (每筆回報帶 lease_id，伺服器只套用一次，重複的回報得到 stale 並被忽略)，
+# 連線錯誤與 502/503/504 以指數退避重試
+report_session = create_session(REPORT_POOL_SIZE, Retry(
+    total=5, connect=5, read=2, status=3, backoff_factor=0.5,
+    status_forcelist=(502, 503, 504), allowed_methods=frozenset({"POST"}),
+    respect_retry_after_header=True, raise_on_status=False,
+))
+
 # --- 輔助函式 ---
 
-def update_server_status(task_id: int, status: str, code: str = None) -> bool:
+def result_details(code: str = None, duration_s: float = None, reason: str = None, cached: bool = False) -> Dict[str, Any]:
+    details = {"code": code} if code else {}
+    if duration_s is not None:
+        # 訂票耗時，伺服器彙整在 /metrics 的 thsr_booking_duration_seconds
+        details["duration_s"] = round(duration_s, 3)
+    if reason:
+        # 失敗原因 (例如 sold_out)；cached 表示由售完快取直接判定，沒有實際送出訂票
+        details["reason"] = reason
+        if cached:
+            details["cached"] = True
+    return details
+
+def booking_key(task: Dict[str, Any]) -> tuple:
+    """可共用訂票結果的條件 (與伺服器的 booking_group_key 相同)：同車次、同日期、同起訖站。"""
+    return (task.get("train_no"), task.get("travel_date"), task.get("from_station"), task.get("to_station"))
+
+
+class AvailabilityCache:
+    """最近的訂票結果 (booking_key -> (是否售完, 到期時間))，TTL 到期或超過容量 (LRU) 即淘汰；可由多個訂票執行緒同時使用。"""
+
+    def __init__(self, ttl_s: float = AVAILABILITY_TTL_S, max_entries: int = AVAILABILITY_CACHE_SIZE):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.hits = 0
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_sold_out(self, key: tuple) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            sold_out, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return False
+            self._entries.move_to_end(key)
+            if sold_out:
+                self.hits += 1
+            return sold_out
+
+    def record(self, key: tuple, sold_out: bool):
+        if self.ttl_s <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (sold_out, time.monotonic() + self.ttl_s)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def result_item(task_id: int, status: str, lease_id: str = None, details: Dict[str, Any] = None) -> Dict[str, Any]:
+    item = {"task_id": task_id, "status": status, "details": details or {}}
+    if lease_id:
+        # 伺服器據此確認這筆回報屬於目前的 lease (舊版伺服器不送 lease_id，也就不帶)
+        item["lease_id"] = lease_id
+    return item
+
+def update_server_status(task_id: int, status: str, code: str = None, duration_s: float = None,
+                         reason: str = None, cached: bool = False, lease_id: str = None) -> bool:
     """
     將訂票結果回傳給伺服器，以便從待處理佇列中移除任務。
     """
     url = f'{SERVER_URL}/update_status'
-    details = {"code": code} if code else {}
-    
-    update_payload = {
-        "task_id": task_id,
-        "status": status,
-        "details": details
-    }
+    update_payload = result_item(task_id, status, lease_id, result_details(code, duration_s, reason, cached))
     
     try:
-        response = requests.post(url, json=update_payload, timeout=5) 
+        response = wire.post(report_session, url, update_payload, timeout=5)
+        if response.status_code == 409:
+            # 重複或 lease 已過期的回報：伺服器已忽略，不需重送
+            print(f"[{time.strftime('%H:%M:%S')}] ⚠️ STALE: Result for Task {task_id} ignored by server. {wire.decode(response).get('message')}")
+            return True
         response.raise_for_status() 
         
-        result = response.json()
+        result = wire.decode(response)
         if result.get("status") == "success":
             return True
         else:
@@ -52,19 +241,154 @@ def update_server_status(task_id: int, status: str, code: str = None) -> bool:
         return False
 
 
+class StatusReporter:
+    """
+    累積任務結果，以 /update_status_batch 一次回報多筆 (可由多個訂票執行緒同時呼叫)。
+    伺服器不支援批次端點時 (404)，退回逐筆呼叫 /update_status。
+    """
+
+    def __init__(self, batch_size: int = REPORT_BATCH_SIZE, flush_interval_s: float = REPORT_FLUSH_INTERVAL_S):
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.pending: List[Dict[str, Any]] = []
+        self.oldest_at = None
+        self.batch_supported = True
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def report(self, task_id: int, status: str, code: str = None, duration_s: float = None,
+               reason: str = None, cached: bool = False, lease_id: str = None):
+        with self._lock:
+            self.pending.append(result_item(task_id, status, lease_id, result_details(code, duration_s, reason, cached)))
+            if self.oldest_at is None:
+                self.oldest_at = time.monotonic()
+            due = len(self.pending) >= self.batch_size
+        if due:
+            self.flush()
+
+    def start_background_flush(self):
+        """背景執行緒：最舊的結果等待超過 flush_interval_s 即送出 (主執行緒可能正卡在 long poll)。"""
+        def loop():
+            while True:
+                time.sleep(self.flush_interval_s / 2)
+                with self._lock:
+                    due = self.oldest_at is not None and time.monotonic() - self.oldest_at >= self.flush_interval_s
+                if due:
+                    self.flush()
+        threading.Thread(target=loop, name="status-reporter", daemon=True).start()
+
+    def flush(self):
+        # 一次只有一個執行緒在送出結果，避免同一任務的回報順序顛倒
+        with self._flush_lock:
+            with self._lock:
+                if not self.pending:
+                    return
+                batch, self.pending, self.oldest_at = self.pending, [], None
+            self._send(batch)
+
+    def _send(self, batch: List[Dict[str, Any]]):
+        if not self.batch_supported:
+            for item in batch:
+                details = item["details"]
+                if not update_server_status(item["task_id"], item["status"], details.get("code"), details.get("duration_s"),
+                                            details.get("reason"), details.get("cached", False), item.get("lease_id")):
+                    print(f"[{time.strftime('%H:%M:%S')}] 🚨 CRITICAL: Task {item['task_id']} result not confirmed by server. It remains in the queue.")
+            return
+
+        try:
+            response = wire.post(report_session, f'{SERVER_URL}/update_status_batch', {"results": batch}, timeout=10)
+            if response.status_code == 404:
+                print(f"[{time.strftime('%H:%M:%S')}] ⚠️ Server has no batch endpoint. Falling back to per-task updates.")
+                self.batch_supported = False
+                self._send(batch)
+                return
+            response.raise_for_status()
+
+            for result in wire.decode(response).get("results", []):
+                if result.get("status") == "stale":
+                    print(f"[{time.strftime('%H:%M:%S')}] ⚠️ STALE: Result for Task {result.get('task_id')} ignored by server ({result.get('message')}).")
+                elif result.get("status") != "success":
+                    print(f"[{time.strftime('%H:%M:%S')}] 🚨 CRITICAL: Task {result.get('task_id')} result not confirmed by server ({result.get('message')}). It remains in the queue.")
+
+        except requests.exceptions.RequestException as e:
+            # 保留這批結果，下次 flush 時重送
+            print(f"[{time.strftime('%H:%M:%S')}] 🚨 NETWORK ERROR: Failed to report {len(batch)} task results. {e}")
+            with self._lock:
+                self.pending = batch + self.pending
+                self.oldest_at = time.monotonic()
+
+
+class BookingPool:
+    """
+    以有上限的執行緒池同時執行多筆訂票；每筆完成即交給 StatusReporter 回報，
+    主執行緒可在訂票進行中繼續 long poll。
+    """
+
+    def __init__(self, reporter: StatusReporter, availability: AvailabilityCache,
+                 max_concurrent: int = MAX_CONCURRENT_BOOKINGS):
+        self.reporter = reporter
+        self.availability = availability
+        self.max_concurrent = max(1, max_concurrent)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix="booking")
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def free_slots(self) -> int:
+        with self._cond:
+            return max(0, self.max_concurrent - self._in_flight)
+
+    def wait_for_slot(self):
+        with self._cond:
+            while self._in_flight >= self.max_concurrent:
+                self._cond.wait()
+
+    def submit(self, task: Dict[str, Any]):
+        with self._cond:
+            self._in_flight += 1
+        self.executor.submit(self._run, task)
+
+    def _run(self, task: Dict[str, Any]):
+        task_id = task.get("id")
+        key = booking_key(task)
+        try:
+            if self.availability.is_sold_out(key):
+                # 同車次剛確認售完：不佔用訂票系統，直接回報失敗 (伺服器依重試策略稍後再排入)
+                print(f"[{time.strftime('%H:%M:%S')}] ⏩ SOLD OUT (cached): Task {task_id} train {key[0]} on {key[1]}.")
+                self.reporter.report(task_id, "failed", reason=SOLD_OUT, cached=True, lease_id=task.get("lease_id"))
+                return
+            # 執行模擬訂票 (從 thsr_booking 模組導入)
+            started = time.monotonic()
+            new_status, booking_code, failure_reason = simulate_booking(task)
+            if new_status == "booked" or failure_reason == SOLD_OUT:
+                self.availability.record(key, sold_out=failure_reason == SOLD_OUT)
+            self.reporter.report(task_id, new_status, booking_code, time.monotonic() - started, failure_reason,
+                                 lease_id=task.get("lease_id"))
+        except Exception as e:
+            # 不回報這筆任務：lease 逾時後由伺服器重新排入佇列
+            print(f"[{time.strftime('%H:%M:%S')}] ❌ BOOKING ERROR: Task {task_id} raised {e}.")
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def shutdown(self):
+        """停止接受新任務，等待執行中的訂票完成後送出所有結果。"""
+        print(f"[{time.strftime('%H:%M:%S')}] ⏳ Draining {self.max_concurrent - self.free_slots()} in-flight bookings...")
+        self.executor.shutdown(wait=True)
+        self.reporter.flush()
+
+
+reporter = StatusReporter()
+availability_cache = AvailabilityCache()
+booking_pool = BookingPool(reporter, availability_cache)
+
+
 def process_and_report_tasks(tasks_list: List[Dict[str, Any]]):
     """
-    遍歷任務列表，處理每一筆任務並回傳結果。
+    將任務交給訂票執行緒池；每筆完成後結果會自動批次回傳。
     """
     for task in tasks_list:
-        task_id = task.get("id")
-        
-        # 1. 執行模擬訂票 (從 thsr_booking 模組導入)
-        new_status, booking_code = simulate_booking(task)
-        
-        # 2. 回傳狀態給伺服器
-        if not update_server_status(task_id, new_status, booking_code):
-            print(f"[{time.strftime('%H:%M:%S')}] 🚨 CRITICAL: Task {task_id} result not confirmed by server. It remains in the queue.")
+        booking_pool.submit(task)
 
 
 # --- 核心 Long Polling 邏輯 ---
@@ -73,12 +397,19 @@ def start_polling():
     poll_url = f'{SERVER_URL}/poll_for_update'
     retry_count = 0
     
-    print(f"[{time.strftime('%H:%M:%S')}] 🚀 Client starting Long Polling loop for server: {SERVER_URL}")
+    print(f"[{time.strftime('%H:%M:%S')}] 🚀 Client {WORKER_ID} starting Long Polling loop for server: {SERVER_URL} ({MAX_CONCURRENT_BOOKINGS} concurrent bookings)")
+    reporter.start_background_flush()
 
     while retry_count < MAX_RETRIES:
         try:
+            # 0. 訂票名額全滿時，等到有空閒名額再認領新任務
+            booking_pool.wait_for_slot()
+
             # 1. 準備請求 payload
             payload = {
+                "worker_id": WORKER_ID,
+                "max_tasks": booking_pool.free_slots(),
+                "max_group_size": MAX_GROUP_SIZE,
                 "client_timeout_s": CLIENT_TIMEOUT_S,
                 "timestamp": datetime.now(ZoneInfo("Asia/Taipei")).isoformat() 
             }
@@ -86,15 +417,16 @@ def start_polling():
             print(f"[{time.strftime('%H:%M:%S')}] Client initiating request (POST). Request timeout: {CLIENT_TIMEOUT_S}s.")
             
             # 2. 發起 Long Polling 請求
-            response = requests.post(
+            response = wire.post(
+                poll_session,
                 poll_url, 
-                json=payload, 
+                payload, 
                 timeout=CLIENT_TIMEOUT_S + 30  # 額外緩衝時間
             )
             response.raise_for_status() 
             
-            # 3. 解析響應
-            data = response.json()
+            # 3. 解析響應 (JSON 或 MessagePack)
+            data = wire.decode(response)
             status = data.get('status')
             
             # ⚠️ 依要求：立即印出回傳的 status
@@ -145,4 +477,9 @@ def start_polling():
 
 
 if __name__ == "__main__":
-    start_polling()
\ No newline at end of file
+    try:
+        start_polling()
+    except KeyboardInterrupt:
+        print(f"[{time.strftime('%H:%M:%S')}] 🛑 Interrupted. Shutting down client.")
+    finally:
+        booking_pool.shutdown()
\ No newline at end of file
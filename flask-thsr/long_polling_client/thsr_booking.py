@@ -1,38 +1,54 @@
 # =======================================================
 # thsr_booking.py - 模擬訂票系統
-# 負責實際的訂票邏輯 (50% 成功率)
+# 負責實際的訂票邏輯 (預設 50% 成功率)
 # =======================================================
+import os
 import time
 import random
 from typing import Dict, Any
 
-def simulate_booking(task: Dict[str, Any]) -> (str, str):
+# 模擬訂票的耗時與成功率 (benchmark 可透過環境變數調整)
+SIMULATED_BOOKING_MIN_S = float(os.environ.get("THSR_SIM_BOOKING_MIN_S", "1.5"))
+SIMULATED_BOOKING_MAX_S = float(os.environ.get("THSR_SIM_BOOKING_MAX_S", "3.0"))
+SIMULATED_SUCCESS_RATE = float(os.environ.get("THSR_SIM_SUCCESS_RATE", "0.5"))
+
+# 訂票失敗的原因：模擬的訂票系統只會因為該車次已無座位而失敗
+SOLD_OUT = "sold_out"
+
+def simulate_booking(task: Dict[str, Any]) -> (str, str, str):
     """
-    模擬實際的訂票邏輯，成功率為 50%。
+    模擬實際的訂票邏輯，成功率預設為 50% (THSR_SIM_SUCCESS_RATE)。
     
     Args:
-        task: 包含任務資訊的字典 (例如: {"id": 1, "name": "Taipei to Kaohsiung"})
+        task: 包含任務資訊的字典 (例如: {"id": 1, "name": "Taipei to Kaohsiung"})；
+              合併的多乘客 job 另有 "passengers" 列表，一次訂完所有乘客
         
     Returns:
-        (new_status, booking_code) 元組。
+        (new_status, booking_code, failure_reason) 元組；成功時 failure_reason 為 None，
+        失敗時為 SOLD_OUT (該車次 / 日期 / 起訖站已無座位)。
     """
     task_id = task.get("id")
     task_name = task.get("name", "Unknown Task")
+    passengers = task.get("passengers")
+    if passengers:
+        task_name = ", ".join(p.get("name") or "?" for p in passengers)
     
     print(f"[Booking Engine] ⏳ TASK {task_id}: Simulating booking for {task_name}...")
     
-    # 模擬隨機延遲 (0.5 到 3 秒)
-    time.sleep(1 + random.uniform(0.5, 2.0)) 
+    # 模擬隨機延遲 (預設 1.5 到 3 秒)
+    time.sleep(random.uniform(SIMULATED_BOOKING_MIN_S, SIMULATED_BOOKING_MAX_S))
     
-    # 模擬 50% 成功率
-    if random.random() < 0.5: 
+    # 模擬成功率 (預設 50%)
+    if random.random() < SIMULATED_SUCCESS_RATE: 
         new_status = "booked"
         # 根據 ID 模擬一個訂位代號
         booking_code = f"T{task_id:04d}A{random.randint(10, 99)}"
+        failure_reason = None
         print(f"[Booking Engine] ✅ TASK {task_id}: Booking SUCCESS. Code: {booking_code}")
     else:
         new_status = "failed"
         booking_code = None
-        print(f"[Booking Engine] ❌ TASK {task_id}: Booking FAILED (50% chance).")
+        failure_reason = SOLD_OUT
+        print(f"[Booking Engine] ❌ TASK {task_id}: Booking FAILED (sold out).")
 
-    return new_status, booking_code
\ No newline at end of file
+    return new_status, booking_code, failure_reason
\ No newline at end of file
@@ -0,0 +1,207 @@
+# =======================================================
+# metrics.py - Prometheus 文字格式的內建指標
+# =======================================================
+#
+# 不依賴 prometheus_client：只實作本專案用得到的 Histogram / Gauge，
+# 由 /metrics 端點輸出 text exposition format (version 0.0.4)。
+#   - Histogram: 累積的 bucket 計數 + _sum / _count，可依 label 分組
+#   - Gauge: 以 callback 在輸出時取值 (例如佇列長度)，不必在每次異動時更新
+#   - ProcessSnapshots: 多程序部署時加總各程序送來的快照 (見 coordinator.py 的 metrics.push)
+
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Collection, Dict, List, Optional, Tuple
+
+# 秒數類指標的預設 bucket：涵蓋 1ms 的檔案 I/O 到 10 分鐘的 long poll
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._lock = threading.Lock()
+        # label 值 -> [各 bucket 計數 (非累積), sum, count]
+        self._series: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> List[List]:
+        """目前所有 series 的 [label 值, 各 bucket 計數, sum, count]，可 JSON 序列化。"""
+        with self._lock:
+            return [[list(key), list(s[0]), s[1], s[2]] for key, s in self._series.items()]
+
+    def merge(self, snapshot: List[List]):
+        """加上另一個程序同名 histogram 的 snapshot() (bucket 必須相同)。"""
+        with self._lock:
+            for key, counts, total, count in snapshot:
+                series = self._series.setdefault(tuple(key), [[0] * len(self.buckets), 0.0, 0])
+                for i, bucket_count in enumerate(counts):
+                    series[0][i] += bucket_count
+                series[1] += total
+                series[2] += count
+
+    def copy(self) -> "Histogram":
+        other = Histogram(self.name, self.documentation, self.labelnames, self.buckets[:-1])
+        other.merge(self.snapshot())
+        return other
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, [list(s[0]), s[1], s[2]]) for key, s in self._series.items())
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def value(self) -> Optional[float]:
+        try:
+            return self.function()
+        except Exception:
+            # 單一 callback 失敗不能讓整個 /metrics 失敗
+            return None
+
+    def render(self) -> List[str]:
+        value = self.value()
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge",
+                f"{self.name} {_format_value(value)}"]
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, function: Callable[[], float]) -> Gauge:
+        # 同名 gauge 重新註冊時以新的 callback 取代 (例如切換 store 後重建 dispatcher)
+        return self.register(Gauge(name, documentation, function))
+
+    def select(self, only: Optional[Collection[str]] = None, exclude: Collection[str] = ()) -> List:
+        # only / exclude 依指標名稱篩選 (多程序時分別由各自量測的程序輸出)
+        with self._lock:
+            return [metric for name, metric in self._metrics.items()
+                    if (only is None or name in only) and name not in exclude]
+
+    def render(self, only: Optional[Collection[str]] = None, exclude: Collection[str] = ()) -> str:
+        lines = []
+        for metric in self.select(only, exclude):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self, only: Optional[Collection[str]] = None) -> Dict[str, Any]:
+        """指標名稱 -> histogram 的 snapshot() 或 gauge 目前的值 (取值失敗的 gauge 略過)。"""
+        snapshot = {}
+        for metric in self.select(only):
+            value = metric.snapshot() if isinstance(metric, Histogram) else metric.value()
+            if value is not None:
+                snapshot[metric.name] = value
+        return snapshot
+
+
+class ProcessSnapshots:
+    """保存其他程序最近一次送來的 Registry.snapshot()，輸出時與本程序的值加總。
+
+    histogram 是累積值：程序結束後仍保留它最後一次的快照，加總的計數不會倒退；
+    gauge 是當下的值：只計入 gauge_ttl_s 秒內還有回報的程序。
+    """
+
+    def __init__(self, registry: Registry, gauge_ttl_s: float):
+        self.registry = registry
+        self.gauge_ttl_s = gauge_ttl_s
+        self._lock = threading.Lock()
+        # 程序 id -> (收到的時間, snapshot)
+        self._snapshots: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+    def update(self, process_id: str, snapshot: Dict[str, Any]):
+        with self._lock:
+            self._snapshots[process_id] = (time.monotonic(), snapshot)
+
+    def render(self, only: Optional[Collection[str]] = None) -> str:
+        now = time.monotonic()
+        with self._lock:
+            snapshots = list(self._snapshots.values())
+        lines = []
+        for metric in self.registry.select(only):
+            if isinstance(metric, Histogram):
+                total = metric.copy()
+                for _, snapshot in snapshots:
+                    if metric.name in snapshot:
+                        total.merge(snapshot[metric.name])
+                lines.extend(total.render())
+            else:
+                values = [metric.value()] + [snapshot.get(metric.name) for received, snapshot in snapshots
+                                             if now - received <= self.gauge_ttl_s]
+                value = sum(v for v in values if v is not None)
+                lines.extend(Gauge(metric.name, metric.documentation, lambda: value).render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# 各模組共用的指標
+STORE_IO_SECONDS = REGISTRY.histogram(
+    "thsr_store_io_seconds", "Time spent reading or writing JSON snapshot files.", ("op", "file"))
+PUSH_TO_PICKUP_SECONDS = REGISTRY.histogram(
+    "thsr_push_to_pickup_seconds", "Delay from submitting a new booking task to a worker claiming it.")
@@ -0,0 +1,34 @@
+import os
+import sys
+import importlib
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """在暫存目錄中載入 app 模組 (載入時建立的 store 不供測試使用，見 app_env)。"""
+    os.environ.pop("THSR_BROKER_SOCKET", None)
+    os.environ["TICKET_STORE_BACKEND"] = "journal"
+    os.chdir(tmp_path_factory.mktemp("import"))
+    return importlib.import_module("app")
+
+
+@pytest.fixture
+def app_env(app_module, tmp_path, monkeypatch):
+    """每個測試各自的 store / dispatcher / admission (資料檔在 tmp_path)，測試之間不共用狀態。"""
+    monkeypatch.chdir(tmp_path)
+    store = app_module.create_store("journal")
+    dispatcher = app_module.create_dispatcher(store)
+    monkeypatch.setattr(app_module, "store", store)
+    monkeypatch.setattr(app_module, "dispatcher", dispatcher)
+    monkeypatch.setattr(app_module, "admission", app_module.create_admission(dispatcher))
+    monkeypatch.setattr(app_module, "pending_table_cache", None)
+    return app_module
+
+
+@pytest.fixture
+def client(app_env):
+    return app_env.app.test_client()
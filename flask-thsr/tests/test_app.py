@@ -0,0 +1,98 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+TICKET_STATUS_PENDING = "待處理"
+
+TICKET_FORM = {
+    "name": "王小明",
+    "id_number": "A123456789",
+    "train_no": "0803",
+    "travel_date": "2030-01-15",
+    "from_station": "台北",
+    "from_time": "08:00",
+    "to_station": "台中",
+    "to_time": "09:00",
+}
+
+
+def poll(client, worker_id, wait_s=2):
+    """以 worker 的實際欄位發出 long poll；佇列為空時最多等待約 wait_s 秒。"""
+    import app  # 已由 app_module fixture 在暫存目錄中載入
+    return client.post("/poll_for_update", json={
+        "worker_id": worker_id,
+        "client_timeout_s": wait_s + app.MAX_NETWORK_LATENCY,
+        "timestamp": datetime.now(ZoneInfo("Asia/Taipei")).isoformat(),
+    })
+
+
+def submit_and_poll(client, worker_id="w1"):
+    """提交一筆訂票並由 worker 取走，回傳 (task_id, job)。"""
+    ticket_id = client.post("/api/submit_ticket", json=TICKET_FORM).get_json()["task_id"]
+    job = poll(client, worker_id).get_json()["data"]
+    assert job["id"] == ticket_id
+    return ticket_id, job
+
+
+def test_form_submit_is_dispatched_to_workers(app_env, client):
+    response = client.post("/", data=TICKET_FORM)
+    assert response.status_code == 302
+
+    [ticket] = app_env.store.list_pending()
+    ticket_id = ticket["id"]
+    assert app_env.dispatcher.backlog_size() == 1
+
+    payload = poll(client, "w1").get_json()
+    jobs = payload["data"] if isinstance(payload["data"], list) else [payload["data"]]
+    assert [job["id"] for job in jobs] == [ticket_id]
+
+
+def test_repeated_failed_report_is_applied_once(app_env, client):
+    ticket_id, job = submit_and_poll(client)
+
+    report = {"task_id": ticket_id, "status": "failed", "lease_id": job["lease_id"]}
+    first = client.post("/update_status", json=report)
+    assert first.status_code == 200
+    # client 重送同一結果、或不帶 lease_id 的過期回報：都不再計入失敗次數
+    for duplicate in (report, report, {"task_id": ticket_id, "status": "failed"}):
+        assert client.post("/update_status", json=duplicate).status_code == 409
+
+    ticket = app_env.store.get_ticket(ticket_id)
+    assert ticket["attempts"] == 1
+    assert ticket["status"] == app_env.RETRY_PENDING_STATUS
+
+
+def test_poll_honours_client_timeout(client):
+    started = datetime.now()
+    response = poll(client, "idle-worker", wait_s=1)
+    assert response.get_json()["status"] == "timeout"
+    assert (datetime.now() - started).total_seconds() < 5
+
+
+def test_result_with_stale_lease_id_is_ignored(app_env, client):
+    ticket_id, job = submit_and_poll(client)
+
+    # lease_id 不符 (例如 lease 逾時後改派，舊 worker 才回報)：不套用
+    stale = client.post("/update_status", json={"task_id": ticket_id, "status": "booked", "lease_id": "0" * 16,
+                                                "details": {"code": "STALE"}})
+    assert stale.status_code == 409
+    assert app_env.store.get_ticket(ticket_id)["status"] == TICKET_STATUS_PENDING
+    assert app_env.dispatcher.in_flight() == 1
+
+    booked = {"task_id": ticket_id, "status": "booked", "lease_id": job["lease_id"], "details": {"code": "OK1"}}
+    assert client.post("/update_status", json=booked).status_code == 200
+    # 重送同一個最終結果：忽略，不覆蓋已完成的記錄
+    assert client.post("/update_status", json={**booked, "details": {"code": "OK2"}}).status_code == 409
+    ticket = app_env.store.get_ticket(ticket_id)
+    assert (ticket["status"], ticket["code"]) == ("booked", "OK1")
+    assert app_env.dispatcher.in_flight() == 0
+
+
+def test_poll_validates_and_clamps_max_tasks(app_env, client):
+    for i in range(app_env.DISPATCH_BATCH_SIZE + 2):
+        client.post("/api/submit_ticket", json={**TICKET_FORM, "id_number": f"C12345678{i}", "train_no": f"06{i:02d}"})
+
+    assert client.post("/poll_for_update", json={"worker_id": "w1", "max_tasks": "many"}).status_code == 400
+    payload = client.post("/poll_for_update", json={"worker_id": "w1", "max_tasks": "2"}).get_json()
+    assert len(payload["data"]) == 2
+    payload = client.post("/poll_for_update", json={"worker_id": "w2", "max_tasks": 10 ** 6}).get_json()
+    assert len(payload["data"]) == app_env.DISPATCH_BATCH_SIZE
@@ -0,0 +1,76 @@
+import time
+import threading
+
+import pytest
+
+from dispatcher import TaskDispatcher
+
+
+def make_task(task_id):
+    return {"id": task_id, "train_no": str(task_id), "travel_date": "2030-01-15",
+            "from_station": "台北", "to_station": "台中", "from_time": "08:00"}
+
+
+@pytest.fixture
+def dispatcher():
+    return TaskDispatcher(batch_size=1)
+
+
+def test_repoll_releases_abandoned_waiter(dispatcher):
+    results = []
+    parked = threading.Thread(target=lambda: results.append(dispatcher.poll("w1", 5)))
+    parked.start()
+    time.sleep(0.1)
+
+    dispatcher.seed([make_task(3)])
+    assert dispatcher.poll("w1", 1)["status"] == "success"
+    parked.join(timeout=2)
+    assert results[0]["status"] == "forced_reconnect"
+
+    # 被放棄的 poll 已釋放：新任務留在佇列，不會被派給它
+    dispatcher.submit(make_task(4))
+    assert dispatcher.backlog_size() == 1
+    assert dispatcher.in_flight() == 1
+
+
+def test_claim_result_rejects_stale_and_duplicate_reports(dispatcher):
+    dispatcher.seed([make_task(1)])
+    job = dispatcher.poll("w1", 1)["data"]
+
+    assert dispatcher.claim_result(1, "not-the-lease") is None
+    assert dispatcher.claim_result(1, job["lease_id"], final=True) == [1]
+    # 最終結果寫入中：同一結果的重送 (帶或不帶 lease_id) 都不再套用
+    assert dispatcher.claim_result(1, job["lease_id"], final=True) is None
+    assert dispatcher.claim_result(1) is None
+    dispatcher.complete(1)
+    assert dispatcher.claim_result(1, job["lease_id"]) is None
+
+
+def test_closing_lease_is_not_reclaimed_while_result_is_written():
+    dispatcher = TaskDispatcher(batch_size=1, lease_timeout_s=1, max_group_size=2)
+    # 同車次 / 日期 / 起訖站：合併成一個兩位乘客的 job
+    dispatcher.seed([make_task(1), {**make_task(1), "id": 2}])
+    job = dispatcher.poll("w1", 1, max_group_size=2)["data"]
+    assert job["group_ids"] == [1, 2]
+
+    assert dispatcher.claim_result(1, job["lease_id"], final=True) == [1, 2]
+    time.sleep(1.1)  # 寫入結果的時間超過 lease_timeout_s
+    with dispatcher._lock:
+        dispatcher._reclaim_expired()
+    assert dispatcher.backlog_size() == 0
+
+    dispatcher.complete(1)
+    assert (dispatcher.backlog_size(), dispatcher.in_flight()) == (0, 0)
+
+
+def test_released_claim_expires_normally():
+    dispatcher = TaskDispatcher(batch_size=1, lease_timeout_s=1, max_group_size=2)
+    dispatcher.seed([make_task(1), {**make_task(1), "id": 2}])
+    job = dispatcher.poll("w1", 1, max_group_size=2)["data"]
+    dispatcher.claim_result(1, job["lease_id"], final=True)
+
+    dispatcher.release_claim(1)
+    time.sleep(1.1)
+    with dispatcher._lock:
+        dispatcher._reclaim_expired()
+    assert dispatcher.backlog_size() == 2
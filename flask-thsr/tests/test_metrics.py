@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import subprocess
+import threading
+
+from coordinator import BrokerClient, BrokerServer
+from metrics import Registry, ProcessSnapshots
+from wire import WIRE_PAYLOAD_BYTES
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 模擬一個 web worker：在自己的程序內量測，再把快照送到 broker
+WORKER_SCRIPT = """
+import sys
+sys.path.insert(0, sys.argv[1])
+from coordinator import BrokerClient
+from wire import WIRE_PAYLOAD_BYTES
+for size in map(int, sys.argv[3:]):
+    WIRE_PAYLOAD_BYTES.observe(size, route="summed", format="json", encoding="identity")
+BrokerClient(sys.argv[2]).push_metrics([WIRE_PAYLOAD_BYTES.name])
+"""
+
+
+def series_value(text, sample):
+    [line] = [line for line in text.splitlines() if line.startswith(sample + " ")]
+    return float(line.split()[-1])
+
+
+def test_observations_from_two_processes_are_summed(tmp_path):
+    socket_path = str(tmp_path / "broker.sock")
+    threading.Thread(target=BrokerServer(socket_path, None, None, None).serve_forever, daemon=True).start()
+    deadline = time.monotonic() + 10
+    while not os.path.exists(socket_path) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    for sizes in (["100", "200"], ["300"]):
+        subprocess.run([sys.executable, "-c", WORKER_SCRIPT, REPO_DIR, socket_path, *sizes], check=True, timeout=60)
+
+    # 兩個 worker 都已結束：它們最後一次送出的累積值仍計入
+    text = BrokerClient(socket_path).call("metrics.render", only=[WIRE_PAYLOAD_BYTES.name])
+    labels = 'route="summed",format="json",encoding="identity"'
+    assert series_value(text, f"thsr_wire_payload_bytes_count{{{labels}}}") == 3
+    assert series_value(text, f"thsr_wire_payload_bytes_sum{{{labels}}}") == 600
+    assert series_value(text, f'thsr_wire_payload_bytes_bucket{{{labels},le="+Inf"}}') == 3
+
+
+def test_gauges_only_count_processes_that_still_report():
+    registry = Registry()
+    registry.gauge("thsr_sse_subscribers", "Open pending-table SSE streams.", lambda: 1)
+    snapshots = ProcessSnapshots(registry, gauge_ttl_s=0.2)
+    snapshots.update("worker-a", {"thsr_sse_subscribers": 2})
+    assert series_value(snapshots.render(), "thsr_sse_subscribers") == 3
+
+    time.sleep(0.3)
+    snapshots.update("worker-b", {"thsr_sse_subscribers": 4})
+    assert series_value(snapshots.render(), "thsr_sse_subscribers") == 5
@@ -0,0 +1,89 @@
+import os
+import glob
+import json
+import time
+
+import pytest
+
+from ticket_store import JournalTicketStore
+
+
+def open_store(tmp_path, **kwargs):
+    return JournalTicketStore(str(tmp_path / "ticket_requests.json"), str(tmp_path / "ticket_history.json"),
+                              str(tmp_path / "passenger_data.json"), str(tmp_path / "ticket_journal.log"),
+                              fsync_window_s=None, **kwargs)
+
+
+def make_ticket(ticket_id):
+    return {"id": ticket_id, "status": "待處理", "order_date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "train_no": "0803", "travel_date": "2030-01-15"}
+
+
+def crash(store):
+    # 模擬程序當機：不壓縮、不清理，只關閉檔案
+    store._journal.close()
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return tmp_path / "ticket_journal.log"
+
+
+def test_torn_journal_tail_is_truncated(tmp_path, journal):
+    store = open_store(tmp_path)
+    store.add_ticket(make_ticket(1))
+    store.add_ticket(make_ticket(2))
+    crash(store)
+    with open(journal, "a", encoding="utf-8") as f:
+        f.write('{"op": "add", "ticket": {"id": 3, "sta')
+
+    store = open_store(tmp_path)
+    assert sorted(t["id"] for t in store.list_pending()) == [1, 2]
+    assert journal.read_bytes().endswith(b"\n")
+    # 之後的寫入從新的一行開始，重啟後每一行都能解析
+    store.add_ticket(make_ticket(3))
+    crash(store)
+    assert [json.loads(line)["ticket"]["id"] for line in journal.read_text(encoding="utf-8").splitlines()] == [1, 2, 3]
+    assert sorted(t["id"] for t in open_store(tmp_path, read_only=True).list_pending()) == [1, 2, 3]
+
+
+def test_corrupt_snapshot_is_quarantined_and_restored_from_backup(tmp_path):
+    store = open_store(tmp_path)
+    store.add_ticket(make_ticket(1))
+    store.compact()
+    store.add_ticket(make_ticket(2))
+    store.update_ticket(1, {"status": "booked"}, archive=True)
+    store.compact()          # 前一版快照成為 *.bak，這段期間的 journal 成為 .prev
+    store.add_ticket(make_ticket(3))
+    crash(store)
+    (tmp_path / "ticket_requests.json").write_text('[{"id": 2, "sta', encoding="utf-8")
+
+    store = open_store(tmp_path, read_only=True)
+    assert glob.glob(str(tmp_path / "ticket_requests.json.corrupt-*"))
+    assert not (tmp_path / "ticket_requests.json").exists()
+    # *.bak + .prev + 目前的 journal 還原出當機前的完整狀態
+    assert sorted(t["id"] for t in store.list_pending()) == [2, 3]
+    assert [t["id"] for t in store.iter_history()] == [1]
+    assert store.get_ticket(1)["status"] == "booked"
+
+
+def test_interrupted_compaction_is_replayed(tmp_path, journal):
+    store = open_store(tmp_path)
+    store.add_ticket(make_ticket(1))
+    store.add_ticket(make_ticket(2))
+    # 壓縮中途當機：journal 已改名為 .compacting，新快照還沒寫出
+    with store._lock:
+        store._rotate_journal()
+    store.update_ticket(2, {"status": "booked"}, archive=True)
+    crash(store)
+    assert os.path.exists(str(journal) + ".compacting")
+
+    store = open_store(tmp_path)
+    assert [t["id"] for t in store.list_pending()] == [1]
+    assert [t["id"] for t in store.iter_history()] == [2]
+    # 下一次壓縮把 .compacting 與目前的 journal 一起寫成快照
+    store.compact()
+    crash(store)
+    assert not os.path.exists(str(journal) + ".compacting")
+    store = open_store(tmp_path, read_only=True)
+    assert ([t["id"] for t in store.list_pending()], [t["id"] for t in store.iter_history()]) == ([1], [2])
@@ -0,0 +1,1080 @@
+# =======================================================
+# ticket_store.py - 訂票資料儲存引擎
+# =======================================================
+#
+# 提供兩種可替換的後端 (介面相同，由 open_store() 選擇):
+#   - "journal": JournalTicketStore，append-only journal + in-memory index (預設)
+#   - "sqlite":  SQLiteTicketStore，SQLite (WAL) + 索引查詢
+#
+# [journal] 所有訂票 / 乘客資料常駐記憶體 (以 id 為 key)，每一筆異動只寫一行 JSON
+# 到 journal 檔；journal 累積到一定數量後由背景執行緒壓縮 (compact) 成
+# 原本的 ticket_requests.json / ticket_history.json / passenger_data.json
+# 快照檔。因此新增與更新的成本與歷史資料量無關。
+#
+# Journal 每行格式:
+#   {"op": "add", "ticket": {...}}               新增待處理訂票
+#   {"op": "update", "id": 1, "fields": {...}}   更新待處理訂票欄位
+#   {"op": "archive", "ticket": {...}}           移入歷史記錄 (完整內容)
+#   {"op": "add_passenger", "passenger": {...}}  新增或更新乘客資料 (以 id_number 為鍵)
+#
+# 持久性 / 損毀復原:
+#   - 快照檔以「寫入暫存檔 + fsync + os.replace」原子更新，前一版保留為 *.bak；
+#     壓縮完成後該次的 journal 保留為 ticket_journal.log.prev (= *.bak 到目前快照之間的異動)
+#   - journal 寫入採 group commit：寫入在 lock 內完成，fsync 在 lock 外由一個 leader
+#     代表短時間內的所有寫入執行一次，呼叫端在資料落地後才返回
+#   - 啟動時快照檔無法解析：原檔改名為 *.corrupt-<時間> 保留，改由 *.bak + .prev journal 復原；
+#     journal 結尾不完整的一行 (寫入中途當機) 會被截掉，避免之後的寫入接在同一行
+#
+# 歷史記錄依下單月份 (order_date) 分段：
+#   - ticket_history.json 只保存尚未結束的月份 (目前分段)，壓縮時只重寫這一份
+#   - 月份結束且該月已沒有待處理訂票後，壓縮時把該月封存到 ticket_history/<YYYY-MM>.jsonl.gz
+#     (gzip 的 JSON Lines，依 id 排序，寫入後設為唯讀不再修改) 與 <YYYY-MM>.idx.json 索引
+#     (id 區間、乘車日期分布)；封存的記錄不常駐記憶體，依索引只讀取需要的分段
+#   - 先寫分段、再寫快照；兩者之間當機時，啟動後以分段為準去掉快照中的重複記錄
+
+import os
+import re
+import gzip
+import glob
+import json
+import time
+import heapq
+import bisect
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Iterator, Tuple, Callable
+
+from metrics import STORE_IO_SECONDS
+from jsonlog import get_logger
+
+try:
+    import gevent
+    from gevent import monkey as _gevent_monkey
+except ImportError:
+    gevent = None
+
+log = get_logger("store")
+
+# 歷史記錄分頁查詢時每次從 store 取出的筆數 (不在持有 lock 的情況下串流)
+HISTORY_SCAN_CHUNK = 256
+# 封存分段讀取後保留在記憶體的份數 (翻頁時連續讀同一個月份不必重複解壓縮)
+HISTORY_SEGMENT_CACHE = 4
+
+
+# --- 歷史記錄篩選 ---
+# filters 可包含: date_from / date_to (乘車日期 YYYY-MM-DD，含端點)、train_no、status、
+# passenger (姓名或身分證字號)。未提供或空字串的條件不篩選。
+def match_history_filters(ticket: Dict[str, Any], filters: Dict[str, str]) -> bool:
+    travel_date = ticket.get("travel_date") or ""
+    if filters.get("date_from") and travel_date < filters["date_from"]:
+        return False
+    if filters.get("date_to") and travel_date > filters["date_to"]:
+        return False
+    if filters.get("train_no") and ticket.get("train_no") != filters["train_no"]:
+        return False
+    if filters.get("status") and ticket.get("status") != filters["status"]:
+        return False
+    if filters.get("passenger") and filters["passenger"] not in (ticket.get("name"), ticket.get("id_number")):
+        return False
+    return True
+
+
+# --- JSON 檔案存取 ---
+class CorruptFileError(ValueError):
+    """快照檔存在但無法解析 (例如寫入中途當機或磁碟損毀)。"""
+
+
+def fsync(fd: int):
+    """os.fsync；gevent 下交給 threadpool 執行，不阻塞其他 greenlet。"""
+    if gevent is not None and _gevent_monkey.is_module_patched("threading"):
+        gevent.get_hub().threadpool.apply(os.fsync, (fd,))
+    else:
+        os.fsync(fd)
+
+def fsync_dir(path: str):
+    # rename 本身也要落地：fsync 所在目錄 (Windows 不支援開啟目錄，略過)
+    try:
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def quarantine(path: str) -> str:
+    """將損毀的檔案改名保留 (不覆蓋、不刪除)，回傳新路徑。"""
+    target = f"{path}.corrupt-{time.strftime('%Y%m%d-%H%M%S')}"
+    os.replace(path, target)
+    return target
+
+
+def load_json(filename):
+    if not os.path.exists(filename):
+        return []
+    with STORE_IO_SECONDS.time(op="load_json", file=os.path.basename(filename)):
+        try:
+            with open(filename, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise CorruptFileError(f"{filename}: {e}") from e
+
+def save_json(filename, data, keep_backup: bool = False):
+    """原子寫入：先寫暫存檔並 fsync，再以 os.replace 取代原檔；keep_backup=True 時原檔保留為 .bak。"""
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    tmp_file = filename + ".tmp"
+    with STORE_IO_SECONDS.time(op="save_json", file=os.path.basename(filename)):
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            fsync(f.fileno())
+        if keep_backup:
+            if os.path.exists(filename):
+                os.replace(filename, filename + ".bak")
+            elif os.path.exists(filename + ".bak"):
+                # 主檔不存在 (已隔離) 時舊的 .bak 屬於更早的世代，與 .prev journal 對不上，不再保留
+                os.remove(filename + ".bak")
+        os.replace(tmp_file, filename)
+        fsync_dir(filename)
+
+
+class GroupCommitter:
+    """
+    journal 的 group commit。written() 在 store 的 lock 內、寫入並 flush 之後呼叫，取得序號；
+    wait(seq) 在 lock 外呼叫，直到該序號之前的寫入都已 fsync。同時等待的呼叫端中只有一個
+    (leader) 先等待 window_s 讓其他寫入跟上，再代表所有人執行一次 fsync。
+    """
+
+    def __init__(self, fd: int, window_s: float = 0.002, file_label: str = "journal"):
+        self.window_s = window_s
+        self.file_label = file_label
+        self._fd = fd
+        self._cond = threading.Condition()
+        self._fd_lock = threading.Lock()  # fsync 與 journal 輪替 (壓縮) 互斥
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+
+    def written(self) -> int:
+        self._written += 1
+        return self._written
+
+    def wait(self, seq: int):
+        with self._cond:
+            while self._synced < seq:
+                if not self._syncing:
+                    self._syncing = True
+                    break
+                self._cond.wait()
+            else:
+                return
+        # 這個呼叫端成為 leader
+        synced = None
+        try:
+            if self.window_s > 0:
+                time.sleep(self.window_s)
+            with self._fd_lock:
+                target = self._written
+                if self._synced < target:
+                    with STORE_IO_SECONDS.time(op="fsync", file=self.file_label):
+                        fsync(self._fd)
+                synced = target
+        finally:
+            with self._cond:
+                if synced is not None:
+                    self._synced = max(self._synced, synced)
+                self._syncing = False
+                self._cond.notify_all()
+
+    def rotate(self, sync_and_reopen) -> None:
+        """壓縮輪替 journal：sync_and_reopen() 需 fsync 舊檔並回傳新檔的 fd。"""
+        with self._fd_lock:
+            self._fd = sync_and_reopen()
+            written = self._written
+        with self._cond:
+            self._synced = max(self._synced, written)
+            self._cond.notify_all()
+
+
+class IdSequence:
+    """以 lock 保護的遞增 id 產生器；啟動時以既有最大 id 復原一次，之後不再掃描資料。"""
+
+    def __init__(self, last_value: int = 0):
+        self._lock = threading.Lock()
+        self._value = last_value
+
+    def next(self) -> int:
+        with self._lock:
+            self._value += 1
+            return self._value
+
+
+class PassengerIndex:
+    """
+    乘客資料的記憶體索引：id -> 乘客、id_number -> id，查詢與新增/更新皆為 O(1)。
+    list() 的結果快取到下次寫入，乘客列表頁不必每次重建上萬筆的清單。
+    不自帶 lock，由所屬的 store 以自己的 lock 保護。
+    """
+
+    def __init__(self, passengers=()):
+        self._by_id: Dict[int, Dict[str, Any]] = {}
+        self._by_id_number: Dict[str, int] = {}
+        self._snapshot: Optional[List[Dict[str, Any]]] = None
+        for p in passengers:
+            self.put(p)
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def max_id(self) -> int:
+        return max(self._by_id, default=0)
+
+    def get(self, id_number: str) -> Optional[Dict[str, Any]]:
+        passenger_id = self._by_id_number.get(id_number)
+        return self._by_id.get(passenger_id) if passenger_id is not None else None
+
+    def put(self, passenger: Dict[str, Any]):
+        old = self._by_id.get(passenger["id"])
+        if old is not None and old.get("id_number") != passenger.get("id_number") \
+                and self._by_id_number.get(old.get("id_number")) == old["id"]:
+            del self._by_id_number[old["id_number"]]
+        self._by_id[passenger["id"]] = passenger
+        if passenger.get("id_number"):
+            self._by_id_number[passenger["id_number"]] = passenger["id"]
+        self._snapshot = None
+
+    def list(self) -> List[Dict[str, Any]]:
+        if self._snapshot is None:
+            self._snapshot = list(self._by_id.values())
+        return self._snapshot
+
+
+def merge_passenger(existing: Optional[Dict[str, Any]], fields: Dict[str, Any],
+                    overwrite: bool) -> Optional[Dict[str, Any]]:
+    """
+    upsert_passenger 的共用規則 (以 id_number 識別乘客)：回傳要寫入的新紀錄 (不含新 id)，
+    不需寫入時回傳 None。overwrite=False 時只新增，不覆蓋既有乘客的資料。
+    """
+    if existing is None:
+        return dict(fields)
+    if not overwrite:
+        return None
+    merged = {**existing, **fields}
+    return merged if merged != existing else None
+
+
+# --- 歷史記錄月份分段 ---
+MONTH_PATTERN = re.compile(r"^\d{4}-\d{2}")
+
+def ticket_month(ticket: Dict[str, Any]) -> str:
+    """分段的月份 (YYYY-MM)：依下單時間；缺少 order_date 的舊資料歸入目前月份。"""
+    order_date = ticket.get("order_date") or ""
+    return order_date[:7] if MONTH_PATTERN.match(order_date) else time.strftime("%Y-%m")
+
+def id_ranges(ids: List[int]) -> List[List[int]]:
+    """已排序的 id -> 連續區間 [[first, last], ...] (同一個月份的 id 幾乎都連續，索引因此很小)。"""
+    ranges: List[List[int]] = []
+    for i in ids:
+        if ranges and i == ranges[-1][1] + 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ranges
+
+def merge_descending(sources: List[Tuple[int, Callable[[], Iterator[Dict[str, Any]]]]]) -> Iterator[Dict[str, Any]]:
+    """
+    合併多個依 id 由大到小的來源 [(最大 id, 產生 iterator 的函式), ...]。
+    來源依最大 id 排序，只在輪到它可能有下一筆時才開啟 (封存分段在需要時才讀取)。
+    """
+    sources = sorted(sources, key=lambda s: s[0], reverse=True)
+    heap: list = []
+    opened = 0
+    while True:
+        while opened < len(sources) and (not heap or sources[opened][0] > -heap[0][0]):
+            iterator = sources[opened][1]()
+            first = next(iterator, None)
+            if first is not None:
+                heapq.heappush(heap, (-first["id"], opened, first, iterator))
+            opened += 1
+        if not heap:
+            return
+        _, order, ticket, iterator = heapq.heappop(heap)
+        yield ticket
+        following = next(iterator, None)
+        if following is not None:
+            heapq.heappush(heap, (-following["id"], order, following, iterator))
+
+
+class HistoryArchive:
+    """
+    已封存的歷史記錄分段 (每個月份一個唯讀的 .jsonl.gz 與 .idx.json)。
+    索引常駐記憶體；分段內容在查詢時才讀取，最近用到的 cache_size 份保留在記憶體。
+    新增分段只由壓縮執行緒在 store 的 lock 內以 add_segment() 換上新的清單，讀取端不需要 lock。
+    """
+
+    def __init__(self, directory: str, cache_size: int = HISTORY_SEGMENT_CACHE, read_only: bool = False):
+        self.directory = directory
+        self.cache_size = cache_size
+        self._segments: List[Dict[str, Any]] = []  # 索引，依月份排序
+        self._cache: "OrderedDict[str, Tuple[List[int], List[Dict[str, Any]]]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._load_indexes(read_only)
+
+    def _data_file(self, month: str) -> str:
+        return os.path.join(self.directory, f"{month}.jsonl.gz")
+
+    def _index_file(self, month: str) -> str:
+        return os.path.join(self.directory, f"{month}.idx.json")
+
+    def _load_indexes(self, read_only: bool):
+        segments = []
+        for data_file in sorted(glob.glob(os.path.join(self.directory, "*.jsonl.gz"))):
+            month = os.path.basename(data_file)[:-len(".jsonl.gz")]
+            try:
+                with open(self._index_file(month), "r", encoding="utf-8") as f:
+                    segments.append(json.load(f))
+                continue
+            except FileNotFoundError:
+                pass
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                log.warning("history_index_corrupt", month=month, error=str(e))
+            # 索引遺失或損毀 (寫入索引前當機)：由分段內容重建
+            try:
+                index = self._build_index(month, self._read_segment(month))
+            except (OSError, EOFError, ValueError) as e:
+                log.error("history_segment_unreadable", path=data_file, error=str(e))
+                continue
+            if not read_only:
+                self._write_file(self._index_file(month), json.dumps(index).encode("utf-8"))
+            log.warning("history_index_rebuilt", month=month, records=index["count"])
+            segments.append(index)
+        self._segments = segments
+
+    @staticmethod
+    def _build_index(month: str, tickets: List[Dict[str, Any]]) -> Dict[str, Any]:
+        ids = [t["id"] for t in tickets]
+        travel_dates: Dict[str, int] = {}
+        for t in tickets:
+            travel_date = t.get("travel_date") or ""
+            travel_dates[travel_date] = travel_dates.get(travel_date, 0) + 1
+        return {"month": month, "count": len(ids), "min_id": ids[0] if ids else 0, "max_id": ids[-1] if ids else 0,
+                "id_ranges": id_ranges(ids), "travel_dates": dict(sorted(travel_dates.items()))}
+
+    def _write_file(self, path: str, data: bytes):
+        # 原子寫入後設為唯讀；重新封存同一個月份 (遲到的記錄) 時整份取代，不在原檔上修改
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_file = path + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(data)
+            f.flush()
+            fsync(f.fileno())
+        os.chmod(tmp_file, 0o444)
+        if os.path.exists(path):
+            os.chmod(path, 0o644)  # Windows 無法取代唯讀檔
+        os.replace(tmp_file, path)
+        fsync_dir(path)
+
+    def _read_segment(self, month: str) -> List[Dict[str, Any]]:
+        with STORE_IO_SECONDS.time(op="load_segment", file="history_segment"):
+            with gzip.open(self._data_file(month), "rt", encoding="utf-8") as f:
+                return [json.loads(line) for line in f if line.strip()]
+
+    def _segment(self, month: str) -> Tuple[List[int], List[Dict[str, Any]]]:
+        """(已排序的 id, 記錄)；最近讀過的分段由快取取得。"""
+        with self._cache_lock:
+            segment = self._cache.get(month)
+            if segment is not None:
+                self._cache.move_to_end(month)
+                return segment
+            tickets = self._read_segment(month)
+            segment = self._cache[month] = ([t["id"] for t in tickets], tickets)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return segment
+
+    # --- 封存 (壓縮執行緒) ---
+    def seal(self, month: str, tickets: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """寫出一個月份的分段與索引 (已封存過的月份會與原內容合併)，回傳索引；須再以 add_segment() 啟用。"""
+        merged = {t["id"]: t for t in (self._segment(month)[1] if self.has_month(month) else [])}
+        merged.update((t["id"], t) for t in tickets)
+        ordered = [merged[i] for i in sorted(merged)]
+        body = "".join(json.dumps(t, ensure_ascii=False) + "\n" for t in ordered).encode("utf-8")
+        index = self._build_index(month, ordered)
+        with STORE_IO_SECONDS.time(op="seal_segment", file="history_segment"):
+            # 分段先於索引落地：有索引就代表分段完整
+            self._write_file(self._data_file(month), gzip.compress(body, compresslevel=6))
+            self._write_file(self._index_file(month), json.dumps(index).encode("utf-8"))
+        with self._cache_lock:
+            self._cache.pop(month, None)
+        return index
+
+    def add_segment(self, index: Dict[str, Any]):
+        segments = [s for s in self._segments if s["month"] != index["month"]] + [index]
+        self._segments = sorted(segments, key=lambda s: s["month"])
+
+    # --- 查詢 ---
+    def has_month(self, month: str) -> bool:
+        return any(s["month"] == month for s in self._segments)
+
+    def count(self) -> int:
+        return sum(s["count"] for s in self._segments)
+
+    def max_id(self) -> int:
+        return max((s["max_id"] for s in self._segments), default=0)
+
+    def _segment_for(self, task_id: int) -> Optional[Dict[str, Any]]:
+        for index in self._segments:
+            if not index["min_id"] <= task_id <= index["max_id"]:
+                continue
+            ranges = index["id_ranges"]
+            pos = bisect.bisect_right(ranges, [task_id, float("inf")]) - 1
+            if pos >= 0 and ranges[pos][0] <= task_id <= ranges[pos][1]:
+                return index
+        return None
+
+    def contains(self, task_id: int) -> bool:
+        return self._segment_for(task_id) is not None
+
+    def get(self, task_id: int) -> Optional[Dict[str, Any]]:
+        index = self._segment_for(task_id)
+        if index is None:
+            return None
+        ids, tickets = self._segment(index["month"])
+        pos = bisect.bisect_left(ids, task_id)
+        return tickets[pos] if pos < len(ids) and ids[pos] == task_id else None
+
+    def sources(self, before_id: Optional[int], filters: Dict[str, str]) -> List[Tuple[int, Callable[[], Iterator[Dict[str, Any]]]]]:
+        """iter_history 用的來源：略過 id 都不小於 before_id、或沒有任何乘車日期落在篩選區間的分段。"""
+        date_from, date_to = filters.get("date_from") or "", filters.get("date_to") or ""
+        sources = []
+        for index in self._segments:
+            if before_id is not None and index["min_id"] >= before_id:
+                continue
+            if (date_from or date_to) and not any(
+                    (not date_from or d >= date_from) and (not date_to or d <= date_to) for d in index["travel_dates"]):
+                continue
+            max_id = index["max_id"] if before_id is None else min(index["max_id"], before_id - 1)
+            sources.append((max_id, lambda month=index["month"]: self._iter_segment(month, before_id)))
+        return sources
+
+    def _iter_segment(self, month: str, before_id: Optional[int]) -> Iterator[Dict[str, Any]]:
+        ids, tickets = self._segment(month)
+        end = len(ids) if before_id is None else bisect.bisect_left(ids, before_id)
+        for pos in range(end - 1, -1, -1):
+            yield tickets[pos]
+
+    def iter_all(self) -> Iterator[Dict[str, Any]]:
+        for index in list(self._segments):
+            yield from self._read_segment(index["month"])
+
+
+class JournalTicketStore:
+    """記憶體索引 + append-only journal 的訂票資料庫 (已封存月份的歷史記錄由 HistoryArchive 提供)。"""
+
+    def __init__(self, request_file: str, history_file: str, passenger_file: str,
+                 journal_file: str, compact_threshold: int = 1000, read_only: bool = False,
+                 fsync_window_s: Optional[float] = 0.002, history_dir: Optional[str] = None):
+        self.request_file = request_file
+        self.history_file = history_file
+        # 封存分段的目錄，預設與快照檔同名 (ticket_history.json -> ticket_history/)
+        self.history_dir = history_dir or os.path.splitext(history_file)[0]
+        self.passenger_file = passenger_file
+        self.journal_file = journal_file
+        self.compacting_file = journal_file + ".compacting"
+        self.prev_journal_file = journal_file + ".prev"
+        self.compact_threshold = compact_threshold
+        self.read_only = read_only
+
+        self._lock = threading.RLock()
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._history: Dict[int, Dict[str, Any]] = {}
+        self._history_ids: List[int] = []  # 已排序，供 id cursor 分頁
+        self._passengers = PassengerIndex()
+        self._journal_entries = 0
+
+        self._archive = HistoryArchive(self.history_dir, read_only=read_only)
+        self._recover()
+        # id 隨 add / add_passenger 寫入 journal，重啟時由最大 id 復原即可
+        self._ticket_ids = IdSequence(max(max(self._pending, default=0), max(self._history, default=0),
+                                          self._archive.max_id()))
+        self._passenger_ids = IdSequence(self._passengers.max_id())
+        if read_only:
+            # 僅供讀取 (例如資料移轉)：不開啟 journal，也不啟動背景壓縮
+            return
+
+        os.makedirs(os.path.dirname(self.journal_file) or ".", exist_ok=True)
+        self._journal = open(self.journal_file, "a", encoding="utf-8")
+        # fsync_window_s=None：不 fsync，只 flush 到 OS (舊行為)
+        self._committer = None
+        if fsync_window_s is not None:
+            self._committer = GroupCommitter(self._journal.fileno(), fsync_window_s,
+                                             os.path.basename(self.journal_file))
+
+        self._compact_event = threading.Event()
+        self._compactor = threading.Thread(target=self._compact_loop, name="journal-compactor", daemon=True)
+        self._compactor.start()
+        if self._recovered_from_backup or self._sealable_months():
+            # 盡快寫出新的快照，取代已隔離的檔案；或封存已結束的月份 (例如第一次啟用分段時的舊歷史記錄)
+            self._compact_event.set()
+
+    # --- 啟動復原 ---
+    def _recover(self):
+        # 1. 載入快照；損毀的快照改由 .bak 載入，並需要額外重播 .prev journal
+        self._recovered_from_backup = False
+        used_backup = False
+        pending, ok = self._load_snapshot(self.request_file)
+        used_backup |= not ok
+        history, ok = self._load_snapshot(self.history_file)
+        used_backup |= not ok
+        passengers, ok = self._load_snapshot(self.passenger_file)
+        used_backup |= not ok
+
+        for t in pending:
+            self._pending[t["id"]] = t
+        for h in history:
+            self._history[h["id"]] = h
+        self._history_ids = sorted(self._history)
+        for p in passengers:
+            self._passengers.put(p)
+
+        # 2. 依序重播 journal (重播為冪等操作：每個 op 寫入完整的最終狀態，較新的快照再重播舊異動結果不變)
+        journals = [self.compacting_file, self.journal_file]
+        if used_backup:
+            journals.insert(0, self.prev_journal_file)
+            self._recovered_from_backup = True
+        for path in journals:
+            self._journal_entries += self._replay(path, repair=(path == self.journal_file and not self.read_only))
+
+        # 3. 封存分段已寫出、但快照還沒更新時當機：以分段為準去掉重複的記錄
+        duplicates = [task_id for task_id in self._history if self._archive.contains(task_id)]
+        for task_id in duplicates:
+            del self._history[task_id]
+        if duplicates:
+            self._history_ids = sorted(self._history)
+            log.warning("history_duplicates_dropped", records=len(duplicates))
+
+    def _load_snapshot(self, filename: str) -> Tuple[List[Dict[str, Any]], bool]:
+        """回傳 (資料, 是否為目前的快照)。主檔損毀或遺失 (輪替中途當機) 時改用 .bak。"""
+        backup_file = filename + ".bak"
+        try:
+            if os.path.exists(filename) or not os.path.exists(backup_file):
+                return load_json(filename), True
+        except CorruptFileError as e:
+            moved = quarantine(filename)
+            log.error("snapshot_corrupt", path=filename, error=str(e), quarantined_to=moved)
+        try:
+            data = load_json(backup_file)
+            log.warning("snapshot_restored_from_backup", path=filename, backup=backup_file, records=len(data))
+            return data, False
+        except CorruptFileError as e:
+            moved = quarantine(backup_file)
+            log.error("snapshot_backup_corrupt", path=backup_file, error=str(e), quarantined_to=moved)
+            return [], False
+
+    def _replay(self, path: str, repair: bool = False) -> int:
+        """
+        重播一個 journal 檔。無法解析的行略過並記錄；repair=True 時 (目前使用中的 journal)
+        修補結尾沒有換行的最後一行，之後的 append 才不會接在同一行後面。
+        """
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            lines = f.read().split(b"\n")
+        count = 0
+        tail_ok = True
+        for line_no, raw in enumerate(lines, 1):
+            if not raw.strip():
+                continue
+            is_tail = line_no == len(lines)  # 最後一個換行之後的內容
+            try:
+                entry = json.loads(raw)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                if is_tail:
+                    # 寫入中途當機留下的不完整最後一行
+                    log.warning("journal_torn_tail", path=path, line=line_no, bytes=len(raw))
+                    tail_ok = False
+                else:
+                    log.error("journal_corrupt_entry", path=path, line=line_no)
+                continue
+            self._apply(entry)
+            count += 1
+
+        if repair and lines[-1].strip():
+            with open(path, "r+b") as f:
+                if tail_ok:
+                    # 最後一筆完整，只是少了換行
+                    f.seek(0, os.SEEK_END)
+                    f.write(b"\n")
+                else:
+                    f.truncate(sum(len(line) + 1 for line in lines[:-1]))
+        return count
+
+    def _apply(self, entry: Dict[str, Any]):
+        op = entry.get("op")
+        if op == "add":
+            ticket = entry["ticket"]
+            if self._history.pop(ticket["id"], None) is not None:
+                del self._history_ids[bisect.bisect_left(self._history_ids, ticket["id"])]
+            self._pending[ticket["id"]] = ticket
+        elif op == "update":
+            task_id = entry["id"]
+            if task_id in self._pending:
+                self._pending[task_id] = {**self._pending[task_id], **entry["fields"]}
+        elif op == "archive":
+            ticket = entry["ticket"]
+            self._pending.pop(ticket["id"], None)
+            if ticket["id"] not in self._history:
+                bisect.insort(self._history_ids, ticket["id"])
+            self._history[ticket["id"]] = ticket
+        elif op == "add_passenger":
+            self._passengers.put(entry["passenger"])
+
+    def _append(self, entry: Dict[str, Any]) -> int:
+        # 呼叫端需持有 self._lock
+        return self._append_many([entry])
+
+    def _append_many(self, entries: List[Dict[str, Any]]) -> int:
+        # 呼叫端需持有 self._lock。多筆異動合併成一次寫入；回傳交給 _wait_durable() 的序號。
+        if not entries:
+            return 0
+        for entry in entries:
+            self._apply(entry)
+        self._journal.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+        self._journal.flush()
+        self._journal_entries += len(entries)
+        if self._journal_entries >= self.compact_threshold:
+            self._compact_event.set()
+        return self._committer.written() if self._committer else 0
+
+    def _wait_durable(self, seq: int):
+        # 在 lock 外呼叫：等待 group commit 把這次寫入 fsync 到磁碟
+        if seq and self._committer:
+            self._committer.wait(seq)
+
+    # --- 背景壓縮 ---
+    def _compact_loop(self):
+        while True:
+            self._compact_event.wait()
+            self._compact_event.clear()
+            try:
+                self.compact()
+            except Exception as e:
+                log.error("journal_compaction_error", error=str(e))
+
+    def compact(self):
+        """封存已結束的月份，再將目前狀態寫成快照檔並清空 journal。"""
+        self._seal_closed_months()
+        with self._lock:
+            # 先輪替 journal，快照在 lock 外寫出期間仍可繼續寫入新的 journal。
+            # 記錄只會整筆取代、不會原地修改，因此以下的淺層複製內容一致。
+            if self._committer:
+                self._committer.rotate(self._rotate_journal)
+            else:
+                self._rotate_journal()
+            self._journal_entries = 0
+
+            pending = list(self._pending.values())
+            history = list(self._history.values())
+            passengers = self._passengers.list()
+
+        save_json(self.request_file, pending, keep_backup=True)
+        save_json(self.history_file, history, keep_backup=True)
+        save_json(self.passenger_file, passengers, keep_backup=True)
+        # 新快照已落地；這次的 journal 保留為 .prev，與 *.bak 一起作為快照損毀時的復原來源
+        os.replace(self.compacting_file, self.prev_journal_file)
+        fsync_dir(self.prev_journal_file)
+        log.info("journal_compacted", pending=len(pending), history=len(history), passengers=len(passengers),
+                 archived=self._archive.count())
+
+    def _sealable_months(self) -> Dict[str, List[Dict[str, Any]]]:
+        # 呼叫端需持有 self._lock (或在啟動時)。已結束、且沒有待處理訂票的月份 -> 該月的歷史記錄
+        current_month = time.strftime("%Y-%m")
+        busy = {ticket_month(t) for t in self._pending.values()}
+        months: Dict[str, List[Dict[str, Any]]] = {}
+        for ticket in self._history.values():
+            month = ticket_month(ticket)
+            if month < current_month and month not in busy:
+                months.setdefault(month, []).append(ticket)
+        return months
+
+    def _seal_closed_months(self):
+        with self._lock:
+            months = self._sealable_months()
+        for month, tickets in sorted(months.items()):
+            # 分段在 lock 外寫出；寫完後才換上索引並從記憶體移除，查詢不會看到缺漏
+            index = self._archive.seal(month, tickets)
+            with self._lock:
+                self._archive.add_segment(index)
+                for ticket in tickets:
+                    if self._history.get(ticket["id"]) is ticket:
+                        del self._history[ticket["id"]]
+                self._history_ids = sorted(self._history)
+            log.info("history_month_sealed", month=month, records=len(tickets), segment_records=index["count"])
+
+    def _rotate_journal(self) -> int:
+        # 呼叫端需持有 self._lock。舊 journal 先落地再改名為 .compacting，回傳新 journal 的 fd。
+        self._journal.flush()
+        fsync(self._journal.fileno())
+        self._journal.close()
+        if os.path.exists(self.compacting_file):
+            # 上一次壓縮中途失敗 (留下 .compacting)：把目前的 journal 接在後面，一起在這次壓縮處理
+            with open(self.compacting_file, "a", encoding="utf-8") as dst, \
+                 open(self.journal_file, "r", encoding="utf-8") as src:
+                dst.write(src.read())
+                dst.flush()
+                fsync(dst.fileno())
+            os.remove(self.journal_file)
+        else:
+            os.replace(self.journal_file, self.compacting_file)
+        self._journal = open(self.journal_file, "a", encoding="utf-8")
+        fsync_dir(self.journal_file)
+        return self._journal.fileno()
+
+    # --- 訂票資料 ---
+    def list_pending(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._pending.values())
+
+    def list_history(self) -> List[Dict[str, Any]]:
+        """全部歷史記錄 (含封存分段，會逐一讀取；供資料移轉使用)。"""
+        with self._lock:
+            current = list(self._history.values())
+        return list(self._archive.iter_all()) + current
+
+    def iter_history(self, before_id: Optional[int] = None, filters: Optional[Dict[str, str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        依 id 由新到舊逐筆產生符合條件的歷史記錄：目前分段與封存分段依 id 合併，
+        依乘車日期篩選時略過索引中沒有相符日期的分段。
+        """
+        filters = filters or {}
+        with self._lock:
+            sources = self._archive.sources(before_id, filters)
+            end = len(self._history_ids) if before_id is None else bisect.bisect_left(self._history_ids, before_id)
+            if end:
+                sources.append((self._history_ids[end - 1], lambda: self._iter_current(before_id)))
+        for ticket in merge_descending(sources):
+            if match_history_filters(ticket, filters):
+                yield ticket
+
+    def _iter_current(self, before_id: Optional[int]) -> Iterator[Dict[str, Any]]:
+        # 目前分段 (記憶體) 由新到舊；只在取每一段時短暫持有 lock
+        cursor = before_id
+        while True:
+            with self._lock:
+                end = len(self._history_ids) if cursor is None else bisect.bisect_left(self._history_ids, cursor)
+                ids = self._history_ids[max(0, end - HISTORY_SCAN_CHUNK):end]
+                chunk = [self._history[i] for i in reversed(ids)]
+            if not chunk:
+                return
+            yield from chunk
+            cursor = chunk[-1]["id"]
+
+    def get_ticket(self, task_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            ticket = self._pending.get(task_id) or self._history.get(task_id)
+        # 封存分段的讀取不佔用 store 的 lock
+        return ticket if ticket is not None else self._archive.get(task_id)
+
+    def next_ticket_id(self) -> int:
+        return self._ticket_ids.next()
+
+    def add_ticket(self, ticket: Dict[str, Any]):
+        with self._lock:
+            seq = self._append({"op": "add", "ticket": ticket})
+        self._wait_durable(seq)
+
+    def update_ticket(self, task_id: int, fields: Dict[str, Any], archive: bool = False) -> Optional[Dict[str, Any]]:
+        """更新待處理訂票；archive=True 時同時移入歷史記錄。找不到時回傳 None。"""
+        return self.update_tickets([(task_id, fields, archive)])[0]
+
+    def update_tickets(self, updates: List[tuple]) -> List[Optional[Dict[str, Any]]]:
+        """批次更新 [(task_id, fields, archive), ...]，全部異動以一次 journal 寫入完成。"""
+        with self._lock:
+            # 先在暫存的 view 上組出異動，同一批中重複的 id 會看到前一筆的結果，最後一起套用並寫入
+            view: Dict[int, Optional[Dict[str, Any]]] = {}
+            entries, results = [], []
+            for task_id, fields, archive in updates:
+                current = view[task_id] if task_id in view else self._pending.get(task_id)
+                if current is None:
+                    results.append(None)
+                    continue
+                ticket = {**current, **fields}
+                if archive:
+                    entries.append({"op": "archive", "ticket": ticket})
+                    view[task_id] = None
+                else:
+                    entries.append({"op": "update", "id": task_id, "fields": fields})
+                    view[task_id] = ticket
+                results.append(ticket)
+            seq = self._append_many(entries)
+        self._wait_durable(seq)
+        return results
+
+    # --- 乘客資料 ---
+    def list_passengers(self) -> List[Dict[str, Any]]:
+        """回傳共用的快取清單，呼叫端不可修改。"""
+        with self._lock:
+            return self._passengers.list()
+
+    def find_passenger(self, id_number: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._passengers.get(id_number)
+
+    def next_passenger_id(self) -> int:
+        return self._passenger_ids.next()
+
+    def upsert_passenger(self, fields: Dict[str, Any], overwrite: bool = True) -> Tuple[Dict[str, Any], bool]:
+        """依 id_number 新增或更新乘客 (查詢與寫入在同一個 lock 內完成)；回傳 (乘客, 是否有寫入)。"""
+        with self._lock:
+            existing = self._passengers.get(fields["id_number"])
+            passenger = merge_passenger(existing, fields, overwrite)
+            if passenger is None:
+                return existing, False
+            if existing is None:
+                passenger = {"id": self.next_passenger_id(), **passenger}
+            seq = self._append({"op": "add_passenger", "passenger": passenger})
+        self._wait_durable(seq)
+        return passenger, True
+
+
+class SQLiteTicketStore:
+    """SQLite (WAL mode) 訂票資料庫，介面與 JournalTicketStore 相同。"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tickets (
+        id          INTEGER PRIMARY KEY,
+        archived    INTEGER NOT NULL DEFAULT 0,
+        status      TEXT,
+        travel_date TEXT,
+        data        TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_tickets_archived_id ON tickets (archived, id);
+    CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets (status);
+    CREATE INDEX IF NOT EXISTS idx_tickets_travel_date ON tickets (travel_date);
+
+    CREATE TABLE IF NOT EXISTS passengers (
+        id        INTEGER PRIMARY KEY,
+        name      TEXT,
+        id_number TEXT,
+        data      TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_passengers_id_number ON passengers (id_number);
+
+    CREATE TABLE IF NOT EXISTS id_sequences (
+        name  TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+    """
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        os.makedirs(os.path.dirname(db_file) or ".", exist_ok=True)
+
+        # gevent 下所有 greenlet 共用同一條連線，以 lock 序列化存取
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._sync_sequences()
+        self._load_passengers()
+
+    def _load_passengers(self):
+        # 乘客資料量小、查詢頻繁：啟動時整表載入記憶體索引，之後隨寫入同步更新
+        with self._lock:
+            self._passengers = PassengerIndex(self._query("SELECT data FROM passengers ORDER BY id"))
+
+    def _sync_sequences(self):
+        # 確保序號不小於既有最大 id (例如剛匯入 JSON 資料後)
+        with self._lock:
+            for name, table in (("ticket", "tickets"), ("passenger", "passengers")):
+                self._conn.execute(
+                    f"INSERT INTO id_sequences (name, value) SELECT ?, COALESCE(MAX(id), 0) FROM {table} WHERE true "
+                    "ON CONFLICT (name) DO UPDATE SET value = MAX(value, excluded.value)",
+                    (name,),
+                )
+
+    def _next_id(self, name: str) -> int:
+        # 單一 UPDATE ... RETURNING 陳述式，遞增與讀取為原子操作
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE id_sequences SET value = value + 1 WHERE name = ? RETURNING value", (name,)
+            ).fetchone()[0]
+
+    def _query(self, sql: str, params=()) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [json.loads(row[0]) for row in self._conn.execute(sql, params)]
+
+    def _put_ticket(self, ticket: Dict[str, Any], archived: bool):
+        # 呼叫端需持有 self._lock
+        self._conn.execute(
+            "INSERT OR REPLACE INTO tickets (id, archived, status, travel_date, data) VALUES (?, ?, ?, ?, ?)",
+            (ticket["id"], int(archived), ticket.get("status"), ticket.get("travel_date"),
+             json.dumps(ticket, ensure_ascii=False)),
+        )
+
+    def _put_passenger(self, passenger: Dict[str, Any]):
+        # 呼叫端需持有 self._lock
+        self._conn.execute(
+            "INSERT OR REPLACE INTO passengers (id, name, id_number, data) VALUES (?, ?, ?, ?)",
+            (passenger["id"], passenger.get("name"), passenger.get("id_number"),
+             json.dumps(passenger, ensure_ascii=False)),
+        )
+
+    # --- 訂票資料 ---
+    def list_pending(self) -> List[Dict[str, Any]]:
+        return self._query("SELECT data FROM tickets WHERE archived = 0 ORDER BY id")
+
+    def list_history(self) -> List[Dict[str, Any]]:
+        return self._query("SELECT data FROM tickets WHERE archived = 1 ORDER BY id")
+
+    def iter_history(self, before_id: Optional[int] = None, filters: Optional[Dict[str, str]] = None) -> Iterator[Dict[str, Any]]:
+        """依 id 由新到舊逐筆產生符合條件的歷史記錄；以索引查詢分段讀取。"""
+        filters = filters or {}
+        where, params = ["archived = 1"], []
+        if filters.get("date_from"):
+            where.append("travel_date >= ?")
+            params.append(filters["date_from"])
+        if filters.get("date_to"):
+            where.append("travel_date <= ?")
+            params.append(filters["date_to"])
+        if filters.get("status"):
+            where.append("status = ?")
+            params.append(filters["status"])
+        if filters.get("train_no"):
+            where.append("json_extract(data, '$.train_no') = ?")
+            params.append(filters["train_no"])
+        if filters.get("passenger"):
+            where.append("(json_extract(data, '$.name') = ? OR json_extract(data, '$.id_number') = ?)")
+            params.extend([filters["passenger"], filters["passenger"]])
+
+        cursor = before_id
+        while True:
+            clause = where + (["id < ?"] if cursor is not None else [])
+            chunk = self._query(
+                f"SELECT data FROM tickets WHERE {' AND '.join(clause)} ORDER BY id DESC LIMIT ?",
+                (*params, *([cursor] if cursor is not None else []), HISTORY_SCAN_CHUNK),
+            )
+            yield from chunk
+            if len(chunk) < HISTORY_SCAN_CHUNK:
+                return
+            cursor = chunk[-1]["id"]
+
+    def get_ticket(self, task_id: int) -> Optional[Dict[str, Any]]:
+        rows = self._query("SELECT data FROM tickets WHERE id = ?", (task_id,))
+        return rows[0] if rows else None
+
+    def next_ticket_id(self) -> int:
+        return self._next_id("ticket")
+
+    def add_ticket(self, ticket: Dict[str, Any]):
+        with self._lock:
+            self._put_ticket(ticket, archived=False)
+
+    def update_ticket(self, task_id: int, fields: Dict[str, Any], archive: bool = False) -> Optional[Dict[str, Any]]:
+        """更新待處理訂票；archive=True 時同時移入歷史記錄。找不到時回傳 None。"""
+        return self.update_tickets([(task_id, fields, archive)])[0]
+
+    def update_tickets(self, updates: List[tuple]) -> List[Optional[Dict[str, Any]]]:
+        """批次更新 [(task_id, fields, archive), ...]，在單一交易內完成。"""
+        with self._lock:
+            results = []
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for task_id, fields, archive in updates:
+                    row = self._conn.execute(
+                        "SELECT data FROM tickets WHERE id = ? AND archived = 0", (task_id,)
+                    ).fetchone()
+                    if row is None:
+                        results.append(None)
+                        continue
+                    ticket = {**json.loads(row[0]), **fields}
+                    self._put_ticket(ticket, archived=archive)
+                    results.append(ticket)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return results
+
+    # --- 乘客資料 ---
+    def list_passengers(self) -> List[Dict[str, Any]]:
+        """回傳共用的快取清單，呼叫端不可修改。"""
+        with self._lock:
+            return self._passengers.list()
+
+    def find_passenger(self, id_number: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._passengers.get(id_number)
+
+    def next_passenger_id(self) -> int:
+        return self._next_id("passenger")
+
+    def upsert_passenger(self, fields: Dict[str, Any], overwrite: bool = True) -> Tuple[Dict[str, Any], bool]:
+        """依 id_number 新增或更新乘客 (查詢與寫入在同一個 lock 內完成)；回傳 (乘客, 是否有寫入)。"""
+        with self._lock:
+            existing = self._passengers.get(fields["id_number"])
+            passenger = merge_passenger(existing, fields, overwrite)
+            if passenger is None:
+                return existing, False
+            if existing is None:
+                passenger = {"id": self.next_passenger_id(), **passenger}
+            self._put_passenger(passenger)
+            self._passengers.put(passenger)
+            return passenger, True
+
+    # --- 資料移轉 ---
+    def is_empty(self) -> bool:
+        with self._lock:
+            return (self._conn.execute("SELECT COUNT(*) FROM tickets").fetchone()[0] == 0
+                    and self._conn.execute("SELECT COUNT(*) FROM passengers").fetchone()[0] == 0)
+
+    def import_from(self, source) -> int:
+        """從另一個 store (例如既有的 JSON 檔 / journal) 匯入全部資料，單一交易完成。"""
+        with self._lock:
+            count = 0
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for t in source.list_pending():
+                    self._put_ticket(t, archived=False)
+                    count += 1
+                for h in source.list_history():
+                    self._put_ticket(h, archived=True)
+                    count += 1
+                for p in source.list_passengers():
+                    self._put_passenger(p)
+                    count += 1
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._sync_sequences()
+            self._load_passengers()
+            return count
+
+
+STORE_BACKENDS = ("journal", "sqlite")
+
+def open_store(backend: str, request_file: str, history_file: str, passenger_file: str,
+               journal_file: str, db_file: str, compact_threshold: int = 1000,
+               fsync_window_s: Optional[float] = 0.002):
+    """依 backend 名稱建立 store。第一次使用 sqlite 時會自動匯入既有的 JSON 檔 / journal。"""
+    if backend == "journal":
+        return JournalTicketStore(request_file, history_file, passenger_file, journal_file,
+                                  compact_threshold=compact_threshold, fsync_window_s=fsync_window_s)
+    if backend == "sqlite":
+        db = SQLiteTicketStore(db_file)
+        if db.is_empty() and any(os.path.exists(f) for f in (request_file, history_file, passenger_file, journal_file)):
+            count = migrate_json_to_sqlite(db, request_file, history_file, passenger_file, journal_file)
+            log.info("migrated_to_sqlite", records=count, db_file=db_file)
+        return db
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+def migrate_json_to_sqlite(db: SQLiteTicketStore, request_file: str, history_file: str,
+                           passenger_file: str, journal_file: str) -> int:
+    """將 JSON 快照檔 (含尚未壓縮的 journal) 匯入 SQLite。"""
+    source = JournalTicketStore(request_file, history_file, passenger_file, journal_file, read_only=True)
+    return db.import_from(source)
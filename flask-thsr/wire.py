@@ -0,0 +1,162 @@
+# =======================================================
+# wire.py - poll / 狀態回報的傳輸格式協商
+# =======================================================
+#
+# /poll_for_update、/update_status、/update_status_batch 的請求與回應：
+#   - 編碼：JSON (預設) 或 MessagePack (client 在 Accept 中偏好 application/msgpack 時)
+#   - 壓縮：依 Accept-Encoding 選 zstd / gzip，只壓縮超過 COMPRESS_MIN_BYTES 的回應
+#   - 請求本體可用 Content-Type: application/msgpack 與 Content-Encoding: gzip / zstd
+#   - 協定版本：client 以 X-THSR-Protocol 宣告；2 以上只收到訂票需要的欄位 (JOB_FIELDS)，
+#     沒有宣告的舊版 client 維持原本的完整 JSON
+# 回應標頭帶 X-THSR-Protocol、Accept-Post (可接受的請求格式) 與 Accept-Encoding (可接受的請求壓縮，RFC 7694)，
+# client 據此決定之後的請求要不要改用 MessagePack / 壓縮。
+# msgpack 與 zstandard 都是選用套件，沒有安裝時只提供 JSON / gzip。
+
+import gzip
+import json
+import zlib
+from typing import Any, Dict, List, Tuple
+
+from flask import Request, Response
+
+from metrics import REGISTRY
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PROTOCOL_HEADER = "X-THSR-Protocol"
+PROTOCOL_VERSION = 2
+
+JSON_MIMETYPE = "application/json"
+MSGPACK_MIMETYPE = "application/msgpack"
+
+# 小於此大小的回應不壓縮 (單筆 push 通常只有數百 bytes，壓縮得不償失)
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+# 解壓縮後的請求本體上限，避免壓縮炸彈
+MAX_DECODED_BODY_BYTES = 16 * 1024 * 1024
+
+# 協定版本 2 的 job 只保留訂票需要的欄位 (不含 status / order_date / result_details 等)
+JOB_FIELDS = ("id", "name", "id_number", "train_no", "travel_date", "from_station", "from_time",
+              "to_station", "to_time", "attempts", "group_ids", "passengers", "lease_id")
+
+WIRE_PAYLOAD_BYTES = REGISTRY.histogram(
+    "thsr_wire_payload_bytes", "Encoded size of poll / status response bodies.",
+    ("route", "format", "encoding"),
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+
+
+class WireFormatError(ValueError):
+    """請求本體的編碼 / 壓縮格式不支援 (415) 或無法解析 (400)。"""
+
+    def __init__(self, message: str, http_status: int = 400):
+        super().__init__(message)
+        self.http_status = http_status
+
+
+def response_encodings() -> List[str]:
+    # 依偏好順序；zstd 需要 zstandard 套件
+    return ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+
+def request_mimetypes() -> List[str]:
+    return [MSGPACK_MIMETYPE, JSON_MIMETYPE] if msgpack is not None else [JSON_MIMETYPE]
+
+def client_protocol(req: Request) -> int:
+    try:
+        return int(req.headers.get(PROTOCOL_HEADER, "1"))
+    except ValueError:
+        return 1
+
+
+# --- 請求 ---
+def _decompress(body: bytes, encoding: str) -> bytes:
+    if encoding in ("", "identity"):
+        return body
+    if encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = decompressor.decompress(body, MAX_DECODED_BODY_BYTES)
+    elif encoding == "zstd" and zstandard is not None:
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+                data = reader.read(MAX_DECODED_BODY_BYTES)
+        except zstandard.ZstdError as e:
+            raise WireFormatError(f"Invalid zstd body: {e}") from e
+    else:
+        raise WireFormatError(f"Unsupported Content-Encoding: {encoding}", 415)
+    if len(data) >= MAX_DECODED_BODY_BYTES:
+        raise WireFormatError("Request body too large", 413)
+    return data
+
+def decode_request(req: Request) -> Any:
+    """依 Content-Encoding / Content-Type 解出請求本體 (JSON 或 MessagePack)。"""
+    try:
+        body = _decompress(req.get_data(cache=False), (req.headers.get("Content-Encoding") or "").strip().lower())
+    except zlib.error as e:
+        raise WireFormatError(f"Invalid compressed body: {e}") from e
+    if not body:
+        return None
+    if req.mimetype == MSGPACK_MIMETYPE:
+        if msgpack is None:
+            raise WireFormatError("MessagePack is not supported by this server", 415)
+        try:
+            return msgpack.unpackb(body, raw=False, strict_map_key=False)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise WireFormatError(f"Invalid MessagePack body: {e}") from e
+    try:
+        return json.loads(body)
+    except ValueError as e:
+        raise WireFormatError(f"Invalid JSON body: {e}") from e
+
+
+# --- 回應 ---
+def _encode_body(req: Request, payload: Any) -> Tuple[bytes, str]:
+    accept = req.accept_mimetypes
+    if msgpack is not None and accept.quality(MSGPACK_MIMETYPE) > accept.quality(JSON_MIMETYPE):
+        return msgpack.packb(payload, use_bin_type=True), MSGPACK_MIMETYPE
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), JSON_MIMETYPE
+
+def _compress(req: Request, body: bytes) -> Tuple[bytes, str]:
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, ""
+    encoding = req.accept_encodings.best_match(response_encodings())
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body), encoding
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), encoding
+    return body, ""
+
+def encode_response(req: Request, payload: Any, status: int = 200) -> Response:
+    """依 Accept / Accept-Encoding 編碼並壓縮回應，附上協定版本與可接受的請求格式。"""
+    body, mimetype = _encode_body(req, payload)
+    body, encoding = _compress(req, body)
+    route = req.url_rule.rule if req.url_rule else req.path
+    WIRE_PAYLOAD_BYTES.observe(len(body), route=route, format=mimetype.split("/")[1], encoding=encoding or "identity")
+    response = Response(body, status=status, mimetype=mimetype)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept, Accept-Encoding"
+    response.headers[PROTOCOL_HEADER] = str(PROTOCOL_VERSION)
+    response.headers["Accept-Post"] = ", ".join(request_mimetypes())
+    response.headers["Accept-Encoding"] = ", ".join(response_encodings())
+    return response
+
+
+# --- 協定版本 2：精簡的 job ---
+def compact_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: job[key] for key in JOB_FIELDS if key in job}
+
+def compact_poll_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    data = payload.get("data")
+    if isinstance(data, list):
+        return {**payload, "data": [compact_job(job) for job in data]}
+    if isinstance(data, dict):
+        return {**payload, "data": compact_job(data)}
+    return payload